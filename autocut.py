@@ -1,30 +1,107 @@
 #!/usr/bin/python3
 # Requirements:
-# pip install pydub
+# pip install numpy pydub
 # sudo apt-add-repository ppa:marin-m/songrec
 # sudo apt install songrec
 
 import argparse
+import concurrent.futures
 import configparser
+import contextlib
+import copy
+import ctypes
+import ctypes.util
 import datetime
+import fcntl
+import ftplib
 from ftplib import FTP
 import glob
+import hashlib
 import json
 import logging
+import math
+import multiprocessing
 import os
 import re
+import resource
+import select
+import shlex
+import sqlite3
 import platform
+import struct
+import sys
 import subprocess
-from statx import statx
 import tempfile
-from time import sleep, time_ns
+import threading
+import urllib.parse
+import urllib.request
+from time import sleep, time, time_ns
+import wave
 import yaml
 
-from pydub import AudioSegment, effects, silence
-from inaSpeechSegmenter import Segmenter
+import numpy as np
+# pydub, statx and inaSpeechSegmenter (which loads TensorFlow) are imported
+# by the functions that need them, so that --help, --upload-only and the
+# tests start quickly
 
 
 intro_length = 100000
+# songrec needs a few seconds to recognize a song
+min_intro_length = 10000
+# The coarse pass over the 20 s slots only probes every coarse_slot_step-th
+# slot; that still hits every intro that is at least a minute long
+coarse_slot_step = 3
+envelope_hop_ms = 10
+# Jingle fingerprints: spectral peaks of 16 kHz mono audio in 64 ms windows
+# every 32 ms, picked in fingerprint_bands (FFT bins, ~150 Hz - 5 kHz).
+# Every peak is paired with the next fingerprint_fan_out peaks.
+fingerprint_rate = 16000
+fingerprint_fft = 1024
+fingerprint_hop = 512
+fingerprint_bands = [10, 15, 22, 33, 49, 72, 106, 157, 232, 320]
+fingerprint_fan_out = 5
+fingerprint_max_dt = 31
+fingerprint_floor_db = -20
+# Fast speech/music classifier: features of 25 ms frames, classified in
+# windows of 1 s every 0.5 s and smoothed over classifier_smoothing windows
+classifier_frame = 400
+classifier_window = 40
+classifier_hop = 20
+classifier_smoothing = 7
+chunk_frames = 1 << 20
+_segmenter = None
+_segmenter_pool = None
+# Windows (in seconds) that get segmented in parallel, and how much they
+# overlap on each side
+segment_window_sec = 600
+segment_overlap_sec = 30
+# Memory (in MB) a process with the segmenter models needs (TensorFlow)
+segmenter_process_mb = 1000
+parallel_segmentation = True
+# Windows (in seconds) that get segmented while recording, and how much
+# audio at the recording head we ignore when looking for the intro
+live_window_sec = 120
+live_guard_ms = 10000
+# The phone server plays 8 kHz mono in these formats
+phone_rate = 8000
+phone_formats = ['.wav', '.ulaw', '.sln', '.gsm']
+phone_sounds_dir = '/var/lib/asterisk/sounds/de_DE/custom/'
+# Loudness normalization (ITU-R BS.1770): the loudness is measured in
+# blocks of 100 ms; gain changes are smoothed over +/- loudness_smoothing
+# blocks and no piece gets louder by more than loudness_max_gain_db
+loudness_block_ms = 100
+loudness_smoothing = 3
+loudness_max_gain_db = 20.0
+# K-weighting filters (pre-filter and RLB high-pass) as (b, a) at 48 kHz
+_k_weighting_filters = [
+    ([1.53512485958697, -2.69169618940638, 1.19839281085285],
+     [1.0, -1.69065929318241, 0.73248077421585]),
+    ([1.0, -2.0, 1.0],
+     [1.0, -1.99004745483398, 0.99007225036621])]
+# Directory for intermediate files; every process in batch mode has its own
+work_dir = None
+# Where in the recording the decoded audio starts (see get_decode_start_ms)
+decode_offset_ms = 0
 
 
 def convert_milliseconds_to_readable(millseconds):
@@ -35,6 +112,15 @@ def convert_milliseconds_to_readable(millseconds):
     return f'{hours:02}:{minutes:02}:{seconds:04.1f}'
 
 
+def get_work_dir():
+    return work_dir or tempfile.gettempdir()
+
+
+def ms_to_frame(millseconds, frame_rate):
+    # Same conversion as AudioSegment slicing
+    return int(millseconds * (frame_rate / 1000.0))
+
+
 def secure_lookup(data, key1, key2=None, default=None):
     """
     Return data[key1][key2] while dealing with data being None or key1
@@ -50,27 +136,874 @@ def secure_lookup(data, key1, key2=None, default=None):
     return default
 
 
-def load_audio(file):
+def load_audio(file, streaming=False):
     logging.info('Loading %s', file)
     if not os.path.exists(file):
         logging.error('File %s not found', file)
         exit(2)
+    if is_pcm_store(file):
+        return PcmStore(file)
+    if streaming:
+        return StreamedAudio(file)
+    from pydub import AudioSegment
     return AudioSegment.from_file(file)
 
 
+def probe_audio(file):
+    """
+    Return the tuple (duration in ms, frame rate) of the audio stream in file
+    """
+    out = subprocess.run(['ffmpeg', '-hide_banner', '-i', file],
+                         stderr=subprocess.PIPE, text=True)
+    match = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', out.stderr)
+    if not match:
+        raise ValueError(f"Can't determine duration of {file}")
+    (hours, minutes, seconds) = match.groups()
+    duration_ms = round(((int(hours) * 60 + int(minutes)) * 60 +
+                         float(seconds)) * 1000)
+    match = re.search(r'Audio: .*?(\d+) Hz', out.stderr)
+    return (duration_ms, int(match.group(1)) if match else 44100)
+
+
+class StreamedAudio:
+    """
+    AudioSegment-like view on (a part of) an audio file. Instead of keeping
+    the decoded recording in memory the samples are decoded with ffmpeg on
+    demand, either in chunks or for short slices.
+    """
+    sample_width = 2
+    channels = 2
+    max_possible_amplitude = 32768.0
+
+    def __init__(self, file, start_ms=0, end_ms=None, frame_rate=None):
+        self.file = file
+        if end_ms is None or frame_rate is None:
+            (duration_ms, probed_rate) = probe_audio(file)
+            end_ms = duration_ms if end_ms is None else end_ms
+            frame_rate = frame_rate or probed_rate
+        self.frame_rate = frame_rate
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+
+    def __len__(self):
+        return round(self.end_ms - self.start_ms)
+
+    def __getitem__(self, millisecond):
+        start = millisecond.start if millisecond.start is not None else 0
+        end = millisecond.stop if millisecond.stop is not None else len(self)
+        start = self.start_ms + min(max(start, 0), len(self))
+        end = self.start_ms + min(max(end, 0), len(self))
+        view = copy.copy(self)
+        view.start_ms = start
+        view.end_ms = max(start, end)
+        return view
+
+    def frame_count(self):
+        return ms_to_frame(len(self), self.frame_rate)
+
+    def iter_chunks(self, chunk_frames=1 << 20):
+        """
+        Decode the view and yield the samples in consecutive blocks of
+        shape (frames, channels)
+        """
+        frame_width = self.sample_width * self.channels
+        cmd = ['ffmpeg', '-v', 'error', '-ss', f'{self.start_ms / 1000:.6f}',
+               '-t', f'{(self.end_ms - self.start_ms) / 1000:.6f}',
+               '-i', self.file, '-vn', '-f', 's16le', '-ac',
+               str(self.channels), '-ar', str(self.frame_rate), '-']
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as process:
+            while True:
+                data = process.stdout.read(chunk_frames * frame_width)
+                if not data:
+                    break
+                data = data[:len(data) - len(data) % frame_width]
+                yield np.frombuffer(data, dtype=np.int16).reshape(
+                    -1, self.channels)
+            process.stdout.close()
+
+    def read_frames(self, start=0, end=None):
+        """
+        Return the samples between the frames start and end of the view
+        """
+        end = self.frame_count() if end is None else end
+        view = self[start * 1000 / self.frame_rate:end * 1000 / self.frame_rate]
+        chunks = list(view.iter_chunks())
+        if not chunks:
+            return np.zeros((0, self.channels), dtype=np.int16)
+        return np.concatenate(chunks)[:end - start]
+
+    def to_audio_segment(self):
+        from pydub import AudioSegment
+        return AudioSegment(self.read_frames().tobytes(),
+                            frame_rate=self.frame_rate,
+                            sample_width=self.sample_width,
+                            channels=self.channels)
+
+    def export(self, out_f, **kwargs):
+        return self.to_audio_segment().export(out_f, **kwargs)
+
+
+def _wav_layout(file):
+    """
+    Return the tuple (frame_rate, channels, data offset, data size) of the
+    16-bit PCM WAV file
+    """
+    with open(file, 'rb') as f:
+        (riff, _, wave) = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError(f'{file} is not a WAV file')
+        frame_rate = channels = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError(f'No data in {file}')
+            (chunk_id, size) = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                (_, channels, frame_rate) = struct.unpack('<HHI', f.read(8))
+                f.seek(size - 8 + size % 2, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                return (frame_rate, channels, f.tell(), size)
+            else:
+                f.seek(size + size % 2, os.SEEK_CUR)
+
+
+def get_segmenter_filename(store_file):
+    return os.path.splitext(store_file)[0] + '-16k.wav'
+
+
+def get_fallback_filename(store_file):
+    return os.path.splitext(store_file)[0] + '.mp3'
+
+
+def is_pcm_store(file):
+    return os.path.exists(get_segmenter_filename(file))
+
+
+class PcmStore(StreamedAudio):
+    """
+    The decoded recording, memory-mapped from the WAV file written by
+    convert_to_pcm_store. Next to it is the 16 kHz mono version that the
+    segmenter needs. Slicing and reading is done on the mapped samples, so
+    all stages share one decode.
+    """
+
+    def __init__(self, file, start_ms=0, end_ms=None):
+        self.file = file
+        (self.frame_rate, self.channels, offset, size) = _wav_layout(file)
+        frames = min(size, os.path.getsize(file) - offset) // (
+            self.channels * self.sample_width)
+        self.samples = np.memmap(file, dtype=np.int16, mode='r',
+                                 offset=offset, shape=(frames, self.channels))
+        self.start_ms = start_ms
+        self.end_ms = round(1000 * frames / self.frame_rate) \
+            if end_ms is None else end_ms
+
+    def _frame_range(self):
+        return (ms_to_frame(self.start_ms, self.frame_rate),
+                ms_to_frame(self.end_ms, self.frame_rate))
+
+    def iter_chunks(self, chunk_frames=1 << 20):
+        (start, end) = self._frame_range()
+        for pos in range(start, min(end, len(self.samples)), chunk_frames):
+            yield np.array(self.samples[pos:min(pos + chunk_frames, end)])
+
+    def read_frames(self, start=0, end=None):
+        (offset, view_end) = self._frame_range()
+        end = view_end - offset if end is None else end
+        return np.array(self.samples[offset + start:offset + end])
+
+    def segmenter_samples(self, start_ms=0, end_ms=None):
+        """
+        Return the 16 kHz mono samples (as float in -1..1) from start_ms to
+        end_ms, for the fingerprints and the fast classifier
+        """
+        segmenter_file = get_segmenter_filename(self.file)
+        (frame_rate, _, offset, size) = _wav_layout(segmenter_file)
+        frames = min(size, os.path.getsize(segmenter_file) - offset) // 2
+        samples = np.memmap(segmenter_file, dtype=np.int16, mode='r',
+                            offset=offset, shape=(frames,))
+        start = ms_to_frame(start_ms, frame_rate)
+        end = None if end_ms is None else ms_to_frame(end_ms, frame_rate)
+        return samples[start:end].astype(np.float32) / 32768
+
+
+def get_chunk_frames(max_memory_mb, channels=StreamedAudio.channels):
+    """
+    Return the number of frames to process at once so that the processing
+    stays within max_memory_mb. Processing a block needs several
+    intermediate copies (in 64 bit), so we allow 32 bytes per sample.
+    """
+    return max(1 << 16, max_memory_mb * 1024 * 1024 // (channels * 32))
+
+
+def audio_to_samples(audio):
+    """
+    Return the samples of audio as NumPy array of shape (frames, channels)
+    without copying the data
+    """
+    if audio.sample_width == 3:
+        audio = audio.set_sample_width(4)
+    dtype = {1: np.int8, 2: np.int16, 4: np.int32}[audio.sample_width]
+    return np.frombuffer(audio.raw_data, dtype=dtype).reshape(
+        -1, audio.channels)
+
+
+def iter_sample_chunks(samples, chunk_frames=1 << 20):
+    for pos in range(0, len(samples), chunk_frames):
+        yield samples[pos:pos + chunk_frames]
+
+
+def _prefix_energy(chunks, boundaries):
+    """
+    Return the sum of the squared samples before each of the (sorted) frame
+    positions in boundaries. chunks is an iterable of consecutive sample
+    blocks of shape (frames, channels).
+    """
+    result = np.zeros(len(boundaries), dtype=np.float64)
+    total = 0
+    pos = 0
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+        # exact for 16-bit audio, same as audioop
+        flat = chunk.reshape(-1).astype(
+            np.int64 if chunk.dtype.itemsize <= 2 else np.float64)
+        flat *= flat
+        # boundaries within this chunk (boundary b covers frames [0, b))
+        first = np.searchsorted(boundaries, pos, side='right')
+        last = np.searchsorted(boundaries, pos + len(chunk), side='right')
+        cuts = (boundaries[first:last] - pos) * chunk.shape[1]
+        points = np.concatenate(([0], cuts[cuts < len(flat)]))
+        sums = np.add.reduceat(flat, points)
+        prefix = total + np.cumsum(sums)
+        # prefix[k] is the sum up to points[k + 1] (or the end of the chunk)
+        result[first:last] = prefix[np.searchsorted(points, cuts) - 1]
+        total = prefix[-1]
+        pos += len(chunk)
+    # boundaries after the end (pydub pads with silence)
+    result[np.searchsorted(boundaries, pos, side='right'):] = total
+    return result
+
+
+def _silent_starts(chunks, seg_len, frame_count, frame_rate, channels,
+                   min_silence_len, silence_thresh, seek_step):
+    """
+    Return the start (in ms) of all windows of min_silence_len ms whose rms
+    is below silence_thresh (as ratio of the max amplitude), stepping
+    seek_step ms. This produces the same result as pydub.silence which
+    calculates the rms for every window separately.
+    """
+    last_slice_start = seg_len - min_silence_len
+    starts = np.arange(0, last_slice_start + 1, seek_step)
+    if last_slice_start % seek_step:
+        starts = np.append(starts, last_slice_start)
+    ends = np.minimum(starts + min_silence_len, seg_len)
+    # Same ms to frame conversion as AudioSegment slicing
+    start_frames = (starts * (frame_rate / 1000.0)).astype(np.int64)
+    end_frames = (ends * (frame_rate / 1000.0)).astype(np.int64)
+    boundaries = np.unique(np.concatenate((start_frames, end_frames)))
+    energy = _prefix_energy(chunks, np.minimum(boundaries, frame_count))
+    window_energy = (energy[np.searchsorted(boundaries, end_frames)] -
+                     energy[np.searchsorted(boundaries, start_frames)])
+    counts = (end_frames - start_frames) * channels
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rms = np.where(counts > 0, np.floor(np.sqrt(window_energy / counts)),
+                       0)
+    return starts[rms <= silence_thresh]
+
+
+def _nonsilent_ranges(silence_starts, seg_len, min_silence_len, seek_step):
+    if len(silence_starts) == 0:
+        return [[0, seg_len]]
+
+    # combine overlapping silent windows into ranges
+    diff = np.diff(silence_starts)
+    breaks = np.nonzero((diff != seek_step) & (diff > min_silence_len))[0]
+    range_starts = np.concatenate(([silence_starts[0]],
+                                   silence_starts[breaks + 1]))
+    range_ends = np.concatenate((silence_starts[breaks],
+                                 [silence_starts[-1]])) + min_silence_len
+    silent_ranges = list(zip(range_starts.tolist(), range_ends.tolist()))
+
+    # whole segment is silent
+    if silent_ranges[0][0] == 0 and silent_ranges[0][1] == seg_len:
+        return []
+
+    prev_end = 0
+    nonsilent_ranges = []
+    for start, end in silent_ranges:
+        nonsilent_ranges.append([prev_end, start])
+        prev_end = end
+    if prev_end != seg_len:
+        nonsilent_ranges.append([prev_end, seg_len])
+    if nonsilent_ranges[0] == [0, 0]:
+        nonsilent_ranges.pop(0)
+    return nonsilent_ranges
+
+
+def detect_nonsilent(audio, min_silence_len=1000, silence_thresh=-16,
+                     seek_step=1, chunk_frames=1 << 20):
+    """
+    Vectorized version of pydub.silence.detect_nonsilent. Returns the same
+    [start, end] ranges (in ms) but calculates the rms of all windows in
+    one pass over the samples.
+    """
+    from pydub.utils import db_to_float
+    seg_len = len(audio)
+    if seg_len < min_silence_len:
+        return [[0, seg_len]]
+    if isinstance(audio, StreamedAudio):
+        chunks = audio.iter_chunks(chunk_frames)
+        frame_count = audio.frame_count()
+    else:
+        samples = audio_to_samples(audio)
+        chunks = iter_sample_chunks(samples)
+        frame_count = len(samples)
+    thresh = db_to_float(silence_thresh) * audio.max_possible_amplitude
+    silence_starts = _silent_starts(
+        chunks, seg_len, frame_count, audio.frame_rate, audio.channels,
+        min_silence_len, thresh, seek_step)
+    return _nonsilent_ranges(silence_starts, seg_len, min_silence_len,
+                             seek_step)
+
+
 def detect_segments(audio, silence_len=1000, seek_step=100):
     logging.info('Detecting segments')
-    return silence.detect_nonsilent(audio, min_silence_len=silence_len,
-                                    silence_thresh=-50, seek_step=seek_step)
+    return detect_nonsilent(audio, min_silence_len=silence_len,
+                            silence_thresh=-50, seek_step=seek_step,
+                            chunk_frames=chunk_frames)
+
+
+class SegmenterEnergy:
+    """
+    The mean log energy of the frames of a recording, computed like the
+    segmenter does. The segmenter labels the frames that are much quieter
+    than the mean as noEnergy, and takes the mean of the audio it gets.
+    Windows of a recording therefore have to be segmented against the
+    mean of the whole recording (in live mode: of the recording so far) to
+    get the same result as one pass.
+    """
+    frame = 400
+    shift = 160
+    pre_emphasis = 0.97
+    energy_ratio = 0.03
+
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
+
+    @classmethod
+    def log_energy(cls, samples):
+        """
+        Return the log energy of the 25 ms frames (every 10 ms) of the
+        16 kHz samples, pre-emphasized within every frame
+        """
+        if len(samples) < cls.frame:
+            return np.zeros(0)
+        samples = samples.astype(np.float64)
+        frames = np.lib.stride_tricks.sliding_window_view(
+            samples, cls.frame)[::cls.shift]
+        energy = np.square(frames[:, 0] * (1 - cls.pre_emphasis)) + \
+            np.sum(np.square(frames[:, 1:] - cls.pre_emphasis *
+                             frames[:, :-1]), axis=1)
+        with np.errstate(divide='ignore'):
+            return np.log(energy)
+
+    def add(self, store_file, start_ms=0, end_ms=None):
+        """
+        Add the frames of the 16 kHz file of the PCM store from start_ms to
+        end_ms
+        """
+        store = PcmStore(store_file)
+        end_ms = store.end_ms if end_ms is None else end_ms
+        # blocks that are a multiple of the frame shift, so that the
+        # frames continue across the blocks
+        block_ms = self.shift * 4000 * 1000 // fingerprint_rate
+        rest = np.zeros(0, dtype=np.float32)
+        for pos in range(round(start_ms), round(end_ms), block_ms):
+            samples = np.concatenate([rest, store.segmenter_samples(
+                pos, min(pos + block_ms, round(end_ms)))])
+            energy = self.log_energy(samples)
+            rest = samples[len(energy) * self.shift:]
+            energy = energy[np.isfinite(energy)]
+            self.total += float(np.sum(energy))
+            self.count += len(energy)
+        return self
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+def segment_file(store_file, start_ms=0, end_ms=None, reference=None):
+    """
+    Segment the 16 kHz mono file of the PCM store from start_ms to end_ms.
+    The segmenter still runs ffmpeg on it, but that only copies the samples
+    instead of decoding the recording again. reference is the mean log
+    energy of the whole recording (SegmenterEnergy.mean()); by default the
+    segmenter uses the one of start_ms to end_ms.
+    """
+    segmenter = get_segmenter()
+    energy_ratio = segmenter.energy_ratio
+    if reference is not None:
+        window = SegmenterEnergy().add(store_file, start_ms, end_ms).mean()
+        if window is not None:
+            # the segmenter's threshold is the mean of the window plus
+            # log(energy_ratio); move it to the one of the recording
+            segmenter.energy_ratio = SegmenterEnergy.energy_ratio * np.exp(
+                reference - window)
+    try:
+        return segmenter(
+            get_segmenter_filename(store_file), start_sec=start_ms / 1000,
+            stop_sec=None if end_ms is None else end_ms / 1000)
+    finally:
+        segmenter.energy_ratio = energy_ratio
+
+
+def get_segmenter():
+    """
+    Return the segmenter. Loading the models takes a while, so the
+    segmenter is kept for later runs (in worker mode).
+    """
+    global _segmenter
+    if _segmenter is None:
+        logging.info('Loading segmenter models')
+        from inaSpeechSegmenter import Segmenter
+        _segmenter = Segmenter()
+    return _segmenter
+
+
+def available_memory_mb():
+    """
+    Return the memory (in MB) that is available without swapping
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') \
+        // (1024 * 1024)
+
+
+def get_segmenter_processes(config):
+    """
+    Return how many processes with the segmenter models may run at the
+    same time: Processing/SegmenterProcesses, or by default one per CPU,
+    but only as many as fit into Processing/SegmenterMemory (by default
+    the memory that is available). This is separate from MaxMemory, which
+    limits the audio that is kept in memory.
+    """
+    processes = int(config['Processing']['SegmenterProcesses'])
+    if processes:
+        return processes
+    budget_mb = int(config['Processing']['SegmenterMemory']) or \
+        available_memory_mb()
+    return max(1, min(os.cpu_count() or 1,
+                      budget_mb // segmenter_process_mb))
+
+
+def get_segmenter_pool():
+    """
+    Return the process pool for segmenting in parallel, or None if we
+    segment in this process. Every process loads the models once, so we
+    only start get_segmenter_processes(config) processes.
+    """
+    global _segmenter_pool
+    processes = get_segmenter_processes(config)
+    if not parallel_segmentation or processes < 2:
+        return None
+    if _segmenter_pool is None:
+        # spawn instead of fork: forking after the models got loaded
+        # isn't safe
+        _segmenter_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes, initializer=get_segmenter,
+            mp_context=multiprocessing.get_context('spawn'))
+    return _segmenter_pool
+
+
+def segment_window(store_file, start_ms, end_ms, engine='cnn',
+                   reference=None):
+    """
+    Segment start_ms to end_ms of the PCM store with engine. reference is
+    the level of the whole recording the window is compared with:
+    ClassifierReference.level() for the fast classifier,
+    SegmenterEnergy.mean() for the CNN.
+    """
+    if engine == 'fast':
+        return classify_segments(PcmStore(store_file)[start_ms:end_ms],
+                                 start_ms / 1000, reference)
+    return segment_file(store_file, start_ms, end_ms, reference)
+
+
+def _frame_features(frames):
+    """
+    Return energy, spectral flatness, harmonicity and spectral centroid of
+    every frame of 16 kHz samples
+    """
+    energy = np.mean(np.square(frames), axis=1)
+    # zero padding to twice the length gives the linear autocorrelation
+    power = np.square(np.abs(np.fft.rfft(frames, 1024, axis=1)))
+    band = power[:, 12:512] + 1e-12
+    flatness = np.exp(np.mean(np.log(band), axis=1)) / np.mean(band, axis=1)
+    autocorrelation = np.fft.irfft(power, 1024, axis=1)
+    # pitch between 50 and 400 Hz
+    harmonicity = autocorrelation[:, 40:320].max(axis=1) / np.maximum(
+        autocorrelation[:, 0], 1e-12)
+    magnitude = np.sqrt(power[:, :512])
+    centroid = magnitude @ np.fft.rfftfreq(1024, 1 / fingerprint_rate)[
+        :512] / np.maximum(magnitude.sum(axis=1), 1e-12)
+    return (energy, flatness, harmonicity, centroid)
+
+
+def frame_features(blocks):
+    """
+    Return the features (energy, flatness, harmonicity and spectral
+    centroid) of the 25 ms frames of the consecutive blocks of 16 kHz mono
+    samples, as arrays with one value per frame
+    """
+    features = [[] for _ in range(4)]
+    rest = np.zeros(0, dtype=np.float32)
+    for block in blocks:
+        samples = np.concatenate([rest, block])
+        count = len(samples) // classifier_frame
+        rest = samples[count * classifier_frame:]
+        frames = samples[:count * classifier_frame].reshape(
+            -1, classifier_frame)
+        for pos in range(0, count, 1024):
+            for (feature, value) in zip(
+                    features, _frame_features(frames[pos:pos + 1024])):
+                feature.append(value)
+    return [np.concatenate(feature) if feature else np.zeros(0)
+            for feature in features]
+
+
+def _windows(values):
+    """
+    Return the frame values in windows of classifier_window frames, one
+    window every classifier_hop frames, centered on the hop
+    """
+    count = -(-len(values) // classifier_hop)
+    pad = (classifier_window - classifier_hop) // 2
+    padded = np.pad(values, (pad, pad + classifier_window), mode='edge')
+    return np.lib.stride_tricks.sliding_window_view(
+        padded, classifier_window)[::classifier_hop][:count]
+
+
+def _masked_mean(values, mask):
+    return np.sum(values * mask, axis=1) / np.maximum(mask.sum(axis=1), 1)
+
+
+def _masked_deviation(values, mask):
+    mean = _masked_mean(values, mask)
+    return (np.sqrt(_masked_mean(np.square(values - mean[:, np.newaxis]),
+                                 mask)), mean)
+
+
+def _frame_levels(energy):
+    return 10 * np.log10(energy + 1e-12)
 
 
-def detect_detailed_segments(audio_file, startMilliSeconds):
+class ClassifierReference:
+    """
+    The mean level of the frames with sound of the whole recording, which
+    the fast classifier compares every window with (like the segmenter
+    does). In live mode the frames are added as they get decoded, so the
+    mean is the one of the recording so far.
+    """
+
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, audio):
+        for block in _iter_fingerprint_samples(audio):
+            count = len(block) // classifier_frame
+            level = _frame_levels(np.mean(np.square(
+                block[:count * classifier_frame].reshape(
+                    -1, classifier_frame)), axis=1))
+            level = level[level >= -60]
+            self.total += float(np.sum(level))
+            self.count += len(level)
+        return self
+
+    def level(self):
+        """
+        Return the mean level in dB
+        """
+        return self.total / self.count if self.count else -60.0
+
+
+def classify_windows(energy, flatness, harmonicity, centroid,
+                     reference=None):
+    """
+    Return the kind (speech, music, noise or noEnergy) of every window.
+    Frames more than 25 dB below the mean level are silent, windows that
+    are mostly silent are noEnergy. In the others only the frames with
+    sound count: speech alternates syllables and pauses, voiced and
+    unvoiced sounds, so its level, harmonicity and spectral centroid vary
+    more than in music; noise is flat and steady. reference is the mean
+    level of the whole recording (ClassifierReference.level()); by default
+    the one of the given frames.
+    """
+    if not len(energy):
+        return np.zeros(0, dtype=object)
+    level = _frame_levels(energy)
+    if reference is None:
+        loud = level[level >= -60]
+        reference = float(np.mean(loud)) if len(loud) else -60.0
+    silent = (level < -60) | (level < reference - 25)
+    sound = ~_windows(silent)
+    (level_variation, _) = _masked_deviation(_windows(level), sound)
+    (harmonicity_variation, _) = _masked_deviation(_windows(harmonicity),
+                                                   sound)
+    (centroid_variation, mean_centroid) = _masked_deviation(
+        _windows(centroid), sound)
+    centroid_variation /= np.maximum(mean_centroid, 1)
+    energy = _windows(energy)
+    (steadiness, mean_energy) = _masked_deviation(energy, sound)
+    steadiness /= np.maximum(mean_energy, 1e-12)
+    sustained = _masked_mean(_windows(harmonicity) > 0.5, sound)
+    flatness = _masked_mean(_windows(flatness), sound)
+
+    speech = (level_variation - 7.5) + 15 * (harmonicity_variation - 0.08) + \
+        20 * (centroid_variation - 0.23)
+    kinds = np.where(speech > 0, 'speech', 'music').astype(object)
+    kinds[(flatness > 0.4) & (sustained < 0.1) & (steadiness < 0.3)] = \
+        'noise'
+    kinds[sound.mean(axis=1) < 0.5] = 'noEnergy'
+    return kinds
+
+
+def smooth_kinds(kinds):
+    """
+    Replace the kind of every window by the most frequent one of the
+    surrounding classifier_smoothing windows. Pauses (noEnergy) remain, even
+    a single window: the segmenter keeps short pauses too.
+    """
+    names = ['speech', 'music', 'noise', 'noEnergy']
+    codes = np.array([names.index(kind) for kind in kinds], dtype=np.int64)
+    if not len(codes):
+        return kinds
+    no_energy = codes == names.index('noEnergy')
+    radius = classifier_smoothing // 2
+    padded = np.pad(codes, radius, mode='edge')
+    view = np.lib.stride_tricks.sliding_window_view(padded,
+                                                    2 * radius + 1)
+    counts = np.stack([np.sum(view == code, axis=1)
+                       for code in range(len(names) - 1)], axis=1) * 1.0
+    # keep the own kind on a tie
+    own = np.flatnonzero(codes < names.index('noEnergy'))
+    counts[own, codes[own]] += 0.5
+    return np.where(no_energy, 'noEnergy', np.array(
+        names, dtype=object)[counts.argmax(axis=1)]).astype(object)
+
+
+def classify_segments(audio, start_sec=0, reference=None):
+    """
+    Segment audio into speech, music, noise and noEnergy with spectral
+    features instead of the CNN of the segmenter. Returns the same (kind,
+    start, stop) tuples (in seconds, starting at start_sec). If audio is a
+    window of a longer recording, reference is the mean level of the whole
+    recording (see ClassifierReference).
+    """
+    features = frame_features(_iter_fingerprint_samples(audio))
+    kinds = smooth_kinds(classify_windows(*features, reference=reference))
+    hop_sec = classifier_hop * classifier_frame / fingerprint_rate
+    end_sec = start_sec + len(audio) / 1000
+    segments = []
+    start = 0
+    for i in range(1, len(kinds) + 1):
+        if i == len(kinds) or kinds[i] != kinds[start]:
+            segments.append((kinds[start], round(start_sec + start * hop_sec,
+                                                 2),
+                             round(min(start_sec + i * hop_sec, end_sec), 2)))
+            start = i
+    return segments
+
+
+def split_into_windows(start_sec, end_sec, window_sec, overlap_sec):
+    """
+    Split start_sec-end_sec into windows of window_sec that overlap by
+    overlap_sec on each side. Returns a list of (start, end, owned_start,
+    owned_end) tuples; owned_start-owned_end are the parts that don't
+    overlap and that together cover start_sec-end_sec.
+    """
+    windows = []
+    owned_start = start_sec
+    while owned_start < end_sec:
+        owned_end = owned_start + window_sec
+        if end_sec - owned_end < window_sec / 2:
+            # Rather make the last window longer than having a short one
+            owned_end = end_sec
+        windows.append((max(start_sec, owned_start - overlap_sec),
+                        min(end_sec, owned_end + overlap_sec),
+                        owned_start, owned_end))
+        owned_start = owned_end
+    return windows
+
+
+def stitch_segments(windows):
+    """
+    Combine the segments of overlapping windows. windows is a list of
+    (owned_start, owned_end, segments); the segments of every window are
+    cut to the part the window owns, and segments of the same kind that
+    meet at a window boundary are joined.
+    """
+    result = []
+    for (owned_start, owned_end, segments) in windows:
+        for (kind, start, stop) in segments:
+            start = max(start, owned_start)
+            stop = min(stop, owned_end)
+            if stop <= start:
+                continue
+            if result and result[-1][0] == kind and result[-1][2] == start:
+                result[-1] = (kind, result[-1][1], stop)
+            else:
+                result.append((kind, start, stop))
+    return result
+
+
+def detect_detailed_segments(audio, audio_file, startMilliSeconds):
     logging.info('Detecting detailed segments')
-    segmenter = Segmenter()
-    return segmenter(audio_file, start_sec=startMilliSeconds / 1000)
+    if args.segmenter == 'fast':
+        # one pass over the whole recording, which is also the reference
+        return stitch_segments([(startMilliSeconds / 1000, float('inf'),
+                                 classify_segments(audio))])
+    if isinstance(audio, PcmStore):
+        windows = split_into_windows(startMilliSeconds / 1000,
+                                     audio.end_ms / 1000,
+                                     segment_window_sec, segment_overlap_sec)
+        pool = get_segmenter_pool() if len(windows) > 1 else None
+        if pool:
+            logging.info('    Segmenting %d windows in parallel',
+                         len(windows))
+            # the same noEnergy threshold as one pass over the recording
+            reference = SegmenterEnergy().add(audio.file,
+                                              startMilliSeconds).mean()
+            futures = [pool.submit(segment_window, audio.file,
+                                   round(start * 1000), round(end * 1000),
+                                   'cnn', reference)
+                       for (start, end, _, _) in windows]
+            return stitch_segments([
+                (owned_start, owned_end, future.result())
+                for ((_, _, owned_start, owned_end), future) in
+                zip(windows, futures)])
+        return segment_file(audio.file, startMilliSeconds)
+    return get_segmenter()(audio_file, start_sec=startMilliSeconds / 1000)
 
 
-def call_songrec(filename, attempt):
+class RunMetrics:
+    """
+    Wall time, CPU time and peak memory of the stages of a run, plus
+    counters like the number of calls to the recognizer
+    """
+
+    def __init__(self):
+        self.started = time()
+        self.per_stage_peak = self._reset_peak()
+        self.peak_rss_mb = 0
+        self.start_usage = self._usage()
+        self.stages = []
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _reset_peak():
+        """
+        Reset the peak memory of the process to its current memory, so that
+        the next reading is the peak since now. Returns False if the kernel
+        doesn't support that.
+        """
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def _peak_rss_mb():
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+        # ru_maxrss is in KB
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def _usage(self):
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {'wall_s': time(),
+                'cpu_s': own.ru_utime + own.ru_stime,
+                'children_cpu_s': children.ru_utime + children.ru_stime}
+
+    @staticmethod
+    def _difference(start, end):
+        return {key: round(end[key] - start[key], 3) for key in end}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.per_stage_peak:
+            self._reset_peak()
+        start = self._usage()
+        try:
+            yield
+        finally:
+            stage = {'stage': name}
+            stage.update(self._difference(start, self._usage()))
+            peak = self._peak_rss_mb()
+            # Without resetting the peak it's the peak of the process so far
+            stage['peak_rss_mb' if self.per_stage_peak
+                  else 'process_peak_rss_mb'] = round(peak, 1)
+            with self.lock:
+                self.peak_rss_mb = max(self.peak_rss_mb, peak)
+                self.stages.append(stage)
+
+    def add(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = round(
+                self.counters.get(counter, 0) + value, 3)
+
+    def report(self, **extra):
+        report = {'started': datetime.datetime.fromtimestamp(
+            self.started).isoformat(timespec='seconds')}
+        report.update(extra)
+        report['total'] = self._difference(self.start_usage, self._usage())
+        # ru_maxrss is in KB; for the children it's the largest child
+        report['total'].update(
+            peak_rss_mb=round(max(self.peak_rss_mb,
+                                  self._peak_rss_mb()), 1),
+            children_peak_rss_mb=round(resource.getrusage(
+                resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1))
+        report['stages'] = self.stages
+        report['counters'] = self.counters
+        return report
+
+    def write(self, filename, **extra):
+        """
+        Append the report as one line to filename and log a summary
+        """
+        report = self.report(**extra)
+        for stage in self.stages + [dict(report['total'], stage='total')]:
+            logging.info('    %-10s %8.1f s wall %8.1f s CPU (+%.1f s '
+                         'children) %6.0f MB peak', stage['stage'],
+                         stage['wall_s'], stage['cpu_s'],
+                         stage['children_cpu_s'],
+                         stage.get('peak_rss_mb',
+                                   stage.get('process_peak_rss_mb')))
+        with open(filename, 'a') as f:
+            f.write(json.dumps(report) + '\n')
+
+
+metrics = RunMetrics()
+
+
+def call_songrec(filename, attempt, pass_fds=()):
     max_attempts = 3
     if attempt > max_attempts:
         # No success in 3 attempts - give up
@@ -79,87 +1012,355 @@ def call_songrec(filename, attempt):
     if attempt > 0:
         # Waiting for 25s seems to work
         logging.info(f'        Retry again in 25 s ({attempt}. attempt)')
+        metrics.add('recognizer_retry_wait_s', 25)
         sleep(25)
 
+    metrics.add('recognizer_calls')
     out = subprocess.Popen(['songrec', 'audio-file-to-recognized-song',
-                            filename], stdout=subprocess.PIPE, text=True)
+                            filename], stdout=subprocess.PIPE, text=True,
+                           pass_fds=pass_fds)
     (line, _) = out.communicate()
     if not line or out.returncode != 0:
         if out.returncode != 0:
-            return call_songrec(filename, attempt + 1)
+            return call_songrec(filename, attempt + 1, pass_fds)
         return ''
     return line
 
 
-def check_segment_for_intro(audio, start_ms, end_ms, timestamp_ns,
-                            retry_ns, debug_suffix):
-    filename = os.path.join(tempfile.gettempdir(), "segment.mp3")
+class RateLimit:
+    """
+    Shared budget for calls to the recognizer. Shazam tells us in retryms
+    how long we have to wait before the next request.
+    """
+
+    def __init__(self):
+        self.next_call_ns = 0
+
+    def wait(self):
+        time_now_ns = time_ns()
+        if time_now_ns < self.next_call_ns:
+            # Make sure that we don't try before the retry_ns that
+            # the previous call to songrec returned from shazam
+            to_wait_s = (self.next_call_ns - time_now_ns) / 1000000000
+            logging.info('        Waiting %f s', to_wait_s)
+            metrics.add('rate_limit_wait_s', to_wait_s)
+            sleep(to_wait_s)
+
+    def update(self, data):
+        retry_ms = secure_lookup(data, 'retryms')
+        if retry_ms:
+            self.next_call_ns = time_ns() + retry_ms * 1000000
+
+
+class RecognitionCache:
+    """
+    Persistent cache of the recognizer results, keyed by the recognizer and
+    the hash of the audio. Entries older than max_age_days are dropped, and
+    the oldest entries are dropped when the cache grows beyond max_size_mb.
+    """
+
+    def __init__(self, filename, max_age_days=90, max_size_mb=20):
+        self.db = sqlite3.connect(filename)
+        self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT '
+                        'PRIMARY KEY, value TEXT, created REAL)')
+        self.max_age_days = max_age_days
+        self.max_size_mb = max_size_mb
+        self.evict()
+
+    def get(self, key):
+        row = self.db.execute('SELECT value FROM results WHERE key = ?',
+                              (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, value):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                            (key, value, time()))
+
+    def evict(self):
+        with self.db:
+            self.db.execute('DELETE FROM results WHERE created < ?',
+                            (time() - self.max_age_days * 24 * 3600,))
+            (size,) = self.db.execute(
+                'SELECT TOTAL(LENGTH(key) + LENGTH(value)) FROM results'
+            ).fetchone()
+            max_size = self.max_size_mb * 1024 * 1024
+            for (key, length) in self.db.execute(
+                    'SELECT key, LENGTH(key) + LENGTH(value) FROM results '
+                    'ORDER BY created').fetchall():
+                if size <= max_size:
+                    break
+                self.db.execute('DELETE FROM results WHERE key = ?', (key,))
+                size -= length
+
+
+def open_recognition_cache(config):
+    directory = config['Cache']['Directory']
+    if not directory:
+        return None
+    try:
+        os.makedirs(directory, exist_ok=True)
+        return RecognitionCache(os.path.join(directory, 'recognition.db'),
+                                float(config['Cache']['MaxAge']),
+                                float(config['Cache']['MaxSize']))
+    except (OSError, sqlite3.Error) as e:
+        logging.warning('Can\'t open recognition cache: %s', e)
+        return None
+
+
+class SongrecRecognizer:
+    """
+    Recognizes candidates with songrec (Shazam), respecting the rate limit.
+    Results are looked up in and added to the cache, and kept in memory so
+    that searching again (e.g. in live mode) doesn't ask songrec twice.
+    """
+    name = 'songrec'
+
+    def __init__(self, cache=None):
+        self.rate_limit = RateLimit()
+        self.cache = cache
+        self.results = {}
+
+    def recognize(self, prepared):
+        """
+        Return the JSON output of songrec for the prepared candidate, or ''
+        """
+        (filename, fd, digest) = prepared
+        key = f'{self.name}:{digest}'
+        if key in self.results:
+            return self.results[key]
+        if self.cache:
+            line = self.cache.get(key)
+            if line:
+                logging.info('        Using cached result')
+                metrics.add('recognizer_cache_hits')
+                return line
+        self.rate_limit.wait()
+        line = call_songrec(filename, 0, () if fd is None else (fd,))
+        if not line:
+            return ''
+        self.rate_limit.update(json.loads(line))
+        self.results[key] = line
+        if self.cache:
+            self.cache.put(key, line)
+        return line
+
+
+def is_intro(data):
+    # Jaykar: Dior
+    intro_subtitle = 'Jaykar'
+    intro_title = 'Dior'
+    return secure_lookup(data, 'track', 'subtitle') == intro_subtitle and \
+        secure_lookup(data, 'track', 'title') == intro_title
+
+
+def prepare_candidate(audio, start_ms, end_ms, debug_suffix):
+    """
+    Write the candidate audio[start_ms:end_ms] as WAV for songrec. Unless
+    we're debugging the file is kept in memory (memfd). Returns the tuple
+    (filename, fd, digest) where fd is the file descriptor that songrec has
+    to inherit, or None, and digest is the hash of the samples.
+    """
+    segment = audio[start_ms:end_ms]
+    if isinstance(segment, StreamedAudio):
+        segment = segment.to_audio_segment()
+    digest = hashlib.sha256(segment.raw_data)
+    digest.update(f'{segment.frame_rate}/{segment.channels}'.encode())
+    digest = digest.hexdigest()
     if debug:
-        filename = os.path.join(
-            tempfile.gettempdir(), f'segment{debug_suffix}.mp3')
-    with open(filename, "wb") as f:
-        audio[start_ms:end_ms].export(f, format="mp3")
-    time_now_ns = time_ns()
-    if time_now_ns < timestamp_ns + retry_ns:
-        # Make sure that we don't try before the retry_ns that
-        # the previous call to songrec returned from shazam
-        to_wait_s = (timestamp_ns + retry_ns - time_now_ns) / 1000000000
-        logging.info('        Waiting %f s', to_wait_s)
-        sleep(to_wait_s)
-    line = call_songrec(filename, 0)
+        filename = os.path.join(get_work_dir(), f'segment{debug_suffix}.wav')
+        with open(filename, 'wb') as f:
+            segment.export(f, format='wav')
+        return (filename, None, digest)
+    if not hasattr(os, 'memfd_create'):
+        # every candidate needs its own file since they're prepared
+        # concurrently
+        with tempfile.NamedTemporaryFile(dir=get_work_dir(), suffix='.wav',
+                                         prefix='segment',
+                                         delete=False) as f:
+            segment.export(f, format='wav')
+        return (f.name, None, digest)
+    fd = os.memfd_create(f'segment{debug_suffix}')
+    with os.fdopen(fd, 'wb', closefd=False) as f:
+        segment.export(f, format='wav')
+    return (f'/proc/self/fd/{fd}', fd, digest)
+
+
+def release_candidate(prepared):
+    (filename, fd, _) = prepared
+    if fd is not None:
+        os.close(fd)
+    elif not debug and os.path.exists(filename):
+        os.remove(filename)
+
+
+def check_segment_for_intro(prepared, recognizer, debug_suffix):
+    """
+    Ask the recognizer whether the prepared candidate is the intro
+    """
+    line = recognizer.recognize(prepared)
     if not line:
         logging.warning(f'No output from songrec for segment {debug_suffix}')
-        return (False, end_ms, timestamp_ns, retry_ns)
+        return False
     if debug:
-        with open(os.path.join(tempfile.gettempdir(),
+        with open(os.path.join(get_work_dir(),
                                f'songrec{debug_suffix}.json'), 'w') as fo:
             fo.write(line)
-    data = json.loads(line)
+    return is_intro(json.loads(line))
 
-    # Jaykar: Dior
-    intro_subtitle = 'Jaykar'
-    intro_title = 'Dior'
-    if secure_lookup(data, 'track', 'subtitle') == intro_subtitle and secure_lookup(data, 'track', 'title') == intro_title:
-        logging.info(f'Found intro in segment {debug_suffix}')
-        if end_ms - start_ms > intro_length:
-            logging.info('Missed end of intro segment. Re-detecting with '
-                         'shorter silence.')
-            segment_audio = audio[start_ms:end_ms]
-            subsegments = detect_segments(segment_audio, 750,
-                                          seek_step=50)
-            if subsegments[0][1] - subsegments[0][0] > intro_length:
-                logging.info('Still missed end of intro segment. Hard '
-                             'cutting after known intro length.')
-                end_ms = start_ms + intro_length
-            else:
-                end_ms = start_ms + subsegments[0][1]
-        return (True, end_ms, timestamp_ns, retry_ns)
-    retry_ms = secure_lookup(data, 'retryms')
-    if retry_ms:
-        retry_ns = retry_ms * 1000000
-    return (False, end_ms, timestamp_ns, retry_ns)
 
+def probe_candidates(audio, candidates, recognizer, lookahead=3):
+    """
+    Check the candidates (start_ms, end_ms, debug_suffix, message) in order
+    and return the first one that contains the intro, or None.
+
+    While we wait for songrec (and for the rate limit) the next candidates
+    are already prepared in a worker pool. Once the intro is found the
+    outstanding work is cancelled.
+    """
+    candidates = iter(candidates)
+    pending = []
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=lookahead)
+
+    def fill():
+        while len(pending) < lookahead:
+            candidate = next(candidates, None)
+            if candidate is None:
+                return
+            (start_ms, end_ms, debug_suffix, _) = candidate
+            pending.append((candidate, executor.submit(
+                prepare_candidate, audio, start_ms, end_ms, debug_suffix)))
 
-def get_end_of_intro_segment(audio, segments):
-    logging.info('Finding intro segment (in %d segments)', len(segments))
     try:
-        i = -1
-        timestamp_ns = 0
-        retry_ns = 0
-        for segment in segments:
-            if args.end_intro and segment[0] > int(args.end_intro) * 60 * 1000:
-                logging.info('    Intro segment not found in '
-                             f'{args.end_intro} minutes; skipping rest')
-                return -1
-            i = i + 1
-            logging.info(
-                f'    Examining segment {i} ('
-                f'{convert_milliseconds_to_readable(segment[0])} - '
-                f'{convert_milliseconds_to_readable(segment[1])})')
+        fill()
+        while pending:
+            (candidate, future) = pending.pop(0)
+            fill()
+            (_, _, debug_suffix, message) = candidate
+            logging.info(message)
+            prepared = future.result()
+            try:
+                found = check_segment_for_intro(prepared, recognizer,
+                                                debug_suffix)
+            finally:
+                release_candidate(prepared)
+            if found:
+                logging.info(f'Found intro in segment {debug_suffix}')
+                return candidate
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        for (_, future) in pending:
+            if not future.cancelled() and future.exception() is None:
+                release_candidate(future.result())
+    return None
 
-            (found, end_ms, timestamp_ns, retry_ns) = check_segment_for_intro(audio, segment[0], segment[1], timestamp_ns, retry_ns, i)
-            if not found:
-                continue
+
+def _intro_search_end_ms():
+    """
+    Return the end of the --end-intro window in the decoded audio, or None
+    """
+    if not args.end_intro:
+        return None
+    return max(0, int(args.end_intro) * 60 * 1000 - decode_offset_ms)
+
+
+def _candidate_score(start_ms, end_ms, expected_ms):
+    """
+    Lower is better: the distance (in minutes) of the candidate to the
+    expected start of the intro, plus a penalty if its length doesn't fit
+    the intro
+    """
+    distance = max(0, start_ms - expected_ms, expected_ms - end_ms) / 60000
+    length = max(end_ms - start_ms, 1)
+    fit = max(0, math.log2(min_intro_length / length)) + \
+        max(0, math.log2(length / intro_length))
+    return distance + fit
+
+
+def _segments_to_search(segments):
+    end_ms = _intro_search_end_ms()
+    if end_ms and any(segment[0] > end_ms for segment in segments):
+        logging.info('    Only looking for intro segment in the first '
+                     f'{args.end_intro} minutes')
+        return [segment for segment in segments if segment[0] <= end_ms]
+    return segments
+
+
+def _segment_candidates(segments, expected_ms=0):
+    """
+    Return the segments as candidates, the most likely ones first: closest
+    to expected_ms and with a length that fits the intro. Without
+    expected_ms this is not chronological, segments that are too short or
+    too long for the intro come later.
+    """
+    candidates = [
+        (segment[0], segment[1], i,
+         f'    Examining segment {i} ('
+         f'{convert_milliseconds_to_readable(segment[0])} - '
+         f'{convert_milliseconds_to_readable(segment[1])})')
+        for (i, segment) in enumerate(_segments_to_search(segments))]
+    return sorted(candidates, key=lambda candidate: _candidate_score(
+        candidate[0], candidate[1], expected_ms))
+
+
+def _slot_candidates(segments, slot_len, expected_ms=0):
+    """
+    Return the slots of slot_len in the segments as candidates, coarse to
+    fine: first every coarse_slot_step-th slot of every segment, then the
+    slots next to the best coarse slots (the ones within a minute of the
+    slot closest to expected_ms) and finally all other slots. Within each
+    pass the slots closest to expected_ms come first (without expected_ms
+    that's chronological). Of slots that are as close, the ones in segments
+    that are too long for the intro come first: the intro might be hidden
+    in them because no silence separates it from what follows.
+    """
+    slots = []
+    for (i, segment) in enumerate(_segments_to_search(segments)):
+        hidden = segment[1] - segment[0] > intro_length
+        for (k, j) in enumerate(range(segment[0], segment[1], slot_len)):
+            slots.append((i, k, _candidate_score(j, j + slot_len, expected_ms),
+                          not hidden,
+                          (j, j + slot_len, f'{i}-{j}',
+                           f'    Examining {int(slot_len / 1000)}s slot '
+                           f'starting at '
+                           f'{convert_milliseconds_to_readable(j)} in '
+                           f'segment {i}')))
+    coarse = [slot for slot in slots if slot[1] % coarse_slot_step == 0]
+    best_score = min((slot[2] for slot in coarse), default=0)
+    best = {(i, k) for (i, k, score, _, _) in coarse
+            if score <= best_score + 1}
+
+    def rank(slot):
+        (i, k, score, not_hidden, _) = slot
+        if k % coarse_slot_step == 0:
+            step = 0
+        elif (i, k - 1) in best or (i, k + 1) in best:
+            step = 1
+        else:
+            step = 2
+        return (step, score, not_hidden)
+    return [slot[-1] for slot in sorted(slots, key=rank)]
+
+
+def get_end_of_intro_segment(audio, segments, recognizer, expected_ms=0):
+    logging.info('Finding intro segment (in %d segments)', len(segments))
+    try:
+        match = probe_candidates(
+            audio, _segment_candidates(segments, expected_ms), recognizer)
+        if match:
+            (start_ms, end_ms, _, _) = match
+            if end_ms - start_ms > intro_length:
+                logging.info('Missed end of intro segment. Re-detecting with '
+                             'shorter silence.')
+                segment_audio = audio[start_ms:end_ms]
+                subsegments = detect_segments(segment_audio, 750,
+                                              seek_step=50)
+                if subsegments[0][1] - subsegments[0][0] > intro_length:
+                    logging.info('Still missed end of intro segment. Hard '
+                                 'cutting after known intro length.')
+                    end_ms = start_ms + intro_length
+                else:
+                    end_ms = start_ms + subsegments[0][1]
             return end_ms
     except Exception as e:
         logging.warning('Got exception trying to find intro segment: %s', e)
@@ -168,40 +1369,26 @@ def get_end_of_intro_segment(audio, segments):
     return -1
 
 
-def get_end_of_intro_segment_in_slots(audio, segments):
+def get_end_of_intro_segment_in_slots(audio, segments, recognizer,
+                                      expected_ms=0):
     slot_len = 20000  # 20s
     logging.info('Finding intro segment in slots (in %d segments)',
                  len(segments))
     try:
-        i = -1
-        timestamp_ns = 0
-        retry_ns = 0
-        found = False
-        for segment in segments:
-            if args.end_intro and segment[0] > int(args.end_intro) * 60 * 1000:
-                logging.info(
-                    f'    Intro segment not found in {args.end_intro} '
-                    'minutes; skipping rest')
-                return -1
-            i = i + 1
-            for j in range(segment[0], segment[1], slot_len):
-                logging.info(
-                    f'    Examining {int(slot_len / 1000)}s slot starting at '
-                    f'{convert_milliseconds_to_readable(j)} in segment {i}')
-
-                (found, end_ms, timestamp_ns, retry_ns) = check_segment_for_intro(
-                    audio, j, j + slot_len, timestamp_ns, retry_ns, f'{i}-{j}')
-                if not found:
-                    continue
-                # Now we know a segment that contains the intro, but we still
-                # don't know the end of the intro. Try and find that now.
-                logging.info('Found intro segment. Now looking for end of intro.')
-                segment_end = j + slot_len
-                segment_audio = audio[segment_end:segment_end + intro_length]
-                subsegments = detect_segments(segment_audio, 250)
-                end_ms = end_ms + subsegments[0][1]
-                logging.info(f'    Calculated end of intro at {convert_milliseconds_to_readable(end_ms)}')
-                return end_ms
+        match = probe_candidates(
+            audio, _slot_candidates(segments, slot_len, expected_ms),
+            recognizer)
+        if match:
+            # Now we know a segment that contains the intro, but we still
+            # don't know the end of the intro. Try and find that now.
+            (_, end_ms, _, _) = match
+            logging.info('Found intro segment. Now looking for end of intro.')
+            segment_audio = audio[end_ms:end_ms + intro_length]
+            subsegments = detect_segments(segment_audio, 250)
+            end_ms = end_ms + subsegments[0][1]
+            logging.info('    Calculated end of intro at %s',
+                         convert_milliseconds_to_readable(end_ms))
+            return end_ms
     except Exception as e:
         logging.warning('Got exception trying to find intro segment: %s', e)
 
@@ -209,28 +1396,514 @@ def get_end_of_intro_segment_in_slots(audio, segments):
     return -1
 
 
-def find_start_after_intro(audio, start_in_audio_ms, silence_len=1000):
+def compute_envelope(samples, frame_rate, hop_ms=envelope_hop_ms):
+    """
+    Return the loudness envelope (in dB) of samples, one value per hop_ms
+    """
+    hop = int(frame_rate * hop_ms / 1000)
+    frames = len(samples) // hop
+    envelope = np.empty(frames, dtype=np.float64)
+    # Work on blocks of ~10s so that we don't need a float copy of the
+    # entire recording
+    block = hop * max(1, 10000 // hop_ms)
+    for pos in range(0, frames * hop, block):
+        chunk = samples[pos:min(pos + block, frames * hop)]
+        chunk = chunk.astype(np.float32).reshape(-1, hop * samples.shape[1])
+        power = np.mean(np.square(chunk), axis=1)
+        envelope[pos // hop:pos // hop + len(power)] = 10 * np.log10(
+            power + 1e-10)
+    return envelope
+
+
+def make_intro_fingerprint(reference_audio, refine_ms=2000):
+    """
+    Create the fingerprint of the intro from the reference clip. The
+    fingerprint consists of the loudness envelope of the clip which is used
+    to find the approximate position, and the mono samples at the beginning
+    of the clip which are used to refine the position sample-accurately.
+    """
+    samples = audio_to_samples(reference_audio)
+    head_len = int(reference_audio.frame_rate * refine_ms / 1000)
+    return {
+        'envelope': compute_envelope(samples, reference_audio.frame_rate),
+        'head': samples[:head_len].mean(axis=1, dtype=np.float32),
+        'frame_rate': reference_audio.frame_rate,
+        'length': len(samples),
+    }
+
+
+def load_intro_fingerprint(reference_file, frame_rate):
+    """
+    Load the fingerprint of the intro for the given frame_rate, creating
+    (and caching next to the reference clip) it if necessary
+    """
+    cache_file = f'{os.path.splitext(reference_file)[0]}-{frame_rate}.npz'
+    if os.path.exists(cache_file) and \
+            os.path.getmtime(cache_file) >= os.path.getmtime(reference_file):
+        with np.load(cache_file) as data:
+            return {key: data[key] for key in data.files}
+    logging.info('Creating intro fingerprint from %s', reference_file)
+    from pydub import AudioSegment
+    reference_audio = AudioSegment.from_file(reference_file).set_frame_rate(
+        frame_rate)
+    fingerprint = make_intro_fingerprint(reference_audio)
+    try:
+        np.savez(cache_file, **fingerprint)
+    except OSError as e:
+        logging.warning('Can\'t cache intro fingerprint: %s', e)
+    return fingerprint
+
+
+def _cross_correlate(signal, reference):
+    """
+    Return the normalized cross-correlation of reference at every position
+    in signal
+    """
+    n = len(signal)
+    m = len(reference)
+    if n < m or m == 0:
+        return np.zeros(0)
+    reference = reference - reference.mean()
+    reference_norm = np.sqrt(np.sum(np.square(reference)))
+    size = 1 << int(n + m - 1).bit_length()
+    corr = np.fft.irfft(np.fft.rfft(signal, size) *
+                        np.conj(np.fft.rfft(reference, size)), size)[:n - m + 1]
+    # local mean and energy of signal under the reference
+    cumsum = np.concatenate(([0], np.cumsum(signal, dtype=np.float64)))
+    cumsum2 = np.concatenate(([0], np.cumsum(np.square(signal,
+                                                       dtype=np.float64))))
+    local_sum = cumsum[m:] - cumsum[:-m]
+    local_energy = cumsum2[m:] - cumsum2[:-m] - np.square(local_sum) / m
+    denominator = np.sqrt(np.maximum(local_energy, 0)) * reference_norm
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator > 0, corr / denominator, 0)
+
+
+def find_intro_offline(audio, fingerprint, threshold=0.6):
+    """
+    Find the intro in audio by cross-correlating with the fingerprint.
+    Returns the tuple (start, end) of the intro in samples, or None if
+    the intro can't be found.
+    """
+    frame_rate = audio.frame_rate
+    hop = int(frame_rate * envelope_hop_ms / 1000)
+    if isinstance(audio, StreamedAudio):
+        # chunks have to be multiples of the hop size
+        envelope = np.concatenate(
+            [compute_envelope(chunk, frame_rate) for chunk in
+             audio.iter_chunks(chunk_frames // hop * hop)] + [np.zeros(0)])
+    else:
+        samples = audio_to_samples(audio)
+        envelope = compute_envelope(samples, frame_rate)
+    scores = _cross_correlate(envelope, fingerprint['envelope'])
+    if len(scores) == 0:
+        return None
+    best = int(np.argmax(scores))
+    logging.info('    Best intro match at %s (score %.2f)',
+                 convert_milliseconds_to_readable(best * envelope_hop_ms),
+                 scores[best])
+    if scores[best] < threshold:
+        return None
+
+    # Refine the position within +/- 2 envelope frames on the samples
+    start = best * hop
+    head = fingerprint['head']
+    if np.sqrt(np.mean(np.square(head))) > 1:
+        window_start = max(0, start - 2 * hop)
+        window_end = start + 2 * hop + len(head)
+        if isinstance(audio, StreamedAudio):
+            window = audio.read_frames(window_start, window_end)
+        else:
+            window = samples[window_start:window_end]
+        window = window.mean(axis=1, dtype=np.float32)
+        fine_scores = _cross_correlate(window, head)
+        if len(fine_scores):
+            start = window_start + int(np.argmax(fine_scores))
+    return (start, start + int(fingerprint['length']))
+
+
+def get_end_of_intro_offline(audio, reference_file, threshold):
+    logging.info('Finding intro with offline matcher')
+    try:
+        fingerprint = load_intro_fingerprint(reference_file, audio.frame_rate)
+        if args.end_intro:
+            # the intro has to start within the first end_intro minutes
+            intro_ms = 1000 * int(fingerprint['length']) // audio.frame_rate
+            audio = audio[:_intro_search_end_ms() + intro_ms]
+        match = find_intro_offline(audio, fingerprint, threshold)
+        if match:
+            (start, end) = match
+            start_ms = start * 1000 / audio.frame_rate
+            end_ms = end * 1000 / audio.frame_rate
+            logging.info(
+                f'Found intro at {convert_milliseconds_to_readable(start_ms)}'
+                f' - {convert_milliseconds_to_readable(end_ms)}')
+            return end_ms
+    except Exception as e:
+        logging.warning('Got exception trying to match intro: %s', e)
+
+    logging.info('Offline matcher did not find intro')
+    return -1
+
+
+def _iter_fingerprint_samples(audio, window_ms=600000):
+    """
+    Yield the samples of audio as 16 kHz mono float blocks
+    """
+    if isinstance(audio, PcmStore):
+        for pos in range(round(audio.start_ms), round(audio.end_ms),
+                         window_ms):
+            yield audio.segmenter_samples(pos, min(pos + window_ms,
+                                                   round(audio.end_ms)))
+    elif isinstance(audio, StreamedAudio):
+        view = StreamedAudio(audio.file, audio.start_ms, audio.end_ms,
+                             fingerprint_rate)
+        for chunk in view.iter_chunks(chunk_frames):
+            yield chunk.mean(axis=1, dtype=np.float32) / 32768
+    else:
+        for pos in range(0, len(audio), window_ms):
+            part = audio[pos:pos + window_ms].set_channels(1).set_frame_rate(
+                fingerprint_rate)
+            yield audio_to_samples(part)[:, 0].astype(
+                np.float32) / part.max_possible_amplitude
+
+
+def _pick_peaks(power):
+    """
+    Return (frames, bins) of the peaks in the spectrogram power: in every
+    band the loudest bin, if it is louder than in the two frames before and
+    after
+    """
+    level = 10 * np.log10(power + 1e-10)
+    frames = []
+    bins = []
+    for (low, high) in zip(fingerprint_bands[:-1], fingerprint_bands[1:]):
+        band = level[:, low:high]
+        peak = band.max(axis=1)
+        padded = np.pad(peak, 2, constant_values=-np.inf)
+        local = np.lib.stride_tricks.sliding_window_view(padded, 5).max(
+            axis=1)
+        keep = np.flatnonzero((peak >= local) &
+                              (peak > fingerprint_floor_db))
+        frames.append(keep)
+        bins.append(band.argmax(axis=1)[keep] + low)
+    return (np.concatenate(frames), np.concatenate(bins))
+
+
+def spectral_peaks(blocks, batch_frames=2048):
+    """
+    Return (frames, bins) of the spectral peaks of the consecutive blocks of
+    16 kHz mono samples
+    """
+    window = np.hanning(fingerprint_fft).astype(np.float32)
+    rest = np.zeros(0, dtype=np.float32)
+    first = 0
+    frames = [np.zeros(0, dtype=np.int64)]
+    bins = [np.zeros(0, dtype=np.int64)]
+    for block in blocks:
+        samples = np.concatenate([rest, block])
+        count = max(0, (len(samples) - fingerprint_fft) //
+                    fingerprint_hop + 1)
+        windows = np.lib.stride_tricks.sliding_window_view(
+            samples, fingerprint_fft)[::fingerprint_hop][:count]
+        for pos in range(0, count, batch_frames):
+            spectrum = np.fft.rfft(windows[pos:pos + batch_frames] * window,
+                                   axis=1)
+            (peak_frames, peak_bins) = _pick_peaks(
+                spectrum.real ** 2 + spectrum.imag ** 2)
+            frames.append(peak_frames + first + pos)
+            bins.append(peak_bins)
+        first += count
+        rest = samples[count * fingerprint_hop:]
+    return (np.concatenate(frames), np.concatenate(bins))
+
+
+def landmark_hashes(frames, bins):
+    """
+    Pair every peak with the following ones. Returns (hashes, frames): the
+    hash of the frequencies and the distance of the two peaks, and the frame
+    of the first peak.
+    """
+    order = np.lexsort((bins, frames))
+    (frames, bins) = (frames[order], bins[order])
+    hashes = [np.zeros(0, dtype=np.int64)]
+    anchors = [np.zeros(0, dtype=np.int64)]
+    for k in range(1, fingerprint_fan_out + 1):
+        if k >= len(frames):
+            break
+        dt = frames[k:] - frames[:-k]
+        ok = (dt > 0) & (dt <= fingerprint_max_dt)
+        hashes.append((bins[:-k][ok] << 14) | (bins[k:][ok] << 5) | dt[ok])
+        anchors.append(frames[:-k][ok])
+    return (np.concatenate(hashes).astype(np.int64),
+            np.concatenate(anchors).astype(np.int64))
+
+
+class JingleCatalogue:
+    """
+    Inverted index of the fingerprints of the jingles: the landmark hashes
+    of all clips sorted by hash, with the clip and the frame they occur at.
+    Looking up the hashes of a recording takes the same time no matter how
+    many jingles are in the catalogue.
+    """
+    version = 1
+
+    def __init__(self, clips, hashes, ids, frames, lengths):
+        # clips are (file, role) tuples
+        self.clips = clips
+        self.hashes = hashes
+        self.ids = ids
+        self.frames = frames
+        self.lengths = lengths
+
+    @classmethod
+    def build(cls, clips):
+        from pydub import AudioSegment
+        hashes = [np.zeros(0, dtype=np.int64)]
+        ids = [np.zeros(0, dtype=np.int64)]
+        frames = [np.zeros(0, dtype=np.int64)]
+        lengths = []
+        for (i, (file, _)) in enumerate(clips):
+            logging.info('Creating jingle fingerprint from %s', file)
+            audio = AudioSegment.from_file(file)
+            (clip_hashes, clip_frames) = landmark_hashes(
+                *spectral_peaks(_iter_fingerprint_samples(audio)))
+            hashes.append(clip_hashes)
+            ids.append(np.full(len(clip_hashes), i))
+            frames.append(clip_frames)
+            lengths.append(len(audio) * fingerprint_rate //
+                           (1000 * fingerprint_hop))
+        hashes = np.concatenate(hashes)
+        order = np.argsort(hashes, kind='stable')
+        return cls(clips, hashes[order], np.concatenate(ids)[order],
+                   np.concatenate(frames)[order], np.array(lengths))
+
+    @classmethod
+    def key(cls, clips):
+        return hashlib.sha256(json.dumps(
+            [cls.version] + [(file, role, os.path.getmtime(file))
+                             for (file, role) in clips]).encode()).hexdigest()
+
+    @classmethod
+    def load(cls, clips, cache_file=None):
+        """
+        Load the catalogue from cache_file, or build it (and store it there)
+        if the clips changed
+        """
+        key = cls.key(clips)
+        if cache_file and os.path.exists(cache_file):
+            with np.load(cache_file) as data:
+                if str(data['key']) == key:
+                    return cls(clips, data['hashes'], data['ids'],
+                               data['frames'], data['lengths'])
+        catalogue = cls.build(clips)
+        if cache_file:
+            try:
+                np.savez(cache_file, key=key, hashes=catalogue.hashes,
+                         ids=catalogue.ids, frames=catalogue.frames,
+                         lengths=catalogue.lengths)
+            except OSError as e:
+                logging.warning('Can\'t cache jingle catalogue: %s', e)
+        return catalogue
+
+    def find(self, audio, min_matches=15):
+        """
+        Find all occurrences of the jingles in audio in one pass. Returns a
+        list of dicts with file, role, start_ms, end_ms and the number of
+        matching hashes (votes), ordered by start.
+        """
+        (hashes, frames) = landmark_hashes(
+            *spectral_peaks(_iter_fingerprint_samples(audio)))
+        left = np.searchsorted(self.hashes, hashes, 'left')
+        counts = np.searchsorted(self.hashes, hashes, 'right') - left
+        found = np.flatnonzero(counts)
+        counts = counts[found]
+        # index of every (recording hash, catalogue hash) pair
+        starts = np.repeat(left[found] - np.cumsum(counts) + counts, counts)
+        entries = starts + np.arange(counts.sum())
+        offsets = np.repeat(frames[found], counts) - self.frames[entries]
+        ids = self.ids[entries]
+        valid = offsets >= 0
+        (keys, counts) = np.unique(ids[valid] << 32 | offsets[valid],
+                                   return_counts=True)
+        if not len(keys):
+            return []
+        # allow the offset to be off by one frame
+        votes = counts.copy()
+        for neighbour in (keys - 1, keys + 1):
+            pos = np.minimum(np.searchsorted(keys, neighbour), len(keys) - 1)
+            votes += np.where(keys[pos] == neighbour, counts[pos], 0)
+        matches = []
+        for i in np.argsort(-votes, kind='stable'):
+            if votes[i] < min_matches:
+                break
+            (clip, offset) = (int(keys[i] >> 32), int(keys[i] & 0xffffffff))
+            length = int(self.lengths[clip])
+            if any(match['id'] == clip and
+                   abs(match['offset'] - offset) < length
+                   for match in matches):
+                continue
+            matches.append({'id': clip, 'offset': offset,
+                            'votes': int(votes[i])})
+        frame_ms = 1000 * fingerprint_hop / fingerprint_rate
+        result = []
+        for match in sorted(matches, key=lambda match: match['offset']):
+            (file, role) = self.clips[match['id']]
+            start_ms = match['offset'] * frame_ms
+            length_ms = int(self.lengths[match['id']]) * frame_ms
+            result.append({
+                'file': file, 'role': role, 'start_ms': start_ms,
+                'end_ms': start_ms + length_ms, 'votes': match['votes']})
+            logging.info('    Found %s jingle %s at %s (%d matches)', role,
+                         os.path.basename(file),
+                         convert_milliseconds_to_readable(start_ms),
+                         match['votes'])
+        return result
+
+
+def get_jingle_clips(config):
+    """
+    Return the clips in Jingles/Intro and Jingles/Outro as (file, role)
+    tuples, skipping the ones that don't exist
+    """
+    clips = []
+    for role in ['intro', 'outro']:
+        for file in config['Jingles'][role.capitalize()].split(','):
+            if not file.strip():
+                continue
+            if not os.path.exists(file.strip()):
+                logging.warning('Jingle %s not found', file.strip())
+                continue
+            clips.append((file.strip(), role))
+    return clips
+
+
+def load_jingle_catalogue(config, clips):
+    """
+    Return the JingleCatalogue of the clips, or None if there are none
+    """
+    if not clips:
+        return None
+    directory = config['Cache']['Directory']
+    cache_file = None
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        cache_file = os.path.join(directory, 'jingles.npz')
+    try:
+        return JingleCatalogue.load(clips, cache_file)
+    except Exception as e:
+        logging.warning('Got exception loading jingle catalogue: %s', e)
+        return None
+
+
+def find_jingles(audio, clips, before_ms=None):
+    """
+    Return the jingles of the clips that occur in audio (and start before
+    before_ms)
+    """
+    catalogue = load_jingle_catalogue(config, clips)
+    if not catalogue:
+        return []
+    logging.info('Looking for jingles')
+    if before_ms is not None:
+        longest_ms = int(catalogue.lengths.max()) * 1000 * \
+            fingerprint_hop / fingerprint_rate
+        audio = audio[:round(before_ms + longest_ms)]
+    return [jingle for jingle in
+            catalogue.find(audio, int(config['Jingles']['MinMatches']))
+            if before_ms is None or jingle['start_ms'] < before_ms]
+
+
+def _jingle_params(clips):
+    """
+    Return the checkpoint parameters of the jingles found in the decoded
+    audio
+    """
+    return {'catalogue': JingleCatalogue.key(clips),
+            'min_matches': config['Jingles']['MinMatches'],
+            'decode_offset_ms': decode_offset_ms}
+
+
+def get_end_of_intro_jingle(jingles, expected_ms=0):
+    """
+    Return the end of the intro jingle closest to expected_ms (within the
+    --end-intro window), or -1
+    """
+    end_ms = _intro_search_end_ms()
+    intros = [jingle for jingle in jingles if jingle['role'] == 'intro' and
+              (end_ms is None or jingle['start_ms'] <= end_ms)]
+    if not intros:
+        return -1
+    intro = min(intros, key=lambda jingle: _candidate_score(
+        jingle['start_ms'], jingle['end_ms'], expected_ms))
+    logging.info('Intro jingle ends at %s',
+                 convert_milliseconds_to_readable(intro['end_ms']))
+    return intro['end_ms']
+
+
+def get_start_of_outro(jingles, start_ms):
+    """
+    Return the start of the first outro jingle after start_ms, or None
+    """
+    outros = [jingle['start_ms'] for jingle in jingles
+              if jingle['role'] == 'outro' and jingle['start_ms'] > start_ms]
+    return min(outros, default=None)
+
+
+def trim_segments(segments, end_ms):
+    """
+    Return the segments (kind, start, stop in seconds) that end before
+    end_ms, shortening the one that spans it
+    """
+    end = end_ms / 1000
+    return [(kind, start, min(stop, end))
+            for (kind, start, stop) in segments if start < end]
+
+
+def find_start_after_intro(audio, start_in_audio_ms, silence_len=1000,
+                           search_ms=None, jingles=(), recognizer=None):
     if args.no_intro_detection:
         return start_in_audio_ms if args.use_start_time else 0
 
-    introSegments = detect_segments(audio[:len(audio)/2], silence_len)
-    end_of_intro_ms = get_end_of_intro_segment(audio, introSegments)
+    end_of_intro_ms = get_end_of_intro_jingle(jingles, start_in_audio_ms)
+    if end_of_intro_ms >= 0:
+        return end_of_intro_ms
+
+    reference_file = config['Intro']['Reference']
+    if reference_file:
+        end_of_intro_ms = get_end_of_intro_offline(
+            audio, reference_file, float(config['Intro']['Threshold']))
+        if end_of_intro_ms >= 0:
+            return end_of_intro_ms
+
+    if search_ms is None and args.end_intro:
+        # Only decode the window the intro can be in
+        search_ms = min(_intro_search_end_ms() + intro_length, len(audio))
+    if search_ms is None:
+        search_ms = len(audio) / 2
+    introSegments = detect_segments(audio[:search_ms], silence_len)
+    if recognizer is None:
+        recognizer = SongrecRecognizer(open_recognition_cache(config))
+    # Probe the candidates close to where we expect the intro first
+    end_of_intro_ms = get_end_of_intro_segment(audio, introSegments,
+                                               recognizer, start_in_audio_ms)
     if end_of_intro_ms >= 0:
         return end_of_intro_ms
     # We didn't find an intro segment in the regular segments. Now try
     # again with 20s long segments
     end_of_intro_ms = get_end_of_intro_segment_in_slots(
-        audio, introSegments)
+        audio, introSegments, recognizer, start_in_audio_ms)
     return end_of_intro_ms if end_of_intro_ms >= 0 else -1
 
 
-def _add_audio(existing, new):
-    return existing + new if existing is not None else new
-
-
-def normalize_segments(audio, segments):
-    logging.info('Normalizing %d segments', len(segments))
-    resultAudio = None
+def plan_normalization(segments):
+    """
+    Group the segments into pieces that get normalized together. Returns a
+    list of (start_ms, stop_ms, normalize) tuples. noEnergy and noise
+    segments are kept as they are, consecutive segments of the same kind
+    get normalized together.
+    """
+    pieces = []
     i = -1
     while i < len(segments) - 1:
         i += 1
@@ -238,7 +1911,7 @@ def normalize_segments(audio, segments):
         start = start * 1000
         stop = stop * 1000
         if kind in ['noEnergy', 'noise']:
-            resultAudio = _add_audio(resultAudio, audio[start:stop])
+            pieces.append((start, stop, False))
             continue
         j = i
         for j in range(i+1, len(segments)):
@@ -259,18 +1932,350 @@ def normalize_segments(audio, segments):
                      convert_milliseconds_to_readable(start),
                      convert_milliseconds_to_readable(nextstop),
                      (nextstop - start) / 1000)
-        audioseg = audio[start:nextstop]
-        normalized = effects.normalize(audioseg)
-        resultAudio = _add_audio(resultAudio, normalized)
+        pieces.append((start, nextstop, True))
         if j >= len(segments) - 1:
             # last segment
             break
         i = j - 1
-    return resultAudio
+    return pieces
+
+
+def _piece_frames(audio, pieces):
+    """
+    Return the (start, end) frames of the pieces in audio, clipped to the
+    end of audio like AudioSegment slicing does
+    """
+    return [(ms_to_frame(min(start, len(audio)), audio.frame_rate),
+             ms_to_frame(min(stop, len(audio)), audio.frame_rate))
+            for (start, stop, _) in pieces]
+
+
+def _peak(samples):
+    # same as audioop.max: the maximum absolute sample value
+    if not len(samples):
+        return 0
+    return max(int(samples.max()), -int(samples.min()))
+
+
+def _normalize_factor(peak, max_possible_amplitude, headroom=0.1):
+    """
+    Return the factor to apply to get a peak of peak to the target peak
+    (the same calculation as pydub.effects.normalize)
+    """
+    from pydub.utils import db_to_float, ratio_to_db
+    if peak == 0:
+        return None
+    target_peak = max_possible_amplitude * db_to_float(-headroom)
+    return db_to_float(float(ratio_to_db(target_peak / peak)))
+
+
+def _apply_factor(samples, factor):
+    """
+    Multiply samples by factor with the same rounding and clipping as
+    audioop.mul
+    """
+    info = np.iinfo(samples.dtype)
+    result = samples.astype(np.float64) * factor
+    result = np.where(result > info.max, info.max, result)
+    result = np.where(result < info.min + 1, info.min, result)
+    return np.floor(result).astype(samples.dtype)
+
+
+def compute_gain_table(pieces, peaks, max_possible_amplitude):
+    """
+    Return the factor for every piece, or None if the piece stays unchanged
+    """
+    return [_normalize_factor(peak, max_possible_amplitude)
+            if normalize else None
+            for (peak, (_, _, normalize)) in zip(peaks, pieces)]
+
+
+def normalize_segments(audio, segments):
+    """
+    Normalize the segments of audio. First the gain for every piece is
+    calculated, then the pieces are written with their gain into one
+    preallocated buffer. The result is bit-identical to normalizing every
+    piece with pydub.effects.normalize and concatenating them.
+    """
+    logging.info('Normalizing %d segments', len(segments))
+    pieces = plan_normalization(segments)
+    samples = audio_to_samples(audio)
+    frames = _piece_frames(audio, pieces)
+    peaks = [_peak(samples[start:end]) for (start, end) in frames]
+    factors = compute_gain_table(pieces, peaks, audio.max_possible_amplitude)
 
+    # AudioSegment slicing pads up to 2ms with silence at the end
+    total = sum(max(end - start, 0) for (start, end) in frames)
+    result = np.zeros((total, audio.channels), dtype=samples.dtype)
+    pos = 0
+    for ((start, end), factor) in zip(frames, factors):
+        block = samples[start:end]
+        if factor is not None:
+            block = _apply_factor(block, factor)
+        result[pos:pos + len(block)] = block
+        pos += max(end - start, 0)
+    return audio._spawn(result.tobytes())
 
-def get_info(services, date):
-    service = secure_lookup(services, date.date())
+
+def _iter_pieces(audio, pieces, chunk_frames):
+    """
+    Decode audio in one pass and yield (index, samples) for the pieces
+    (start_ms, stop_ms, ...). A piece can be yielded in several blocks.
+    """
+    if not pieces:
+        return
+    first_ms = min(len(audio), pieces[0][0])
+    view = audio[first_ms:]
+    offset = ms_to_frame(first_ms, audio.frame_rate)
+    ranges = [(start - offset, end - offset)
+              for (start, end) in _piece_frames(audio, pieces)]
+    k = 0
+    pos = 0
+    for chunk in view.iter_chunks(chunk_frames):
+        chunk_end = pos + len(chunk)
+        while k < len(ranges) and ranges[k][0] < chunk_end:
+            (start, stop) = ranges[k]
+            block = chunk[max(start - pos, 0):max(min(stop, chunk_end) - pos, 0)]
+            if len(block):
+                yield (k, block)
+            if stop > chunk_end:
+                break
+            k += 1
+        pos = chunk_end
+
+
+def normalize_segments_streaming(audio, segments, chunk_frames):
+    """
+    Normalize the segments like normalize_segments, but decode audio in
+    chunks: the first pass determines the peak of every piece, the second
+    pass applies the gain. Yields the normalized samples in blocks.
+    """
+    logging.info('Normalizing %d segments (streaming)', len(segments))
+    return normalize_pieces(audio, plan_normalization(segments), chunk_frames)
+
+
+def normalize_pieces(audio, pieces, chunk_frames):
+    """
+    Normalize the pieces of audio in two passes over the audio. Yields the
+    normalized samples in blocks.
+    """
+    peaks = [0] * len(pieces)
+    for (k, block) in _iter_pieces(audio, pieces, chunk_frames):
+        if pieces[k][2]:
+            peaks[k] = max(peaks[k], _peak(block))
+    factors = compute_gain_table(pieces, peaks, audio.max_possible_amplitude)
+    for (k, block) in _iter_pieces(audio, pieces, chunk_frames):
+        yield block if factors[k] is None else _apply_factor(block, factors[k])
+
+
+def _k_weighting(frequencies):
+    """
+    Return the power gain of the K-weighting filter at frequencies (in Hz)
+    """
+    z = np.exp(-2j * np.pi * np.asarray(frequencies, dtype=np.float64) /
+               48000)
+    result = np.ones(len(z))
+    for (b, a) in _k_weighting_filters:
+        result *= np.abs(np.polyval(b[::-1], z) /
+                         np.polyval(a[::-1], z)) ** 2
+    return result
+
+
+def _iter_range_chunks(audio, start_ms, stop_ms, chunk_frames):
+    """
+    Yield the samples of audio from start_ms to stop_ms in blocks of shape
+    (frames, channels)
+    """
+    if isinstance(audio, StreamedAudio):
+        yield from audio[start_ms:stop_ms].iter_chunks(chunk_frames)
+        return
+    samples = audio_to_samples(audio)[
+        ms_to_frame(start_ms, audio.frame_rate):
+        ms_to_frame(stop_ms, audio.frame_rate)]
+    yield from iter_sample_chunks(samples, chunk_frames)
+
+
+def _iter_blocks(chunks, block_frames, channels):
+    """
+    Regroup the blocks of samples in chunks into arrays of shape
+    (blocks, block_frames, channels). The last block is padded with silence.
+    """
+    rest = np.zeros((0, channels))
+    for chunk in chunks:
+        samples = np.concatenate([rest, chunk]) if len(rest) else chunk
+        full = len(samples) // block_frames * block_frames
+        if full:
+            yield samples[:full].reshape(-1, block_frames, channels)
+        rest = samples[full:]
+    if len(rest):
+        padded = np.zeros((block_frames, channels))
+        padded[:len(rest)] = rest
+        yield padded[np.newaxis]
+
+
+def _true_peaks(blocks):
+    """
+    Return the true peak (relative to full scale) of every block of
+    float samples. The peak between two samples is estimated by 4x
+    oversampling with cubic interpolation, which is only done around the
+    samples that come close to the sample peak of their block.
+    """
+    (count, block_frames, channels) = blocks.shape
+    peaks = np.abs(blocks).max(axis=(1, 2))
+    threshold = np.repeat(peaks * 0.7, block_frames)[1:-2]
+    samples = blocks.reshape(-1, channels)
+    for channel in range(channels):
+        v = samples[:, channel]
+        idx = np.flatnonzero(np.abs(v[1:-2]) >= threshold) + 1
+        if not len(idx):
+            continue
+        (p0, p1, p2, p3) = (v[idx - 1], v[idx], v[idx + 1], v[idx + 2])
+        between = np.zeros(len(idx))
+        for t in (0.25, 0.5, 0.75):
+            # Catmull-Rom spline through p0..p3
+            value = 0.5 * (2 * p1 + (p2 - p0) * t +
+                           (2 * p0 - 5 * p1 + 4 * p2 - p3) * t * t +
+                           (3 * (p1 - p2) + p3 - p0) * t * t * t)
+            between = np.maximum(between, np.abs(value))
+        block_of = idx // block_frames
+        starts = np.flatnonzero(np.diff(block_of, prepend=-1))
+        block_of = block_of[starts]
+        peaks[block_of] = np.maximum(
+            peaks[block_of], np.maximum.reduceat(between, starts))
+    return peaks
+
+
+def measure_loudness(chunks, frame_rate, channels, max_possible_amplitude):
+    """
+    Return the K-weighted power (summed over the channels) and the true
+    peak of every 100 ms block of the samples in chunks
+    """
+    block_frames = ms_to_frame(loudness_block_ms, frame_rate)
+    # Parseval on the one-sided spectrum: all bins but DC (and Nyquist)
+    # count twice
+    weights = _k_weighting(np.fft.rfftfreq(block_frames, 1 / frame_rate))
+    weights[1:(block_frames + 1) // 2] *= 2
+    weights /= block_frames * block_frames
+    powers = []
+    peaks = []
+    for blocks in _iter_blocks(chunks, block_frames, channels):
+        # a few blocks at a time keeps the spectra small
+        for pos in range(0, len(blocks), 64):
+            batch = blocks[pos:pos + 64] / max_possible_amplitude
+            spectrum = np.fft.rfft(batch, axis=1)
+            power = spectrum.real ** 2 + spectrum.imag ** 2
+            powers.append(np.einsum('bfc,f->b', power, weights))
+            peaks.append(_true_peaks(batch))
+    if not powers:
+        return (np.zeros(0), np.zeros(0))
+    return (np.concatenate(powers), np.concatenate(peaks))
+
+
+def _block_loudness(power):
+    return -0.691 + 10 * np.log10(np.maximum(power, 1e-20))
+
+
+def integrated_loudness(powers):
+    """
+    Return the gated loudness (LUFS) of the 100 ms block powers, or None
+    for silence. Like BS.1770 it averages 400 ms blocks that overlap by
+    75% and ignores blocks below -70 LUFS or 10 LU below the average.
+    """
+    if len(powers) >= 4:
+        powers = np.convolve(powers, np.ones(4) / 4, mode='valid')
+    powers = powers[_block_loudness(powers) > -70]
+    if not len(powers):
+        return None
+    relative = _block_loudness(powers.mean()) - 10
+    powers = powers[_block_loudness(powers) > relative]
+    return float(_block_loudness(powers.mean()))
+
+
+def _sliding(values, radius, reduce):
+    padded = np.pad(values, radius, mode='edge')
+    return reduce(np.lib.stride_tricks.sliding_window_view(
+        padded, 2 * radius + 1), axis=1)
+
+
+def compute_loudness_gains(pieces, block_ranges, powers, peaks, target,
+                           true_peak):
+    """
+    Return the gain (as factor) for every 100 ms block. Every piece that
+    gets normalized is brought to the target loudness, the others stay
+    unchanged. The gain is lowered where the true peak would exceed
+    true_peak (dBTP) and then smoothed: first the minimum over the
+    neighbouring blocks, then the average, so that the smoothed gain is
+    still below the limit of every block.
+    """
+    gains = np.zeros(len(powers))
+    for ((start_ms, stop_ms, normalize), (start, end)) in zip(pieces,
+                                                               block_ranges):
+        if not normalize:
+            continue
+        loudness = integrated_loudness(powers[start:end])
+        logging.debug('    %s-%s: %s LUFS',
+                      convert_milliseconds_to_readable(start_ms),
+                      convert_milliseconds_to_readable(stop_ms),
+                      'silence' if loudness is None else '%.1f' % loudness)
+        if loudness is not None:
+            gains[start:end] = min(target - loudness, loudness_max_gain_db)
+    limit = true_peak - 20 * np.log10(np.maximum(peaks, 1e-10))
+    gains = np.minimum(gains, limit)
+    if len(gains):
+        # the samples between two block centers get interpolated gains,
+        # so the minimum reaches one block further than the average
+        gains = _sliding(gains, loudness_smoothing + 1, np.min)
+        gains = _sliding(gains, loudness_smoothing, np.mean)
+    return 10 ** (gains / 20)
+
+
+def normalize_loudness(audio, segments, chunk_frames, target=-16.0,
+                       true_peak=-1.0):
+    """
+    Normalize the segments of audio to the target loudness (LUFS) instead
+    of the peak. Yields the normalized samples (16 bit) in blocks.
+    """
+    logging.info('Normalizing %d segments to %s LUFS', len(segments), target)
+    return normalize_pieces_loudness(audio, plan_normalization(segments),
+                                     chunk_frames, target, true_peak)
+
+
+def normalize_pieces_loudness(audio, pieces, chunk_frames, target=-16.0,
+                              true_peak=-1.0):
+    """
+    Normalize the pieces of audio to the target loudness in two passes
+    over the audio: the first measures the loudness and true peak of the
+    100 ms blocks, the second applies the smoothed gains. Yields the
+    normalized samples (16 bit) in blocks.
+    """
+    if not pieces:
+        return
+    if not isinstance(audio, StreamedAudio) and audio.sample_width != 2:
+        audio = audio.set_sample_width(2)
+    start_ms = min(len(audio), pieces[0][0])
+    stop_ms = min(len(audio), pieces[-1][1])
+    offset = ms_to_frame(start_ms, audio.frame_rate)
+    block_frames = ms_to_frame(loudness_block_ms, audio.frame_rate)
+    block_ranges = [((start - offset) // block_frames,
+                     -(-(end - offset) // block_frames))
+                    for (start, end) in _piece_frames(audio, pieces)]
+
+    (powers, peaks) = measure_loudness(
+        _iter_range_chunks(audio, start_ms, stop_ms, chunk_frames),
+        audio.frame_rate, audio.channels, audio.max_possible_amplitude)
+    gains = compute_loudness_gains(pieces, block_ranges, powers, peaks,
+                                   target, true_peak)
+    centers = (np.arange(len(gains)) + 0.5) * block_frames
+    pos = 0
+    for chunk in _iter_range_chunks(audio, start_ms, stop_ms, chunk_frames):
+        factor = np.interp(np.arange(pos, pos + len(chunk)), centers, gains)
+        pos += len(chunk)
+        result = np.rint(chunk * factor[:, np.newaxis])
+        yield np.clip(result, -32768, 32767).astype(np.int16)
+
+
+def get_info(services, date, current=False):
+    service = services.get(date.date(), current) if services else None
     title = secure_lookup(service, 'name', default='Gottesdienst')
     return {'title': title,
             'announce': secure_lookup(service, 'announce', default=title),
@@ -285,26 +2290,82 @@ def get_info(services, date):
             }
 
 
-def export_result(audio, outputdir, info):
-    logging.info('Exporting result')
-    filename = os.path.join(
+def get_result_filename(outputdir, info):
+    return os.path.join(
         outputdir,
         f"{info['isodate']}_{info['title']}_{info['album']}.mp3".replace(
             ' ', '_'
         ),
     )
-    with open(filename, 'wb') as f:
-        metadata = {'title': info['title'], 'track': info['trackno'],
-                    'artist': info['artist'],
-                    'album': info['album'], 'year': info['year'],
-                    'genre': 'Gottesdienst'}
-        audio.export(f, format='mp3', bitrate='128k', tags=metadata,
-                     parameters=['-minrate', '128k', '-maxrate', '128k'])
+
+
+def get_tags(info):
+    return {'title': info['title'], 'track': info['trackno'],
+            'artist': info['artist'],
+            'album': info['album'], 'year': info['year'],
+            'genre': 'Gottesdienst'}
+
+
+def export_result(audio, outputdir, info):
+    """
+    Encode audio to the result mp3 (and the other outputs of
+    export_stream) by piping its samples into ffmpeg
+    """
+    if audio.sample_width != 2:
+        audio = audio.set_sample_width(2)
+    return export_stream(iter_sample_chunks(audio_to_samples(audio),
+                                            chunk_frames),
+                         outputdir, info, audio.frame_rate, audio.channels)
+
+
+def get_renditions(filename):
+    """
+    Return the (file, ffmpeg options) of the additional files configured in
+    the Renditions section. Every key is the suffix that replaces the .mp3
+    of filename, e.g. .flac=-c:a flac
+    """
+    base = os.path.splitext(filename)[0]
+    return [(base + suffix, shlex.split(options))
+            for (suffix, options) in config.items('Renditions')
+            if suffix not in config.defaults()]
+
+
+def export_stream(chunks, outputdir, info, frame_rate, channels):
+    """
+    Encode the blocks of samples in chunks to the result mp3 by piping them
+    into ffmpeg. The same ffmpeg run writes the 8 kHz samples for the
+    telephony versions and the configured renditions.
+    """
+    logging.info('Exporting result (streaming)')
+    filename = get_result_filename(outputdir, info)
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-f', 's16le', '-ar',
+           str(frame_rate), '-ac', str(channels), '-i', '-', '-f', 'mp3',
+           '-b:a', '128k', '-minrate', '128k', '-maxrate', '128k',
+           '-id3v2_version', '4']
+    tags = []
+    for key, value in get_tags(info).items():
+        tags.extend(['-metadata', f'{key}={value}'])
+    cmd.extend(tags + [filename])
+    basename = get_phone_basename(filename)
+    cmd.extend(['-ac', '1', '-ar', str(phone_rate), '-f', 's16le',
+                basename + '.sln'])
+    for (file, options) in get_renditions(filename):
+        logging.info('Also writing %s', file)
+        cmd.extend(tags + options + [file])
+    with subprocess.Popen(cmd, stdin=subprocess.PIPE) as process:
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk.tobytes())
+        finally:
+            process.stdin.close()
+    if process.returncode != 0:
+        raise RuntimeError(f'ffmpeg failed to encode {filename}')
     return filename
 
 
 def read_config():
     tempdir = tempfile.gettempdir()
+    cachedir = os.path.expanduser(os.path.join('~', '.cache', 'autocut'))
     config = configparser.ConfigParser()
     config.read_string("""
     [Paths]
@@ -317,7 +2378,44 @@ def read_config():
     Server=
     PhoneServer=
     Key=
-    """ % (tempdir, tempdir))
+    Retries=5
+    Backoff=10
+    [Processing]
+    MaxMemory=256
+    SegmenterProcesses=0
+    SegmenterMemory=0
+    SeekMargin=5
+    [Normalize]
+    Target=-16
+    TruePeak=-1
+    [Renditions]
+    [Intro]
+    Reference=
+    Threshold=0.6
+    [Jingles]
+    Intro=
+    Outro=
+    MinMatches=20
+    [Cache]
+    Directory=%s
+    MaxAge=90
+    MaxSize=20
+    [Worker]
+    Spool=%s
+    PollInterval=5
+    Concurrency=1
+    [Live]
+    Timeout=30
+    PollInterval=2
+    IntroStep=60
+    [Services]
+    MaxAge=60
+    Timeout=30
+    [Watch]
+    Extensions=mkv,mp4,flv,mov,ts
+    StableTime=10
+    Arguments=--use-start-time
+    """ % (tempdir, tempdir, cachedir, os.path.join(cachedir, 'spool')))
     config.read(os.path.join(os.path.dirname(os.path.realpath(__file__)),
                              'autocut.config'))
     return config
@@ -340,31 +2438,236 @@ def find_input_file(dir):
     return files[-1] if files else ''
 
 
-def convert_video_to_mp3(file):
-    outfile = tempfile.NamedTemporaryFile(suffix='.mp3')
+def _pcm_store_command(file, outfilename, fallback=False, options=(),
+                       start_ms=0):
+    options = list(options)
+    # Seeking on the input only demuxes from the nearest keyframe on
+    seek = ['-ss', '%.3f' % (start_ms / 1000)] if start_ms else []
+    cmd = ['ffmpeg'] + seek + ['-i', file,
+           '-vn', '-ac', '2', '-c:a', 'pcm_s16le'] + options + [
+               '-f', 'wav', outfilename,
+               '-vn', '-ac', '1', '-ar', '16000', '-c:a', 'pcm_s16le'] + \
+        options + ['-f', 'wav', get_segmenter_filename(outfilename)]
+    if fallback:
+        cmd.extend(['-vn'] + options + ['-f', 'mp3',
+                                        get_fallback_filename(outfilename)])
+    return cmd
+
+
+def _new_store_filename():
+    outfile = tempfile.NamedTemporaryFile(suffix='.wav', dir=get_work_dir())
     outfilename = outfile.name
     outfile.close()
-    subprocess.run(['ffmpeg', '-i', file, '-f', 'mp3', outfilename])
     return outfilename
 
 
-def read_services(repo):
-    if not repo:
-        return {}
+def convert_to_pcm_store(file, fallback=False, start_ms=0):
+    """
+    Decode the audio of file (from start_ms on) once into a PCM store: a WAV
+    file with the original sample rate plus a 16 kHz mono WAV file for the
+    segmenter. If fallback is set the same ffmpeg run also encodes the mp3
+    that gets uploaded as fallback.
+    """
+    if start_ms:
+        logging.info('Decoding from %s',
+                     convert_milliseconds_to_readable(start_ms))
+    outfilename = _new_store_filename()
+    # The fallback has to be the complete recording
+    subprocess.run(_pcm_store_command(file, outfilename,
+                                      fallback and not start_ms,
+                                      start_ms=start_ms))
+    return outfilename
+
+
+def get_decode_start_ms(input_file, services, use_start_time):
+    """
+    Return where to start decoding input_file: Processing/SeekMargin minutes
+    before we expect the service to start. The part before that only
+    matters if the intro isn't found after it.
+    """
+    if not use_start_time or not os.path.exists(input_file):
+        return 0
+    date = extract_date_from_filename(input_file)
+    start_ms = get_start_in_audio(input_file, get_info(services, date), date,
+                                  not args.use_start_time)
+    start_ms -= int(config['Processing']['SeekMargin']) * 60 * 1000
+    if args.end_intro:
+        # keep the --end-intro window
+        start_ms = min(start_ms,
+                       int(args.end_intro) * 60 * 1000 - intro_length)
+    return max(0, start_ms)
+
+
+def get_fallback_file(audio_file, input_file=None):
+    """
+    Return the mp3 file to upload as fallback, encoding it from the PCM
+    store if necessary. If the store doesn't start at the beginning of the
+    recording the mp3 is encoded from input_file instead.
+    """
+    if not is_pcm_store(audio_file):
+        return audio_file
+    filename = get_fallback_filename(audio_file)
+    if not os.path.exists(filename):
+        source = input_file if decode_offset_ms and input_file else audio_file
+        subprocess.run(['ffmpeg', '-i', source, '-vn', '-f', 'mp3', filename])
+    return filename
+
+
+def fetch_services(repo, timeout):
+    """
+    Update the clone of the services repo and return the parsed
+    Gottesdienst.yml, or None if that isn't possible
+    """
     logging.info('Getting Gottesdienste metadata')
     scriptDir = os.path.dirname(os.path.realpath(__file__))
     inputDir = 'Gottesdienste'
-    if os.path.exists(inputDir):
-        subprocess.run(['git', 'pull', 'origin'], cwd=os.path.join(scriptDir,
-                                                                   inputDir))
-    else:
-        subprocess.run(['git', 'clone', repo, inputDir], cwd=scriptDir)
+    try:
+        if os.path.exists(os.path.join(scriptDir, inputDir)):
+            subprocess.run(['git', 'pull', 'origin'],
+                           cwd=os.path.join(scriptDir, inputDir),
+                           timeout=timeout)
+        else:
+            subprocess.run(['git', 'clone', repo, inputDir], cwd=scriptDir,
+                           timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logging.warning('Timeout getting Gottesdienste metadata')
     yml_file = os.path.join(scriptDir, inputDir, 'Gottesdienst.yml')
     if not os.path.exists(yml_file):
         logging.warning("Can't find Gottesdienst.yml")
-        return {}
+        return None
+    # The C implementation is much faster if libyaml is available
+    loader = getattr(yaml, 'CFullLoader', yaml.FullLoader)
     with open(yml_file, 'r') as f:
-        return yaml.load(f, Loader=yaml.FullLoader)
+        return yaml.load(f, Loader=loader) or {}
+
+
+class ServicesIndex:
+    """
+    The metadata of the services, indexed by date. The index is stored in
+    Cache/Directory so that processing can start without waiting for git
+    and the YAML parser; refresh() updates it in the background. If the
+    network is down the stored index is used. Processes that refresh at
+    the same time (e.g. in batch mode) wait for the first one instead of
+    updating the same clone.
+    """
+
+    def __init__(self, repo, db_file, max_age, timeout):
+        self.repo = repo
+        self.db_file = db_file
+        self.max_age = max_age
+        self.timeout = timeout
+        self.updated = 0
+        self.services = {}
+        self.lock = threading.Lock()
+        self._refreshed = threading.Event()
+        self._refreshed.set()
+        self._load()
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_file)
+        db.execute('CREATE TABLE IF NOT EXISTS services (date TEXT PRIMARY '
+                   'KEY, value TEXT)')
+        db.execute('CREATE TABLE IF NOT EXISTS updated (time REAL)')
+        return db
+
+    def _load(self):
+        if not self.db_file:
+            return
+        try:
+            db = self._connect()
+            try:
+                services = {date: json.loads(value) for (date, value) in
+                            db.execute('SELECT * FROM services')}
+                (updated,) = db.execute(
+                    'SELECT TOTAL(time) FROM updated').fetchone()
+            finally:
+                db.close()
+            with self.lock:
+                (self.services, self.updated) = (services, updated)
+        except (sqlite3.Error, ValueError) as e:
+            logging.warning('Can\'t read services index: %s', e)
+
+    def _save(self):
+        if not self.db_file:
+            return
+        db = self._connect()
+        try:
+            with db:
+                db.execute('DELETE FROM services')
+                db.executemany('INSERT INTO services VALUES (?, ?)', [
+                    (date, json.dumps(service, default=str))
+                    for (date, service) in self.services.items()])
+                db.execute('DELETE FROM updated')
+                db.execute('INSERT INTO updated VALUES (?)', (self.updated,))
+        finally:
+            db.close()
+
+    def is_fresh(self):
+        return time() - self.updated < self.max_age
+
+    def refresh(self):
+        """
+        Update the index in a background thread unless it's fresh
+        """
+        if not self.repo or self.is_fresh():
+            return
+        self._refreshed.clear()
+        threading.Thread(target=self._refresh, daemon=True).start()
+
+    def _refresh(self):
+        try:
+            with contextlib.ExitStack() as stack:
+                if self.db_file:
+                    # Wait while another process refreshes, then use its
+                    # result
+                    lock_file = stack.enter_context(
+                        open(self.db_file + '.lock', 'w'))
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    self._load()
+                    if self.is_fresh():
+                        return
+                services = fetch_services(self.repo, self.timeout)
+                if services is not None:
+                    with self.lock:
+                        self.services = {str(date): service for
+                                         (date, service) in services.items()}
+                        self.updated = time()
+                    self._save()
+        except Exception as e:
+            logging.warning('Got exception updating services: %s', e)
+        finally:
+            self._refreshed.set()
+
+    def get(self, date, current=False):
+        """
+        Return the metadata of the service on date. If the stored index
+        doesn't know the date yet, or if current is set (for the metadata
+        the result gets named and uploaded with), wait for the refresh.
+        """
+        key = date.isoformat()
+        with self.lock:
+            known = key in self.services
+        if (current or not known) and not self._refreshed.wait(
+                self.timeout):
+            logging.warning('Timeout waiting for Gottesdienste metadata')
+        with self.lock:
+            return self.services.get(key)
+
+
+def read_services(config):
+    """
+    Return the ServicesIndex for Paths/Services and start refreshing it
+    """
+    directory = config['Cache']['Directory']
+    db_file = None
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        db_file = os.path.join(directory, 'services.db')
+    services = ServicesIndex(config['Paths']['Services'], db_file,
+                             float(config['Services']['MaxAge']) * 60,
+                             float(config['Services']['Timeout']))
+    services.refresh()
+    return services
 
 
 def extract_date_from_filename(filename):
@@ -389,7 +2692,7 @@ def extract_date_from_filename(filename):
 
 
 def get_announcement_filename():
-    return os.path.join(tempfile.gettempdir(), "Announce.txt")
+    return os.path.join(get_work_dir(), "Announce.txt")
 
 
 def save_announcement_file(info):
@@ -404,51 +2707,317 @@ def save_announcement_file(info):
     return filename
 
 
-def upload_to_website(config, file, year, msg='Uploading to website'):
-    logging.info(msg)
-    subprocess.run(
-        [
-            'ncftpput',
-            '-m',  # Create remote directory before copying
-            '-u', config['Upload']['User'],
-            '-p', config['Upload']['Password'],
-            config['Upload']['Server'],
-            f'/Predigten/{year}/',
-            file,
-        ]
-    )
+class FtpConnection:
+    """
+    Connection to the FTP server of the website that gets reused for all
+    transfers (and reopened if the server closed it)
+    """
+
+    def __init__(self, server, user, password):
+        self.server = server
+        self.user = user
+        self.password = password
+        self.ftp = None
+        # remote files this connection already sent bytes to
+        self.started = set()
+
+    def _connect(self):
+        if self.ftp:
+            try:
+                self.ftp.voidcmd('NOOP')
+                return self.ftp
+            except (OSError, ftplib.Error):
+                self.close()
+        self.ftp = FTP(self.server, timeout=60)
+        self.ftp.login(self.user, self.password)
+        return self.ftp
+
+    def _cwd(self, directory):
+        ftp = self._connect()
+        try:
+            ftp.cwd(directory)
+        except ftplib.error_perm:
+            # Create remote directory before copying
+            ftp.cwd('/')
+            for part in directory.strip('/').split('/'):
+                try:
+                    ftp.cwd(part)
+                except ftplib.error_perm:
+                    ftp.mkd(part)
+                    ftp.cwd(part)
+        return ftp
+
+    def upload(self, file, directory, attempt=0):
+        """
+        Upload file to directory and return the number of bytes sent. On a
+        retry the upload continues where the previous attempt stopped. A
+        file on the server that we didn't start to write (e.g. from an
+        earlier run) gets overwritten.
+        """
+        ftp = self._cwd(directory)
+        name = os.path.basename(file)
+        remote = (directory, name)
+        ftp.voidcmd('TYPE I')
+        offset = 0
+        if attempt > 0 and remote in self.started:
+            try:
+                offset = ftp.size(name) or 0
+            except ftplib.error_perm:
+                offset = 0
+            if offset > os.path.getsize(file):
+                offset = 0
+            if offset:
+                logging.info('        Resuming upload of %s at %d bytes',
+                             name, offset)
+        with open(file, 'rb') as f:
+            f.seek(offset)
+            ftp.storbinary(f'STOR {name}', f, blocksize=256 * 1024,
+                           callback=lambda _: self.started.add(remote),
+                           rest=offset or None)
+        return os.path.getsize(file) - offset
+
+    def delete(self, file, directory, attempt=0):
+        self._cwd(directory).delete(os.path.basename(file))
+        return 0
+
+    def close(self):
+        if self.ftp:
+            try:
+                self.ftp.quit()
+            except (OSError, ftplib.Error):
+                self.ftp.close()
+            self.ftp = None
+
+
+def get_phone_basename(file):
+    """
+    Return the filename (without extension) for the telephony versions of
+    file
+    """
+    return os.path.join(get_work_dir(), os.path.splitext(
+        os.path.basename(file))[0] + '-8k')
+
+
+def lin2ulaw(samples):
+    """
+    G.711 mu-law encoding of the 16 bit samples (same as audioop.lin2ulaw)
+    """
+    values = samples.astype(np.int32) >> 2
+    mask = np.where(values < 0, 0x7F, 0xFF)
+    values = np.minimum(np.abs(values), 8159) + 0x21
+    seg = np.searchsorted(np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF,
+                                    0xFFF, 0x1FFF]), values)
+    ulaw = np.where(seg >= 8, 0x7F,
+                    (seg << 4) | ((values >> (seg + 1)) & 0x0F))
+    return (ulaw ^ mask).astype(np.uint8)
+
+
+def encode_phone_formats(basename):
+    """
+    Encode the 8 kHz mono samples in basename.sln into the other formats
+    the phone server plays. Returns the list of files.
+    """
+    samples = np.fromfile(basename + '.sln', dtype='<i2')
+    with wave.open(basename + '.wav', 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(phone_rate)
+        f.writeframes(samples.tobytes())
+    lin2ulaw(samples).tofile(basename + '.ulaw')
+    subprocess.run(['sox', '-t', 'raw', '-r', str(phone_rate), '-e', 'signed',
+                    '-b', '16', '-c', '1', basename + '.sln',
+                    basename + '.gsm'], check=True)
+    return [basename + ext for ext in phone_formats]
+
+
+def transcode_for_phone(file):
+    """
+    Decode file and resample it to 8 kHz mono (once) and encode the
+    telephony formats from that. Returns the list of files.
+    """
+    basename = get_phone_basename(file)
+    subprocess.run(['ffmpeg', '-v', 'error', '-y', '-i', file, '-vn', '-ac',
+                    '1', '-ar', str(phone_rate), '-f', 's16le',
+                    basename + '.sln'], check=True)
+    return encode_phone_formats(basename)
+
+
+def get_phone_files(file):
+    """
+    Return the telephony versions of file, encoded from the 8 kHz samples
+    written while exporting the result if they are there
+    """
+    basename = get_phone_basename(file)
+    # Both are written by the same ffmpeg run, but which one gets closed
+    # last isn't defined
+    if os.path.exists(basename + '.sln') and os.path.getmtime(
+            basename + '.sln') >= os.path.getmtime(file) - 60:
+        return encode_phone_formats(basename)
+    return transcode_for_phone(file)
+
 
+def cleanup_phone_files(file):
+    for ext in phone_formats:
+        filename = get_phone_basename(file) + ext
+        if os.path.exists(filename):
+            os.remove(filename)
 
-def upload_to_phoneserver(config, file):
-    logging.info('Uploading to phone server')
-    subprocess.run(['bash', '-c', '%s %s %s' % (os.path.join(os.path.dirname(
-        os.path.realpath(__file__)), 'upload-to-phone.sh'), file.replace(
-            '(', '\\(').replace(')', '\\)'), config['Upload']['PhoneServer'])])
+
+def upload_to_phone(server, files, name, attempt=0):
+    """
+    Copy files to the sounds directory of the phone server as name.<ext>,
+    all in one SFTP session
+    """
+    # name ends up in a quoted argument of the sftp batch
+    name = re.sub(r'[^\w-]', '_', name)
+    commands = ''.join(
+        f'put "{file}" "{phone_sounds_dir}{name}{os.path.splitext(file)[1]}"\n'
+        for file in files)
+    subprocess.run(['sftp', '-b', '-'] + _ssh_options() + [server],
+                   input=commands, text=True, check=True)
+    return sum(os.path.getsize(file) for file in files)
 
 
-def upload_announcement(config, file):
-    logging.info('Uploading to announcement')
-    subprocess.run(['bash', '-c', '%s %s %s %s' % (os.path.join(
-        os.path.dirname(os.path.realpath(__file__)),
-        'upload-announcement.sh'), file.replace('(', '\\(').replace(
-            ')', '\\)'), config['Upload']['Key'], config[
-                'Upload']['PhoneServer'])])
+def upload_recording_to_phone(server, file, attempt=0):
+    size = upload_to_phone(server, get_phone_files(file), 'Gottesdienst')
+    cleanup_phone_files(file)
+    return size
 
 
-def remove_from_website(config, file, year):
-    logging.info('Removing fallback file from website')
+def upload_announcement_to_phone(server, key, file, attempt=0):
+    """
+    Let the text-to-speech service read the announcement in file and copy
+    it to the phone server
+    """
+    with open(file, 'r') as f:
+        text = f.read()
+    speech_file = os.path.splitext(file)[0] + '-tts.wav'
+    query = urllib.parse.urlencode({'key': key, 'hl': 'de-de', 'v': 'Lina',
+                                    'src': text})
+    with urllib.request.urlopen(f'http://api.voicerss.org/?{query}',
+                                timeout=60) as response, \
+            open(speech_file, 'wb') as f:
+        f.write(response.read())
     try:
-        ftp = FTP(config['Upload']['Server'])
-        ftp.login(config['Upload']['User'], config['Upload']['Password'])
-        ftp.cwd(f'/Predigten/{year}/')
-        ftp.delete(os.path.basename(file))
-        ftp.quit()
-    except Exception as e:
-        logging.warning('Got exception deleting file from website: %s', e)
+        size = upload_to_phone(server, transcode_for_phone(speech_file),
+                               'Announce')
+    finally:
+        cleanup_phone_files(speech_file)
+        os.remove(speech_file)
+    return size
+
+
+def _ssh_options():
+    # All transfers to a server share one SSH connection
+    return ['-o', 'ControlMaster=auto', '-o', 'ControlPersist=60', '-o',
+            'ControlPath=' + os.path.join(tempfile.gettempdir(),
+                                          'autocut-ssh-%r@%h:%p')]
+
+
+class Uploader:
+    """
+    Runs the uploads. Transfers to different servers run at the same time,
+    transfers to the same server one after another over the same
+    connection. Failed transfers are retried with increasing delays (see
+    Upload/Retries and Upload/Backoff).
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.retries = int(config['Upload']['Retries'])
+        self.backoff = float(config['Upload']['Backoff'])
+        self.website = FtpConnection(config['Upload']['Server'],
+                                     config['Upload']['User'],
+                                     config['Upload']['Password'])
+        self.executors = {}
+        self.results = []
+
+    def submit(self, server, description, func, *args):
+        """
+        Queue func(*args, attempt=n) for server. Returns a future.
+        """
+        if server not in self.executors:
+            self.executors[server] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix=f'upload-{server}')
+        return self.executors[server].submit(self._run, server, description,
+                                             func, *args)
+
+    def _run(self, server, description, func, *args):
+        logging.info(description)
+        start = time()
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                delay = self.backoff * 2 ** (attempt - 1)
+                logging.info('        Retry again in %d s (%d. attempt)',
+                             delay, attempt)
+                sleep(delay)
+            try:
+                size = func(*args, attempt=attempt)
+                error = None
+                break
+            except Exception as e:
+                logging.warning('%s failed: %s', description, e)
+                error = e
+                if server == 'website':
+                    self.website.close()
+        seconds = time() - start
+        result = {'server': server, 'description': description,
+                  'ok': error is None, 'attempts': attempt + 1,
+                  'bytes': size if error is None else 0, 'seconds': seconds}
+        self.results.append(result)
+        return result
+
+    def upload_to_website(self, file, year, msg='Uploading to website'):
+        return self.submit('website', msg, self.website.upload, file,
+                           f'/Predigten/{year}/')
+
+    def remove_from_website(self, file, year):
+        return self.submit('website', 'Removing fallback file from website',
+                           self.website.delete, file, f'/Predigten/{year}/')
+
+    def upload_to_phoneserver(self, file):
+        return self.submit('phone', 'Uploading to phone server',
+                           upload_recording_to_phone,
+                           self.config['Upload']['PhoneServer'], file)
+
+    def upload_announcement(self, file):
+        return self.submit('phone', 'Uploading announcement',
+                           upload_announcement_to_phone,
+                           self.config['Upload']['PhoneServer'],
+                           self.config['Upload']['Key'], file)
+
+    def finish(self):
+        """
+        Wait for all uploads, close the connections and log a summary.
+        Returns True if all uploads succeeded.
+        """
+        for executor in self.executors.values():
+            executor.shutdown()
+        self.website.close()
+        for result in self.results:
+            mb = result['bytes'] / 1024 / 1024
+            logging.info('    %s: %s (%.1f MB in %.0f s, %.2f MB/s, %d '
+                         'attempts)', result['description'],
+                         'ok' if result['ok'] else 'FAILED', mb,
+                         result['seconds'],
+                         mb / result['seconds'] if result['seconds'] else 0,
+                         result['attempts'])
+        return all(result['ok'] for result in self.results)
+
+
+def upload_to_website(config, file, year, msg='Uploading to website'):
+    uploader = Uploader(config)
+    uploader.upload_to_website(file, year, msg)
+    return uploader.finish()
 
 
 def cleanup_intermediate(intermediate):
     logging.info('Cleanup intermediate')
+    if is_pcm_store(intermediate):
+        for filename in [get_segmenter_filename(intermediate),
+                         get_fallback_filename(intermediate)]:
+            if os.path.exists(filename):
+                os.remove(filename)
     os.remove(intermediate)
 
 def cleanup_announcement(announcement):
@@ -473,6 +3042,7 @@ def _creation_timestamp(input_file):
         # We're probably on Linux. Hopefully, we are on a recent enough
         # version that we can use the statx syscall. (If we are not, btime
         # below will be `None`.)
+        from statx import statx
         btime = statx(input_file).btime
         if btime:
             return btime
@@ -510,36 +3080,242 @@ def get_start_in_audio(input_file, info, date, detect_intro):
     return diff.seconds * 1000
 
 
-def process_audio(input_file, audio_file, services, use_start_time):
+def hash_input_file(input_file, sample_size=4 * 1024 * 1024):
+    """
+    Return a hash identifying the input file. To keep this fast for
+    recordings of several GB only the size and the first and last
+    sample_size bytes are hashed.
+    """
+    digest = hashlib.sha256()
+    size = os.path.getsize(input_file)
+    digest.update(str(size).encode())
+    with open(input_file, 'rb') as f:
+        digest.update(f.read(sample_size))
+        if size > sample_size:
+            f.seek(max(sample_size, size - sample_size))
+            digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+
+class Checkpoint:
+    """
+    Results of the stages of process_audio for one input file, stored as
+    JSON so that a rerun can continue after the last completed stage. Every
+    stage keeps its result per combination of the parameters it depends on
+    (including the results of earlier stages).
+    """
+    stages = ['convert', 'jingles', 'intro', 'segments', 'normalize']
+
+    def __init__(self, filename, resume=False, from_stage=None):
+        self.filename = filename
+        self.data = {}
+        if filename and resume and os.path.exists(filename):
+            try:
+                with open(filename, 'r') as f:
+                    self.data = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning('Can\'t read checkpoint %s: %s', filename, e)
+        if from_stage:
+            # Don't reuse the results of from_stage and later stages
+            for stage in self.stages[self.stages.index(from_stage):]:
+                self.data.pop(stage, None)
+
+    @staticmethod
+    def _key(params):
+        return json.dumps(params, sort_keys=True)
+
+    def get(self, stage, params):
+        return secure_lookup(self.data, stage, self._key(params))
+
+    def set(self, stage, params, value):
+        self.data.setdefault(stage, {})[self._key(params)] = value
+        if not self.filename:
+            return
+        try:
+            with open(self.filename, 'w') as f:
+                json.dump(self.data, f)
+        except OSError as e:
+            logging.warning('Can\'t write checkpoint %s: %s', self.filename,
+                            e)
+
+
+def open_checkpoint(config, input_file, resume, from_stage=None):
+    """
+    Return the checkpoint for input_file. Results of earlier runs are only
+    reused if resume is set, and only for the stages before from_stage.
+    """
+    directory = config['Cache']['Directory']
+    if not directory or not os.path.exists(input_file):
+        return Checkpoint(None)
+    directory = os.path.join(directory, 'checkpoints')
+    try:
+        os.makedirs(directory, exist_ok=True)
+        # remove checkpoints of old recordings
+        max_age = float(config['Cache']['MaxAge']) * 24 * 3600
+        for filename in glob.glob(os.path.join(directory, '*.json')):
+            if os.path.getmtime(filename) < time() - max_age:
+                os.remove(filename)
+    except OSError as e:
+        logging.warning('Can\'t use checkpoints: %s', e)
+        return Checkpoint(None)
+    return Checkpoint(os.path.join(directory,
+                                   f'{hash_input_file(input_file)}.json'),
+                      resume, from_stage)
+
+
+def give_up_without_intro(input_file, audio_file, info):
+    """
+    Upload the complete recording to the website instead (unless
+    --no-upload) and exit
+    """
+    if not args.no_upload:
+        # If we can't find intro we upload the full temp file to the website
+        upload_to_website(config, get_fallback_file(audio_file, input_file),
+                          info['year'])
+    exit(1)
+
+
+def process_audio(input_file, audio_file, services, use_start_time,
+                  checkpoint=None):
+    global decode_offset_ms
+    if checkpoint is None:
+        checkpoint = Checkpoint(None)
     date = extract_date_from_filename(input_file)
     logging.info(f'Found date {date.year:04}-{date.month:02}-{date.day:02}')
     info = get_info(services, date)
 
-    myAudio = load_audio(audio_file)
+    with metrics.stage('load'):
+        myAudio = load_audio(audio_file, args.streaming)
 
     if use_start_time:
-        start_in_audio_ms = get_start_in_audio(input_file, info, date, not args.use_start_time)
+        start_in_audio_ms = max(0, get_start_in_audio(
+            input_file, info, date, not args.use_start_time) -
+            decode_offset_ms)
     else:
         start_in_audio_ms = 0
 
-    startMilliseconds = find_start_after_intro(myAudio, start_in_audio_ms)
+    clips = get_jingle_clips(config)
+    intro_params = {'start_in_audio_ms': start_in_audio_ms,
+                    'decode_offset_ms': decode_offset_ms,
+                    'no_intro_detection': args.no_intro_detection,
+                    'use_start_time': args.use_start_time,
+                    'end_intro': args.end_intro,
+                    'reference': config['Intro']['Reference'],
+                    'jingles': _jingle_params(clips)}
+    startMilliseconds = checkpoint.get('intro', intro_params)
+
+    jingles = checkpoint.get('jingles', _jingle_params(clips))
+    if jingles is None:
+        jingles = []
+        # Intro jingles are only needed to find the intro
+        if any(role == 'outro' or (startMilliseconds is None and
+                                   not args.no_intro_detection)
+               for (_, role) in clips):
+            with metrics.stage('jingles'):
+                jingles = find_jingles(myAudio, clips)
+            checkpoint.set('jingles', _jingle_params(clips), jingles)
+    else:
+        logging.info('Using checkpoint: %d jingles', len(jingles))
+
+    if startMilliseconds is None:
+        with metrics.stage('intro'):
+            startMilliseconds = find_start_after_intro(myAudio,
+                                                       start_in_audio_ms,
+                                                       jingles=jingles)
+        # Not finding the intro might be caused by songrec or the network,
+        # so a rerun has to search again
+        if startMilliseconds >= 0:
+            checkpoint.set('intro', intro_params, startMilliseconds)
+    else:
+        logging.info('Using checkpoint: intro ends at %s',
+                     convert_milliseconds_to_readable(startMilliseconds))
     if startMilliseconds < 0:
+        if decode_offset_ms and not args.no_preconvert:
+            # The intro might be in the part we didn't decode
+            logging.info('Intro not found, decoding the whole recording')
+            cleanup_intermediate(audio_file)
+            offset_ms = decode_offset_ms
+            decoded_jingles = checkpoint.get('jingles', _jingle_params(clips))
+            decode_offset_ms = 0
+            with metrics.stage('convert'):
+                audio_file = convert_to_pcm_store(input_file)
+            checkpoint.set('convert', {'start_ms': 0}, audio_file)
+            if decoded_jingles is not None:
+                # Only the part before offset_ms is new
+                with metrics.stage('jingles'):
+                    jingles = find_jingles(load_audio(audio_file), clips,
+                                           offset_ms)
+                checkpoint.set('jingles', _jingle_params(clips), jingles + [
+                    dict(jingle, start_ms=jingle['start_ms'] + offset_ms,
+                         end_ms=jingle['end_ms'] + offset_ms)
+                    for jingle in decoded_jingles])
+            return process_audio(input_file, audio_file, services,
+                                 use_start_time, checkpoint)
         if use_start_time:
             # try again from beginning
-            (resultFile, announcement, info) = process_audio(input_file, audio_file, services, False)
+            (resultFile, announcement, info) = process_audio(
+                input_file, audio_file, services, False, checkpoint)
             return resultFile, announcement, info
         else:
-            if not args.no_upload:
-                # If we can't find intro we upload the full temp file to the website
-                upload_to_website(config, audio_file, info['year'])
-            exit(1)
+            give_up_without_intro(input_file, audio_file, info)
 
-    segments = detect_detailed_segments(audio_file, startMilliseconds)
+    segments_params = {'start': startMilliseconds,
+                       'decode_offset_ms': decode_offset_ms,
+                       'segmenter': args.segmenter}
+    segments = checkpoint.get('segments', segments_params)
+    if segments is None:
+        with metrics.stage('segments'):
+            segments = detect_detailed_segments(myAudio, audio_file,
+                                                startMilliseconds)
+        checkpoint.set('segments', segments_params,
+                       [list(segment) for segment in segments])
+    else:
+        logging.info('Using checkpoint: %d detailed segments', len(segments))
 
-    resultAudio = normalize_segments(myAudio, segments)
+    end_ms = get_start_of_outro(jingles, startMilliseconds)
+    if end_ms is not None:
+        logging.info('Cutting at the outro at %s',
+                     convert_milliseconds_to_readable(end_ms))
+        segments = trim_segments(segments, end_ms)
 
-    resultFile = export_result(resultAudio, config['Paths']['OutputPath'],
-                               info)
+    # The services might have been updated meanwhile; the result gets
+    # named and uploaded with this metadata
+    info = get_info(services, date, current=True)
+    normalize_params = {
+        'filename': get_result_filename(config['Paths']['OutputPath'], info),
+        'segments': hashlib.sha256(json.dumps(
+            [list(segment) for segment in segments]).encode()).hexdigest(),
+        'normalize': args.normalize,
+        'renditions': dict(config['Renditions'])}
+    if args.normalize == 'loudness':
+        normalize_params.update(config['Normalize'])
+    resultFile = checkpoint.get('normalize', normalize_params)
+    if resultFile and os.path.exists(resultFile):
+        logging.info('Using checkpoint: %s', resultFile)
+    elif args.normalize == 'loudness':
+        with metrics.stage('normalize'):
+            resultFile = export_stream(
+                normalize_loudness(myAudio, segments, chunk_frames,
+                                   float(config['Normalize']['Target']),
+                                   float(config['Normalize']['TruePeak'])),
+                config['Paths']['OutputPath'], info, myAudio.frame_rate,
+                myAudio.channels)
+        checkpoint.set('normalize', normalize_params, resultFile)
+    elif isinstance(myAudio, StreamedAudio):
+        # Normalizing and encoding run interleaved
+        with metrics.stage('normalize'):
+            resultFile = export_stream(
+                normalize_segments_streaming(myAudio, segments, chunk_frames),
+                config['Paths']['OutputPath'], info, myAudio.frame_rate,
+                myAudio.channels)
+        checkpoint.set('normalize', normalize_params, resultFile)
+    else:
+        with metrics.stage('normalize'):
+            resultAudio = normalize_segments(myAudio, segments)
+        with metrics.stage('export'):
+            resultFile = export_result(resultAudio,
+                                       config['Paths']['OutputPath'], info)
+        checkpoint.set('normalize', normalize_params, resultFile)
     announcement = save_announcement_file(info)
 
     cleanup_intermediate(audio_file)
@@ -547,22 +3323,243 @@ def process_audio(input_file, audio_file, services, use_start_time):
     return resultFile, announcement, info
 
 
-if __name__ == '__main__':
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s [%(levelname)s] %(message)s",
-        handlers=[
-            logging.FileHandler(os.path.join(tempfile.gettempdir(),
-                                             "autocut.log")),
-            logging.StreamHandler()
-        ]
-    )
-    logging.info('STARTING AUTOCUT')
+class LiveRecording:
+    """
+    A recording that OBS is still writing. A thread feeds the file into
+    ffmpeg as it grows, which decodes it into a PCM store. The recording is
+    complete once the file didn't grow for Live/Timeout seconds.
+    """
+
+    def __init__(self, input_file, timeout, poll_interval):
+        self.input_file = input_file
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.file = _new_store_filename()
+        # Write the decoded audio as soon as it's there
+        cmd = _pcm_store_command('-', self.file,
+                                 options=['-flush_packets', '1'])
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        threading.Thread(target=self._feed, daemon=True).start()
+
+    def _feed(self):
+        last_growth = time()
+        try:
+            with open(self.input_file, 'rb') as f:
+                while True:
+                    data = f.read(1 << 20)
+                    if data:
+                        self.process.stdin.write(data)
+                        last_growth = time()
+                    elif time() - last_growth > self.timeout:
+                        logging.info('Recording %s is complete',
+                                     self.input_file)
+                        break
+                    else:
+                        sleep(self.poll_interval)
+        except OSError as e:
+            logging.warning('Got exception reading %s: %s', self.input_file,
+                            e)
+        finally:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+
+    @property
+    def finished(self):
+        return self.process.poll() is not None
+
+    def _available_ms(self):
+        available = []
+        for file in [self.file, get_segmenter_filename(self.file)]:
+            try:
+                (frame_rate, channels, offset, _) = _wav_layout(file)
+            except (OSError, ValueError, struct.error):
+                return 0
+            frames = (os.path.getsize(file) - offset) // (channels * 2)
+            available.append(1000 * frames // frame_rate)
+        return min(available)
+
+    def wait_for(self, ms):
+        """
+        Wait until ms of audio are decoded or the recording is complete.
+        Returns the PCM store with the audio decoded so far.
+        """
+        while not self.finished and self._available_ms() < ms:
+            sleep(self.poll_interval)
+        if self.finished:
+            if self.process.returncode != 0:
+                raise RuntimeError(f'ffmpeg failed to decode '
+                                   f'{self.input_file}')
+            return PcmStore(self.file)
+        return PcmStore(self.file, end_ms=self._available_ms())
+
+
+def find_start_after_intro_live(recording, start_in_audio_ms, recognizer):
+    """
+    Look for the intro every Live/IntroStep seconds in the audio that is
+    decoded so far. Returns the end of the intro, or -1 if it wasn't found
+    before the recording was complete or in the first --end-intro minutes.
+    The recognizer keeps the results of the candidates that were already
+    checked in an earlier step.
+    """
+    step_ms = int(config['Live']['IntroStep']) * 1000
+    end_ms = _intro_search_end_ms()
+    available_ms = 0
+    while True:
+        audio = recording.wait_for(available_ms + step_ms)
+        if recording.finished:
+            return find_start_after_intro(audio, start_in_audio_ms,
+                                          recognizer=recognizer)
+        available_ms = len(audio)
+        # The last few seconds might be the beginning of a longer segment
+        search_ms = available_ms - live_guard_ms
+        if not args.no_intro_detection:
+            logging.info('Looking for intro in the first %s',
+                         convert_milliseconds_to_readable(search_ms))
+        end_of_intro_ms = find_start_after_intro(audio, start_in_audio_ms,
+                                                 search_ms=search_ms,
+                                                 recognizer=recognizer)
+        if end_of_intro_ms >= 0 or (end_ms and search_ms > end_ms):
+            return end_of_intro_ms
+
+
+def iter_live_segments(recording, start_ms):
+    """
+    Segment the recording after start_ms window by window as soon as the
+    audio of a window is decoded. Yields (segments, final) with all
+    segments so far after every window.
+    """
+    window_ms = live_window_sec * 1000
+    overlap_ms = segment_overlap_sec * 1000
+    windows = []
+    owned_start = start_ms
+    # the windows are compared with the recording so far, like one pass
+    # compares them with the whole recording (the CNN only gets the part
+    # after start_ms)
+    if args.segmenter == 'fast':
+        reference = ClassifierReference()
+        added_ms = 0
+    else:
+        reference = SegmenterEnergy()
+        added_ms = start_ms
+    while True:
+        audio = recording.wait_for(owned_start + window_ms + overlap_ms)
+        final = recording.finished and \
+            len(audio) < owned_start + window_ms + overlap_ms
+        owned_end = len(audio) if final else owned_start + window_ms
+        if owned_end > owned_start:
+            logging.info('Detecting detailed segments %s - %s',
+                         convert_milliseconds_to_readable(owned_start),
+                         convert_milliseconds_to_readable(owned_end))
+            end_ms = min(len(audio), owned_end + overlap_ms)
+            if args.segmenter == 'fast':
+                reference.add(audio[added_ms:end_ms])
+                reference_level = reference.level()
+            else:
+                reference.add(audio.file, added_ms, end_ms)
+                reference_level = reference.mean()
+            added_ms = end_ms
+            windows.append((owned_start / 1000, owned_end / 1000,
+                            segment_window(audio.file,
+                                           max(start_ms,
+                                               owned_start - overlap_ms),
+                                           end_ms, args.segmenter,
+                                           reference_level)))
+        yield (stitch_segments(windows), final)
+        if final:
+            return
+        owned_start = owned_end
+
+
+def normalize_live(recording, start_ms, chunk_frames):
+    """
+    Normalize the pieces of the recording as soon as they can't change
+    anymore, i.e. all except the ones starting with the last piece that
+    gets normalized. Yields the normalized samples in blocks.
+    """
+    done = 0
+    for (segments, final) in iter_live_segments(recording, start_ms):
+        pieces = plan_normalization(segments)
+        stable = len(pieces) if final else max(
+            [i for (i, piece) in enumerate(pieces) if piece[2]], default=0)
+        if stable > done:
+            audio = recording.wait_for(0) if final else PcmStore(
+                recording.file)
+            if args.normalize == 'loudness':
+                yield from normalize_pieces_loudness(
+                    audio, pieces[done:stable], chunk_frames,
+                    float(config['Normalize']['Target']),
+                    float(config['Normalize']['TruePeak']))
+            else:
+                yield from normalize_pieces(audio, pieces[done:stable],
+                                            chunk_frames)
+            done = stable
+
+
+def process_live(input_file, services, use_start_time):
+    """
+    Process the recording while OBS is still recording: look for the intro
+    in the first minutes and segment, normalize and encode the recording
+    behind the recording head. When the recording is complete only the
+    last part remains to be done.
+    """
+    date = extract_date_from_filename(input_file)
+    logging.info(f'Found date {date.year:04}-{date.month:02}-{date.day:02}')
+    info = get_info(services, date)
+    recording = LiveRecording(input_file, float(config['Live']['Timeout']),
+                              float(config['Live']['PollInterval']))
+
+    if use_start_time:
+        start_in_audio_ms = get_start_in_audio(input_file, info, date,
+                                               not args.use_start_time)
+    else:
+        start_in_audio_ms = 0
+    recognizer = SongrecRecognizer(open_recognition_cache(config))
+    try:
+        with metrics.stage('intro'):
+            startMilliseconds = find_start_after_intro_live(
+                recording, start_in_audio_ms, recognizer)
+            if startMilliseconds < 0 and use_start_time:
+                # try again from beginning in the complete recording, as
+                # process_audio does
+                logging.info('No intro found while recording')
+                startMilliseconds = find_start_after_intro(
+                    recording.wait_for(float('inf')), 0,
+                    recognizer=recognizer)
+        if startMilliseconds < 0:
+            recording.wait_for(float('inf'))
+            give_up_without_intro(input_file, recording.file, info)
+
+        audio = recording.wait_for(0)
+        info = get_info(services, date, current=True)
+        # Includes waiting for the end of the recording
+        with metrics.stage('normalize'):
+            resultFile = export_stream(
+                normalize_live(recording, startMilliseconds, chunk_frames),
+                config['Paths']['OutputPath'], info, audio.frame_rate,
+                audio.channels)
+    except Exception:
+        if args.fallback_upload and not args.no_upload:
+            # Same as the fallback in run(), but we only have the complete
+            # recording now
+            upload_to_website(config, get_fallback_file(
+                recording.wait_for(float('inf')).file), info['year'],
+                'Uploading fallback')
+        raise
+    announcement = save_announcement_file(info)
+
+    cleanup_intermediate(recording.file)
 
+    return resultFile, announcement, info
+
+
+def create_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--debug', action='store_true', help='debug')
     parser.add_argument('--no-preconvert', action='store_true',
-                        help='don\'t do conversion to mp3 as first step')
+                        help='don\'t decode the audio into a PCM store as '
+                        'first step')
     parser.add_argument('--no-upload', action='store_true',
                         help='don\'t upload to servers')
     parser.add_argument('--no-intro-detection', action='store_true',
@@ -579,24 +3576,91 @@ if __name__ == '__main__':
                         help='upload previously converted files')
     parser.add_argument('--use-start-time', action='store_true',
                         help='')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue after the last stage that completed '
+                        'in a previous run with the same input file')
+    parser.add_argument('--from-stage', action='store',
+                        choices=Checkpoint.stages,
+                        help='reuse the results of a previous run, but '
+                        'run this stage and the following ones again')
+    parser.add_argument('--streaming', action='store_true',
+                        help='decode the audio in chunks instead of loading '
+                        'the entire recording into memory (see '
+                        'Processing/MaxMemory)')
+    parser.add_argument('--segmenter', action='store',
+                        choices=['cnn', 'fast'], default='cnn',
+                        help='detect speech and music with the CNN of '
+                        'inaSpeechSegmenter (default) or with a fast '
+                        'classifier of spectral features')
+    parser.add_argument('--normalize', action='store',
+                        choices=['peak', 'loudness'], default='peak',
+                        help='normalize the peak of every piece (default) '
+                        'or its loudness (see Normalize/*)')
+    parser.add_argument('--worker', action='store_true',
+                        help='keep running and process the jobs submitted '
+                        'with --submit (see Worker/Spool)')
+    parser.add_argument('--submit', action='store_true',
+                        help='hand the job over to the running worker and '
+                        'return immediately (if no worker is running the job '
+                        'is processed directly)')
+    parser.add_argument('--watch', action='store_true',
+                        help='run as worker and automatically process new '
+                        'recordings in InputPath (see Watch/*)')
+    parser.add_argument('--input', action='store',
+                        help='process this recording instead of the newest '
+                        'one in InputPath')
+    parser.add_argument('--live', action='store_true',
+                        help='process the recording while it is still being '
+                        'recorded (see Live/*)')
+    parser.add_argument('--profile', action='store_true',
+                        help='record time, CPU and memory used by the stages '
+                        'and append them to autocut-metrics.jsonl next to '
+                        'the log')
+    parser.add_argument('--batch', action='store', metavar='DIR|GLOB',
+                        help='process all recordings in DIR (or matching '
+                        'GLOB) in parallel')
+    parser.add_argument('--jobs', action='store', type=int,
+                        help='number of recordings to process at the same '
+                        'time in batch mode (default: number of CPUs)')
+    parser.add_argument('--upload', action='store_true',
+                        help='upload the results in batch mode too (by '
+                        'default batch mode implies --no-upload)')
+    return parser
+
+
+def get_metrics_filename():
+    return os.path.join(tempfile.gettempdir(), 'autocut-metrics.jsonl')
+
+
+def run(argv=None):
+    """
+    Process (or upload) one recording with the command line arguments argv
+    """
+    global args, debug, config, chunk_frames, metrics, decode_offset_ms
+    logging.info('STARTING AUTOCUT')
+    metrics = RunMetrics()
+    decode_offset_ms = 0
 
     resultFile = None
     announcementFile = None
     info = None
-    args = parser.parse_args()
+    args = create_parser().parse_args(argv)
     debug = bool(args.debug)
     config = read_config()
+    chunk_frames = get_chunk_frames(int(config['Processing']['MaxMemory']))
 
-    services = read_services(config['Paths']['Services'])
+    services = read_services(config)
+    uploader = Uploader(config)
 
     if args.upload_only:
         resultFile = args.upload_only
         announcementFile = get_announcement_filename()
         date = extract_date_from_filename(resultFile)
         logging.info(f'Found date {date.year:04}-{date.month:02}-{date.day:02}')
-        info = get_info(services, date)
+        info = get_info(services, date, current=True)
     else:
-        input_file = find_input_file(config['Paths']['InputPath'])
+        input_file = args.input or \
+            find_input_file(config['Paths']['InputPath'])
         if input_file:
             date = extract_date_from_filename(input_file)
             today = datetime.date.today()
@@ -618,29 +3682,488 @@ if __name__ == '__main__':
                 exit(1)
             input_file = os.path.join(config['Paths']['InputPath'], 'Godi.mp4')
 
-        if args.no_preconvert:
-            audio_file = input_file
+        if args.live:
+            try:
+                (resultFile, announcementFile, info) = process_live(
+                    input_file, services,
+                    args.use_start_time or not args.no_intro_detection)
+            except Exception as e:
+                logging.warning('Got exception processing audio: %s', e)
         else:
-            audio_file = convert_video_to_mp3(input_file)
+            checkpoint = open_checkpoint(config, input_file,
+                                         args.resume or bool(args.from_stage),
+                                         args.from_stage)
+            use_start_time = args.use_start_time or \
+                not args.no_intro_detection
+            if not args.no_preconvert:
+                decode_offset_ms = get_decode_start_ms(
+                    input_file, services, use_start_time)
+            convert_params = {'start_ms': decode_offset_ms}
+            audio_file = checkpoint.get('convert', convert_params)
+            if args.no_preconvert:
+                audio_file = input_file
+            elif audio_file and os.path.exists(audio_file):
+                logging.info('Using checkpoint: %s', audio_file)
+            else:
+                with metrics.stage('convert'):
+                    audio_file = convert_to_pcm_store(
+                        input_file, args.fallback_upload, decode_offset_ms)
+                checkpoint.set('convert', convert_params, audio_file)
 
-        if args.fallback_upload:
-            upload_to_website(config, audio_file, datetime.datetime.now().year, 'Uploading fallback')
+            if args.fallback_upload:
+                fallback_file = get_fallback_file(audio_file, input_file)
+                # Wait for the upload since processing removes the file
+                with metrics.stage('fallback'):
+                    uploader.upload_to_website(
+                        fallback_file, datetime.datetime.now().year,
+                        'Uploading fallback').result()
 
-        try:
-            (resultFile, announcementFile, info) = process_audio(
-                input_file, audio_file,
-                services, args.use_start_time or not args.no_intro_detection)
+            try:
+                (resultFile, announcementFile, info) = process_audio(
+                    input_file, audio_file, services, use_start_time,
+                    checkpoint)
 
-            if args.fallback_upload:
-                remove_from_website(config, audio_file, datetime.datetime.now().year)
-        except Exception as e:
-            logging.warning('Got exception processing audio: %s', e)
+                if args.fallback_upload:
+                    uploader.remove_from_website(fallback_file,
+                                                 datetime.datetime.now().year)
+            except Exception as e:
+                logging.warning('Got exception processing audio: %s', e)
 
-    if not args.no_upload:
-        upload_to_website(config, resultFile, info['year'])
-        upload_to_phoneserver(config, resultFile)
-        upload_announcement(config, announcementFile)
+    with metrics.stage('upload'):
+        if not args.no_upload:
+            uploader.upload_to_website(resultFile, info['year'])
+            uploader.upload_to_phoneserver(resultFile)
+            uploader.upload_announcement(announcementFile)
+        if not uploader.finish():
+            logging.warning('Not all uploads succeeded')
 
     cleanup_announcement(announcementFile)
+    if resultFile:
+        cleanup_phone_files(resultFile)
 
+    if args.profile:
+        metrics.write(get_metrics_filename(), argv=argv, result=resultFile,
+                      uploads=uploader.results)
     logging.info('AUTOCUT FINISHED!')
+    return resultFile
+
+
+def _worker_heartbeat_file(spool):
+    return os.path.join(spool, 'worker.json')
+
+
+def is_worker_running(config):
+    """
+    Check if a worker is running by looking at the heartbeat it writes
+    every time it looks for new jobs
+    """
+    try:
+        with open(_worker_heartbeat_file(config['Worker']['Spool']), 'r') as f:
+            heartbeat = json.load(f)
+        if time() - heartbeat['time'] > 3 * float(
+                config['Worker']['PollInterval']):
+            return False
+        os.kill(heartbeat['pid'], 0)
+        return True
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def submit_job(config, argv):
+    """
+    Put the job into the spool directory of the worker
+    """
+    spool = config['Worker']['Spool']
+    os.makedirs(spool, exist_ok=True)
+    name = f'{time_ns()}-{os.getpid()}'
+    # Write under a different name first so that the worker doesn't pick
+    # up a partially written job
+    filename = os.path.join(spool, f'{name}.tmp')
+    with open(filename, 'w') as f:
+        json.dump({'argv': argv, 'submitted': time()}, f)
+    os.rename(filename, os.path.join(spool, f'{name}.job'))
+    logging.info('Submitted job %s', name)
+
+
+def claim_job(job_file):
+    """
+    Claim the job by renaming it. Returns the new filename, or None if
+    somebody else already took the job.
+    """
+    running_file = os.path.splitext(job_file)[0] + '.running'
+    try:
+        os.rename(job_file, running_file)
+        return running_file
+    except OSError:
+        return None
+
+
+def run_claimed_job(running_file):
+    """
+    Run the claimed job. Returns True if the job succeeded.
+    """
+    name = os.path.basename(os.path.splitext(running_file)[0])
+    try:
+        with open(running_file, 'r') as f:
+            job = json.load(f)
+        logging.info('Processing job %s', name)
+        run(job['argv'])
+        os.remove(running_file)
+        return True
+    except (Exception, SystemExit) as e:
+        logging.warning('Job %s failed: %s', name, e)
+        os.rename(running_file, os.path.splitext(running_file)[0] + '.failed')
+        return False
+
+
+def process_job(job_file):
+    """
+    Run the job in job_file. Returns True if the job succeeded.
+    """
+    running_file = claim_job(job_file)
+    return run_claimed_job(running_file) if running_file else False
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+
+def _inotify_watch(directory):
+    """
+    Return an inotify file descriptor that reports files in directory that
+    got closed after writing or moved into it, or None if inotify isn't
+    available
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(directory),
+                                  IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError, TypeError):
+        return None
+
+
+def _read_inotify_events(fd):
+    """
+    Return the names of the files in the pending inotify events
+    """
+    data = os.read(fd, 64 * 1024)
+    names = []
+    pos = 0
+    while pos + 16 <= len(data):
+        (_, _, _, length) = struct.unpack_from('iIII', data, pos)
+        name = data[pos + 16:pos + 16 + length].rstrip(b'\0')
+        if name:
+            names.append(os.fsdecode(name))
+        pos += 16 + length
+    return names
+
+
+class RecordingWatcher:
+    """
+    Watches InputPath for new recordings. A recording is queued once its
+    size and modification time didn't change for Watch/StableTime seconds,
+    even if the writer still has it open; inotify only tells us about new
+    files earlier. Every recording gets submitted exactly once; the
+    recordings we've seen are kept in a database in the cache directory.
+    """
+
+    def __init__(self, config, wakeup):
+        self.directory = config['Paths']['InputPath']
+        self.extensions = [f'.{ext.strip().lower()}' for ext in
+                           config['Watch']['Extensions'].split(',')]
+        self.stable_seconds = float(config['Watch']['StableTime'])
+        self.poll_interval = float(config['Worker']['PollInterval'])
+        self.arguments = shlex.split(config['Watch']['Arguments'])
+        self.db_file = os.path.join(config['Cache']['Directory'],
+                                    'recordings.db')
+        self.config = config
+        self.wakeup = wakeup
+        self.pending = {}
+
+    def is_recording(self, name):
+        return name[:1].isdigit() and \
+            os.path.splitext(name)[1].lower() in self.extensions
+
+    def _scan(self):
+        return [entry.path for entry in os.scandir(self.directory)
+                if entry.is_file() and self.is_recording(entry.name)]
+
+    def _is_known(self, path):
+        return self.db.execute('SELECT 1 FROM recordings WHERE path = ?',
+                               (path,)).fetchone() is not None
+
+    def _add_pending(self, path):
+        if path not in self.pending and not self._is_known(path):
+            self.pending[path] = (None, 0)
+
+    def _check_pending(self):
+        now = time()
+        for path in list(self.pending):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+            (state, since) = self.pending[path]
+            if state != (stat.st_size, stat.st_mtime):
+                self.pending[path] = ((stat.st_size, stat.st_mtime), now)
+            elif now - since >= self.stable_seconds:
+                del self.pending[path]
+                self.enqueue(path)
+
+    def enqueue(self, path):
+        with self.db:
+            inserted = self.db.execute(
+                'INSERT OR IGNORE INTO recordings VALUES (?, ?)',
+                (path, time())).rowcount
+        if inserted:
+            logging.info('New recording %s', path)
+            submit_job(self.config, ['--input', path] + self.arguments)
+            self.wakeup.set()
+
+    def run(self):
+        os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+        self.db = sqlite3.connect(self.db_file)
+        (count,) = self.db.execute(
+            'SELECT COUNT(*) FROM sqlite_master WHERE name = ?',
+            ('recordings',)).fetchone()
+        self.db.execute('CREATE TABLE IF NOT EXISTS recordings (path TEXT '
+                        'PRIMARY KEY, enqueued REAL)')
+        if not count:
+            # First start: don't process the recordings that are already
+            # there
+            with self.db:
+                self.db.executemany(
+                    'INSERT OR IGNORE INTO recordings VALUES (?, 0)',
+                    [(path,) for path in self._scan()])
+        # Recordings that arrived while we weren't watching
+        for path in self._scan():
+            self._add_pending(path)
+
+        fd = _inotify_watch(self.directory)
+        if fd is None:
+            logging.info('inotify not available; polling %s', self.directory)
+        logging.info('Watching %s for recordings', self.directory)
+        last_scan = time()
+        while True:
+            if fd is not None:
+                (ready, _, _) = select.select([fd], [], [], 1)
+                if ready:
+                    for name in _read_inotify_events(fd):
+                        if self.is_recording(name):
+                            self._add_pending(
+                                os.path.join(self.directory, name))
+            else:
+                sleep(1)
+            if time() - last_scan >= self.poll_interval:
+                # Rescan even with inotify: e.g. on drvfs (/mnt/c) watching
+                # works, but no events arrive for files written by Windows
+                # programs
+                for path in self._scan():
+                    self._add_pending(path)
+                last_scan = time()
+            self._check_pending()
+
+
+def _init_job_process():
+    global parallel_segmentation
+    # Several jobs already run in parallel
+    parallel_segmentation = False
+    # Load the models once per worker process
+    get_segmenter()
+
+
+def run_worker(config, watch=False):
+    """
+    Keep the segmenter loaded and process the jobs that get submitted to
+    the spool directory. Up to Worker/Concurrency jobs run at the same
+    time (in separate processes). With watch new recordings in InputPath
+    get submitted automatically.
+    """
+    spool = config['Worker']['Spool']
+    poll_interval = float(config['Worker']['PollInterval'])
+    concurrency = int(config['Worker']['Concurrency'])
+    os.makedirs(spool, exist_ok=True)
+    # Jobs that were running when the previous worker stopped
+    for running_file in glob.glob(os.path.join(spool, '*.running')):
+        os.rename(running_file, os.path.splitext(running_file)[0] + '.job')
+
+    def heartbeat():
+        # Written from a separate thread so that it stays fresh while a
+        # job is processed
+        while True:
+            with open(_worker_heartbeat_file(spool), 'w') as f:
+                json.dump({'pid': os.getpid(), 'time': time()}, f)
+            sleep(poll_interval)
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    wakeup = threading.Event()
+    if watch:
+        threading.Thread(target=RecordingWatcher(config, wakeup).run,
+                         daemon=True).start()
+
+    executor = None
+    if concurrency > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=concurrency, initializer=_init_job_process)
+    else:
+        get_segmenter()
+    logging.info('Worker waiting for jobs in %s', spool)
+    in_flight = set()
+    while True:
+        jobs = sorted(glob.glob(os.path.join(spool, '*.job')))
+        while jobs and len(in_flight) < concurrency:
+            running_file = claim_job(jobs.pop(0))
+            if not running_file:
+                continue
+            if executor:
+                in_flight.add(executor.submit(run_claimed_job, running_file))
+            else:
+                run_claimed_job(running_file)
+        if in_flight:
+            (_, in_flight) = concurrent.futures.wait(
+                in_flight, timeout=poll_interval,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+        elif not jobs:
+            wakeup.wait(poll_interval)
+            wakeup.clear()
+
+
+def find_batch_files(pattern, extensions):
+    """
+    Return the recordings in the directory pattern, or the files matching
+    the glob pattern
+    """
+    if os.path.isdir(pattern):
+        files = [os.path.join(pattern, name) for name in os.listdir(pattern)
+                 if os.path.splitext(name)[1].lower() in extensions]
+    else:
+        files = glob.glob(pattern)
+    return sorted(files)
+
+
+def _init_batch_process(batch_dir, segmenter):
+    global work_dir, parallel_segmentation
+    work_dir = tempfile.mkdtemp(dir=batch_dir)
+    # The recordings are already processed in parallel
+    parallel_segmentation = False
+    if segmenter == 'cnn':
+        get_segmenter()
+
+
+def run_batch_file(input_file, argv):
+    """
+    Process input_file in a batch worker process. Returns a summary dict.
+    """
+    summary = {'file': input_file, 'result': None, 'error': None,
+               'audio_seconds': 0}
+    start = time()
+    try:
+        (duration_ms, _) = probe_audio(input_file)
+        summary['audio_seconds'] = duration_ms / 1000
+        summary['result'] = run(argv + ['--input', input_file])
+        if not summary['result']:
+            summary['error'] = 'no result'
+    except (Exception, SystemExit) as e:
+        summary['error'] = str(e) or type(e).__name__
+    summary['seconds'] = time() - start
+    return summary
+
+
+def _format_summary(name, audio_seconds, seconds, status):
+    speed = audio_seconds / seconds if seconds else 0
+    return (f'{name:40.40} {status:6} '
+            f'{convert_milliseconds_to_readable(audio_seconds * 1000)} '
+            f'{convert_milliseconds_to_readable(seconds * 1000)} '
+            f'{speed:6.1f}x')
+
+
+def run_batch(pattern, argv, jobs=None, upload=False):
+    """
+    Process all recordings in pattern (a directory or a glob) with the
+    command line arguments argv, up to jobs recordings at the same time
+    in separate processes. Returns True if all recordings succeeded.
+
+    Unless upload is set nothing gets uploaded: the results of old
+    recordings would replace the current service and announcement on the
+    phone server and the website.
+    """
+    if not upload:
+        argv = [arg for arg in argv if arg != '--fallback-upload'] + \
+            ['--no-upload']
+    config = read_config()
+    extensions = [f'.{ext.strip().lower()}' for ext in
+                  config['Watch']['Extensions'].split(',')]
+    files = find_batch_files(pattern, extensions)
+    if not files:
+        logging.warning('No recordings found in %s', pattern)
+        return False
+    segmenter = create_parser().parse_args(argv).segmenter
+    if not jobs:
+        # Every process loads its own segmenter models
+        jobs = get_segmenter_processes(config) if segmenter == 'cnn' \
+            else os.cpu_count() or 1
+    jobs = min(jobs, len(files))
+    logging.info('Processing %d recordings with %d processes', len(files),
+                 jobs)
+
+    start = time()
+    summaries = []
+    with tempfile.TemporaryDirectory(prefix='autocut-batch-') as batch_dir, \
+            concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs, initializer=_init_batch_process,
+                initargs=(batch_dir, segmenter)) as executor:
+        futures = [executor.submit(run_batch_file, file, argv)
+                   for file in files]
+        for future in concurrent.futures.as_completed(futures):
+            summary = future.result()
+            summaries.append(summary)
+            logging.info('Finished %s (%d/%d)%s', summary['file'],
+                         len(summaries), len(files),
+                         f': {summary["error"]}' if summary['error'] else '')
+    seconds = time() - start
+
+    audio_seconds = sum(summary['audio_seconds'] for summary in summaries)
+    failed = [summary for summary in summaries if summary['error']]
+    lines = [f'{"Recording":40} {"Status":6} {"Audio":10} {"Time":10} '
+             f'{"Speed":>7}']
+    for summary in sorted(summaries, key=lambda summary: summary['file']):
+        lines.append(_format_summary(
+            os.path.basename(summary['file']), summary['audio_seconds'],
+            summary['seconds'],
+            'failed' if summary['error'] else 'ok'))
+    lines.append(_format_summary(
+        f'Total ({len(failed)} of {len(summaries)} failed)', audio_seconds,
+        seconds, ''))
+    print('\n'.join(lines))
+    return not failed
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[
+            logging.FileHandler(os.path.join(tempfile.gettempdir(),
+                                             "autocut.log")),
+            logging.StreamHandler()
+        ]
+    )
+
+    argv = sys.argv[1:]
+    main_args = create_parser().parse_args(argv)
+    if main_args.worker or main_args.watch:
+        run_worker(read_config(), main_args.watch)
+    elif main_args.batch:
+        sys.exit(0 if run_batch(main_args.batch, argv, main_args.jobs,
+                                main_args.upload) else 1)
+    elif main_args.submit and is_worker_running(read_config()):
+        submit_job(read_config(), [arg for arg in argv if arg != '--submit'])
+    else:
+        run(argv)
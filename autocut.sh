@@ -21,5 +21,8 @@ if [ ! -f last-install.sha1 ] || [[ "$(cat last-install.sha1)" != "$(git rev-par
     git rev-parse HEAD > last-install.sha1
 fi
 python3 autocut.py "$@" || true
+if [[ " $* " == *" --submit "* ]] || [[ " $* " == *" --worker "* ]]; then
+    exit
+fi
 # shellcheck disable=SC2162
 read -p "Press Enter..."
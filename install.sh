@@ -34,7 +34,7 @@ check_repository() {
 }
 
 check_repository marin-m/songrec
-check_and_install_package "songrec python3 python3-pip python3.12-venv ncftp lame sox openssh-client wget ffmpeg"
+check_and_install_package "songrec python3 python3-pip python3.12-venv sox openssh-client ffmpeg"
 
 if (( $(lsb_release -r -s | cut -d'.' -f1) >= 24 )); then
     [ ! -d env ] && python3 -m venv env
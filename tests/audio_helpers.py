@@ -0,0 +1,18 @@
+"""
+Synthetic audio shared by the tests and the benchmarks
+"""
+import numpy as np
+
+
+def make_speech(seconds, frame_rate, rng):
+    # voiced syllables with a varying pitch after an unvoiced consonant, four
+    # per second, and short pauses between words
+    t = np.arange(int(seconds * frame_rate)) / frame_rate
+    syllable = (t * 4) % 1
+    index = (t * 4).astype(int)
+    pitch = rng.uniform(100, 220, index[-1] + 1)[index] * (1 - 0.2 * syllable)
+    phase = 2 * np.pi * np.cumsum(pitch) / frame_rate
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 11)) * np.sin(
+        np.pi * np.clip((syllable - 0.2) / 0.7, 0, 1))
+    unvoiced = rng.normal(0, 0.3, len(t)) * (syllable < 0.2)
+    return (voiced + unvoiced) * (np.sin(2 * np.pi * 0.3 * t) > -0.95)
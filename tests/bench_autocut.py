@@ -0,0 +1,338 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the hot paths of autocut on a synthetic recording (tones,
+synthetic syllables, silences and a known intro). Not collected by pytest;
+run it with
+
+    PYTHONPATH=. python3 tests/bench_autocut.py [--minutes 60]
+
+It prints the throughput (seconds of audio per second) and peak memory of
+every stage and fails if a stage is slower, or needs more memory, than
+bench_baseline.json allows. --update-baseline stores the current results
+as new baseline. It also fails if importing autocut or `autocut.py --help`
+takes longer than startup_limit seconds.
+
+    PYTHONPATH=. python3 tests/bench_autocut.py --compare RECORDING
+
+compares the fast speech/music classifier (--segmenter fast) with the CNN
+of inaSpeechSegmenter on a real recording.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+
+import numpy as np
+from pydub import AudioSegment
+
+from audio_helpers import make_speech
+import autocut
+
+baseline_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             'bench_baseline.json')
+intro_frequency = 1234
+startup_limit = 1.0
+# The fast classifier has to agree with the known segments this often. This
+# only catches regressions; the synthetic recording is much easier than a
+# real one (see --compare)
+min_accuracy = 0.9
+# Modules that only the stages that need them may import
+heavy_modules = ['tensorflow', 'inaSpeechSegmenter', 'pydub', 'statx']
+
+
+def make_recording(minutes, frame_rate=44100, seed=1):
+    """
+    Return (audio, intro_end_ms, segments) of a synthetic recording: some
+    talking before the service, the intro (a tone of intro_frequency) after
+    one minute and then alternating speech and music with silences in
+    between. segments are the (kind, start, stop) tuples (in seconds) after
+    the intro, like the segmenter returns them.
+    """
+    rng = np.random.default_rng(seed)
+    blocks = []
+    segments = []
+    pos = 0
+
+    def add(kind, seconds, volume=0.3):
+        nonlocal pos
+        t = np.arange(int(seconds * frame_rate)) / frame_rate
+        if kind == 'speech':
+            signal = make_speech(seconds, frame_rate, rng) / 3
+        elif kind == 'music':
+            signal = sum(np.sin(2 * np.pi * f * t) for f in
+                         rng.choice([220, 262, 330, 392, 440, 523], 3)) / 3
+        elif kind == 'intro':
+            signal = np.sin(2 * np.pi * intro_frequency * t)
+        else:
+            signal = np.zeros(len(t))
+        blocks.append((signal * volume * 32767).astype(np.int16))
+        if pos >= intro_end and kind != 'intro':
+            segments.append(('noEnergy' if kind == 'silence' else kind,
+                             pos / frame_rate, (pos + len(t)) / frame_rate))
+        pos += len(t)
+
+    intro_end = float('inf')
+    add('speech', 55, 0.05)
+    add('silence', 5)
+    add('intro', 30)
+    intro_end_ms = pos * 1000 // frame_rate
+    intro_end = pos
+    kind = 'speech'
+    while pos < minutes * 60 * frame_rate:
+        add('silence', rng.uniform(1.5, 3))
+        add(kind, rng.uniform(120, 360) if kind == 'speech' else
+            rng.uniform(150, 240), rng.uniform(0.1, 0.6))
+        kind = 'music' if kind == 'speech' else 'speech'
+    samples = np.concatenate(blocks)
+    samples = np.stack([samples, samples], axis=1)
+    return (AudioSegment(samples.tobytes(), frame_rate=frame_rate,
+                         sample_width=2, channels=2), intro_end_ms, segments)
+
+
+class StubRecognizer:
+    """
+    Recognizes the intro by its frequency instead of asking Shazam
+    """
+    name = 'stub'
+
+    def __init__(self):
+        self.calls = 0
+
+    def recognize(self, prepared):
+        self.calls += 1
+        (filename, _, _) = prepared
+        with wave.open(filename, 'rb') as f:
+            frame_rate = f.getframerate()
+            samples = np.frombuffer(f.readframes(f.getnframes()),
+                                    dtype=np.int16)[::f.getnchannels()]
+        spectrum = np.abs(np.fft.rfft(samples))
+        frequency = np.argmax(spectrum) * frame_rate / max(len(samples), 1)
+        if abs(frequency - intro_frequency) < 5:
+            return json.dumps({'track': {'subtitle': 'Jaykar',
+                                         'title': 'Dior'}})
+        return json.dumps({'matches': []})
+
+
+def segment_labels(segments, start, end, step=0.1):
+    """
+    Return the kind of the segments every step seconds between start and
+    end. The CNN distinguishes male and female speakers, which counts as
+    speech.
+    """
+    times = np.arange(start, end, step)
+    labels = np.full(len(times), 'none', dtype=object)
+    for (kind, segment_start, segment_stop) in segments:
+        labels[(times >= segment_start) & (times < segment_stop)] = \
+            'speech' if kind in ['male', 'female'] else kind
+    return labels
+
+
+def agreement(reference, segments, start, end):
+    """
+    Return the fraction of the time where segments have the same kind as
+    reference, and the confusion as {reference kind: {kind: fraction}}
+    """
+    expected = segment_labels(reference, start, end)
+    found = segment_labels(segments, start, end)
+    confusion = {}
+    for kind in sorted(set(expected)):
+        mask = expected == kind
+        confusion[kind] = {other: round(float(np.mean(found[mask] == other)),
+                                        3)
+                           for other in sorted(set(found[mask]))}
+    return (float(np.mean(expected == found)) if len(expected) else 1.0,
+            confusion)
+
+
+def measure(results, name, audio_seconds, func, *args):
+    """
+    Run func(*args) and record its throughput and peak memory. Fast stages
+    are run up to three times and the fastest run counts.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    for _ in range(2):
+        if seconds > 5:
+            break
+        start = time.perf_counter()
+        func(*args)
+        seconds = min(seconds, time.perf_counter() - start)
+    results[name] = {'throughput': round(audio_seconds / seconds, 1),
+                     'seconds': round(seconds, 3),
+                     'peak_mb': round(peak / 1024 / 1024, 1)}
+    print(f'{name:20} {audio_seconds:8.0f} s audio {seconds:8.2f} s '
+          f'{audio_seconds / seconds:8.1f}x {peak / 1024 / 1024:8.1f} MB',
+          flush=True)
+    return result
+
+
+def measure_startup(results):
+    """
+    Record how long a new process takes to import autocut (as the tests
+    do) and to show the help, and whether that loads heavy modules
+    """
+    directory = os.path.dirname(os.path.realpath(autocut.__file__))
+    check = ('import sys, autocut; print(",".join(m for m in %r '
+             'if m in sys.modules))' % heavy_modules)
+    for (name, cmd) in [
+            ('startup_import', [sys.executable, '-c', check]),
+            ('startup_help', [sys.executable, 'autocut.py', '--help'])]:
+        seconds = float('inf')
+        for _ in range(3):
+            start = time.perf_counter()
+            out = subprocess.run(cmd, cwd=directory, check=True, text=True,
+                                 stdout=subprocess.PIPE).stdout
+            seconds = min(seconds, time.perf_counter() - start)
+        results[name] = {'seconds': round(seconds, 3)}
+        print(f'{name:20} {seconds:8.2f} s', flush=True)
+        if name == 'startup_import' and out.strip():
+            print(f'{name}: imports {out.strip()}')
+            results[name]['wrong'] = True
+
+
+def run_benchmarks(minutes):
+    autocut.args = autocut.create_parser().parse_args([])
+    autocut.config = autocut.read_config()
+    autocut.debug = False
+    results = {}
+    measure_startup(results)
+    (audio, intro_end_ms, segments) = make_recording(minutes)
+    length = len(audio) / 1000
+
+    intro_audio = audio[:len(audio) / 2]
+    intro_segments = measure(results, 'detect_segments', length / 2,
+                             autocut.detect_segments, intro_audio)
+    end_ms = measure(results, 'intro_segments', length / 2,
+                     autocut.get_end_of_intro_segment, audio, intro_segments,
+                     StubRecognizer())
+    slot_end_ms = measure(results, 'intro_slots', length / 2,
+                          autocut.get_end_of_intro_segment_in_slots, audio,
+                          intro_segments, StubRecognizer())
+    for (name, found) in [('intro_segments', end_ms),
+                          ('intro_slots', slot_end_ms)]:
+        if abs(found - intro_end_ms) > 1000:
+            print(f'{name}: found end of intro at {found} ms, expected '
+                  f'{intro_end_ms} ms')
+            results[name]['wrong'] = True
+
+    autocut.args.segmenter = 'fast'
+    fast_segments = measure(results, 'segments_fast',
+                            length - intro_end_ms / 1000,
+                            autocut.detect_detailed_segments, audio, None,
+                            intro_end_ms)
+    autocut.args.segmenter = 'cnn'
+    (accuracy, confusion) = agreement(segments, fast_segments,
+                                      intro_end_ms / 1000, length)
+    results['segments_fast']['accuracy'] = round(accuracy, 3)
+    print(f'segments_fast: accuracy {accuracy:.3f} {confusion}')
+    if accuracy < min_accuracy:
+        results['segments_fast']['wrong'] = True
+
+    result = measure(results, 'normalize_segments',
+                     length - intro_end_ms / 1000,
+                     autocut.normalize_segments, audio, segments)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        autocut.work_dir = tmpdir
+        info = autocut.get_info({}, datetime.datetime(2024, 1, 7))
+        measure(results, 'export_result', len(result) / 1000,
+                autocut.export_result, result, tmpdir, info)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return the list of regressions against baseline
+    """
+    regressions = []
+    for (name, result) in results.items():
+        if result.get('wrong'):
+            regressions.append(f'{name}: wrong result')
+        if 'throughput' not in result:
+            if result['seconds'] > startup_limit:
+                regressions.append(f'{name}: {result["seconds"]} s, limit '
+                                   f'{startup_limit} s')
+            continue
+        expected = baseline.get(name)
+        if not expected:
+            continue
+        if result['throughput'] < expected['throughput'] * (1 - tolerance):
+            regressions.append(f'{name}: {result["throughput"]}x, baseline '
+                               f'{expected["throughput"]}x')
+        if result['peak_mb'] > expected['peak_mb'] * (1 + tolerance) + 10:
+            regressions.append(f'{name}: {result["peak_mb"]} MB, baseline '
+                               f'{expected["peak_mb"]} MB')
+    return regressions
+
+
+def compare_segmenters(recording):
+    """
+    Segment recording with the CNN and with the fast classifier and print
+    how well they agree
+    """
+    autocut.args = autocut.create_parser().parse_args([])
+    autocut.config = autocut.read_config()
+    autocut.debug = False
+    audio_file = autocut.convert_to_pcm_store(recording)
+    try:
+        audio = autocut.PcmStore(audio_file)
+        length = len(audio) / 1000
+        results = {}
+        autocut.parallel_segmentation = False
+        cnn = measure(results, 'segments_cnn', length,
+                      autocut.detect_detailed_segments, audio, audio_file, 0)
+        autocut.args.segmenter = 'fast'
+        fast = measure(results, 'segments_fast', length,
+                       autocut.detect_detailed_segments, audio, audio_file, 0)
+    finally:
+        autocut.cleanup_intermediate(audio_file)
+    (accuracy, confusion) = agreement(cnn, fast, 0, length)
+    print(f'Agreement with the CNN: {accuracy:.3f}')
+    for (kind, found) in confusion.items():
+        print(f'    {kind:10} {found}')
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--minutes', type=int, default=20,
+                        help='length of the synthetic recording')
+    parser.add_argument('--tolerance', type=float, default=0.3,
+                        help='allowed regression (0.3 = 30%%)')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--compare', action='store', metavar='RECORDING',
+                        help='compare the fast classifier with the CNN on '
+                        'RECORDING')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.compare:
+        return compare_segmenters(args.compare)
+
+    results = run_benchmarks(args.minutes)
+    if args.update_baseline:
+        with open(baseline_file, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+        return 0
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file, 'r') as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,26 @@
 #!/usr/bin/python3
+import configparser
 import datetime
+import numpy as np
 import os
 from parameterized import parameterized
+from pydub import AudioSegment, effects, silence
 import tempfile
+import threading
 import time
 import unittest
 from unittest import mock
-from autocut import convert_milliseconds_to_readable, extract_date_from_filename, get_start_in_audio
+import wave
+from audio_helpers import make_speech
+from autocut import convert_milliseconds_to_readable, extract_date_from_filename, get_start_in_audio, \
+    find_intro_offline, make_intro_fingerprint, detect_nonsilent, normalize_segments, \
+    plan_normalization, RecognitionCache, split_into_windows, stitch_segments, \
+    lin2ulaw, _segment_candidates, _slot_candidates, normalize_loudness, ServicesIndex, \
+    JingleCatalogue, classify_segments, segment_window, FtpConnection, get_jingle_clips, \
+    ClassifierReference, SegmenterEnergy, segment_file, get_segmenter_processes, \
+    _init_batch_process, Checkpoint, open_checkpoint, process_audio, create_parser, read_config, \
+    upload_to_phone, LiveRecording, iter_live_segments, find_start_after_intro_live, PcmStore, \
+    get_decode_start_ms, get_fallback_file, smooth_kinds
 
 
 mock_creation_time = datetime.time()
@@ -16,6 +30,86 @@ def mocked_get_creation_time(input_file):
     return mock_creation_time
 
 
+def make_audio(samples, frame_rate=8000):
+    samples = np.asarray(samples, dtype=np.int16)
+    return AudioSegment(samples.tobytes(), frame_rate=frame_rate,
+                        sample_width=2, channels=1)
+
+
+def write_store(store_file, samples, frame_rate=16000):
+    # the PCM store (stereo) and its 16 kHz mono version for the segmenter
+    samples = np.asarray(samples, dtype=np.int16)
+    for (file, channels) in [(store_file, 2),
+                             (os.path.splitext(store_file)[0] + '-16k.wav', 1)]:
+        with wave.open(file, 'wb') as f:
+            f.setnchannels(channels)
+            f.setsampwidth(2)
+            f.setframerate(frame_rate)
+            f.writeframes(np.repeat(samples, channels).tobytes())
+
+
+class GrowingRecording:
+    """
+    A LiveRecording of a PCM store that grows by step_ms every time we
+    wait for more audio
+    """
+
+    def __init__(self, file, length_ms, step_ms):
+        self.file = file
+        self.length_ms = length_ms
+        self.step_ms = step_ms
+        self.available_ms = 0
+        self.finished = False
+
+    def wait_for(self, ms):
+        while not self.finished and self.available_ms < ms:
+            self.available_ms = min(self.available_ms + self.step_ms, self.length_ms)
+            self.finished = self.available_ms == self.length_ms
+        return PcmStore(self.file, end_ms=self.available_ms)
+
+
+class EnergySegmenter:
+    """
+    Labels the frames like the energy detection of inaSpeechSegmenter: the
+    ones much quieter than the mean of the audio it gets are noEnergy
+    """
+    energy_ratio = 0.03
+
+    def __call__(self, medianame, start_sec=None, stop_sec=None):
+        with wave.open(medianame, 'rb') as f:
+            samples = np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16)
+        start = round((start_sec or 0) * 16000)
+        stop = None if stop_sec is None else round(stop_sec * 16000)
+        energy = SegmenterEnergy.log_energy(samples[start:stop] / 32768)
+        active = energy > np.mean(energy[np.isfinite(energy)]) + \
+            np.log(self.energy_ratio)
+        segments = []
+        for (i, value) in enumerate(active):
+            kind = 'music' if value else 'noEnergy'
+            time = round(start / 16000 + i * 0.01, 2)
+            if segments and segments[-1][0] == kind:
+                segments[-1] = (kind, segments[-1][1], round(time + 0.01, 2))
+            else:
+                segments.append((kind, time, round(time + 0.01, 2)))
+        return segments
+
+
+def make_intro(seconds, frame_rate=8000):
+    rng = np.random.default_rng(42)
+    t = np.arange(seconds * frame_rate) / frame_rate
+    # noise with a distinctive loudness envelope
+    envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 0.7 * t) * np.sin(2 * np.pi * 0.13 * t)
+    return rng.normal(0, 6000, len(t)) * envelope
+
+
+def make_jingle(seed, seconds, frame_rate=16000):
+    rng = np.random.default_rng(seed)
+    t = np.arange(frame_rate // 4) / frame_rate
+    # a melody of short decaying notes
+    notes = rng.choice([262, 294, 330, 349, 392, 440, 494, 523, 587, 659], seconds * 4)
+    return np.concatenate([np.sin(2 * np.pi * f * t) * np.exp(-3 * t) * 6000 for f in notes])
+
+
 class TestAutocut(unittest.TestCase):
 
     @parameterized.expand([
@@ -74,6 +168,732 @@ class TestAutocut(unittest.TestCase):
         # verify
         self.assertEqual(start, exepcted)
 
+    @parameterized.expand([
+        [0],
+        [138403],
+        [400000],
+    ])
+    def test_find_intro_offline(self, offset):
+        # setup
+        rng = np.random.default_rng(1)
+        intro = make_intro(8)
+        recording = rng.normal(0, 300, 60 * 8000)
+        recording[offset:offset + len(intro)] += intro * 0.5
+        fingerprint = make_intro_fingerprint(make_audio(intro))
+
+        # execute
+        match = find_intro_offline(make_audio(recording), fingerprint)
+
+        # verify
+        self.assertEqual(match, (offset, offset + len(intro)))
+
+    def test_find_intro_offline_no_intro(self):
+        # setup
+        rng = np.random.default_rng(1)
+        recording = rng.normal(0, 3000, 60 * 8000)
+        fingerprint = make_intro_fingerprint(make_audio(make_intro(8)))
+
+        # execute
+        match = find_intro_offline(make_audio(recording), fingerprint)
+
+        # verify
+        self.assertIsNone(match)
+
+    @parameterized.expand([
+        [8000, 1, 1000, 100, -50],
+        [44100, 2, 1000, 100, -50],
+        [44100, 2, 750, 50, -50],
+        [48000, 2, 250, 1, -40],
+        [22050, 1, 333, 37, -16],
+    ])
+    def test_detect_nonsilent_same_as_pydub(self, frame_rate, channels, silence_len,
+                                            seek_step, thresh):
+        # setup
+        rng = np.random.default_rng(frame_rate + silence_len)
+        samples = rng.normal(0, 3000, (frame_rate * 10 + 17, channels))
+        for start, factor in [(0.5, 0), (2.1, 0.01), (4, 0.1), (6.3, 0), (9.5, 0)]:
+            pos = int(start * frame_rate)
+            samples[pos:pos + int(rng.integers(frame_rate // 10, frame_rate))] *= factor
+        audio = AudioSegment(samples.astype(np.int16).tobytes(), frame_rate=frame_rate,
+                             sample_width=2, channels=channels)
+
+        # execute
+        ranges = detect_nonsilent(audio, silence_len, thresh, seek_step)
+
+        # verify
+        self.assertEqual(ranges, silence.detect_nonsilent(audio, silence_len, thresh,
+                                                          seek_step))
+
+    def test_detect_nonsilent_all_silent(self):
+        audio = make_audio(np.zeros(8000 * 5))
+        self.assertEqual(detect_nonsilent(audio, 1000, -50, 100), [])
+
+    @parameterized.expand([
+        [8000, 1, [('music', 0.0, 9.5), ('noEnergy', 9.5, 12.3), ('speech', 12.3, 20.02),
+                   ('noise', 20.02, 21.0), ('speech', 21.0, 30.0), ('music', 30.0, 40.0)]],
+        [44100, 2, [('speech', 0.0, 3.33), ('music', 3.33, 12.0), ('noise', 12.0, 12.5),
+                    ('music', 12.5, 25.0), ('noEnergy', 25.0, 26.0), ('speech', 26.0, 40.0)]],
+        [22050, 2, [('noEnergy', 0.0, 1.0), ('speech', 1.0, 39.98), ('music', 39.98, 40.001)]],
+    ])
+    def test_normalize_segments_same_as_pydub(self, frame_rate, channels, segments):
+        # setup
+        rng = np.random.default_rng(frame_rate)
+        samples = rng.normal(0, 2000, (frame_rate * 40, channels))
+        samples[frame_rate * 20:frame_rate * 25] *= 6
+        audio = AudioSegment(np.clip(samples, -32768, 32767).astype(np.int16).tobytes(),
+                             frame_rate=frame_rate, sample_width=2, channels=channels)
+        expected = AudioSegment.empty()
+        for (start, stop, normalize) in plan_normalization(segments):
+            expected += effects.normalize(audio[start:stop]) if normalize else audio[start:stop]
+
+        # execute
+        result = normalize_segments(audio, segments)
+
+        # verify
+        self.assertEqual(result.raw_data, expected.raw_data)
+
+    def test_recognition_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # setup
+            filename = os.path.join(tmpdir, 'recognition.db')
+            cache = RecognitionCache(filename)
+            cache.put('songrec:1', '{"retryms": 1}')
+            cache.db.execute("UPDATE results SET created = 0 WHERE key = 'songrec:1'")
+            cache.db.commit()
+            cache.put('songrec:2', 'y' * 1000)
+            cache.put('songrec:3', 'x' * 1048000)
+            cache.db.close()
+
+            # execute
+            cache = RecognitionCache(filename, max_age_days=90, max_size_mb=1)
+
+            # verify
+            self.assertIsNone(cache.get('songrec:1'))
+            self.assertIsNone(cache.get('songrec:2'))
+            self.assertEqual(cache.get('songrec:3'), 'x' * 1048000)
+            cache.db.close()
+
+    def test_checkpoint_keeps_results_per_params(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # setup
+            filename = os.path.join(tmpdir, 'checkpoint.json')
+            Checkpoint(filename).set('intro', {'start_in_audio_ms': 0}, 120000)
+
+            # execute
+            checkpoint = Checkpoint(filename, resume=True)
+
+            # verify
+            self.assertEqual(checkpoint.get('intro', {'start_in_audio_ms': 0}), 120000)
+            self.assertIsNone(checkpoint.get('intro', {'start_in_audio_ms': 60000}))
+            self.assertIsNone(Checkpoint(filename).get('intro', {'start_in_audio_ms': 0}))
+
+    def test_checkpoint_from_stage(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # setup
+            filename = os.path.join(tmpdir, 'checkpoint.json')
+            checkpoint = Checkpoint(filename)
+            for stage in Checkpoint.stages:
+                checkpoint.set(stage, {}, stage)
+
+            # execute
+            checkpoint = Checkpoint(filename, resume=True, from_stage='intro')
+
+            # verify
+            self.assertEqual([checkpoint.get(stage, {}) for stage in Checkpoint.stages],
+                             ['convert', 'jingles', None, None, None])
+
+    def test_checkpoint_resume_after_failed_export(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # setup
+            filename = os.path.join(tmpdir, 'checkpoint.json')
+            checkpoint = Checkpoint(filename)
+            checkpoint.set('intro', {}, 120000)
+            checkpoint.set('segments', {'start': 120000}, [['speech', 120.0, 900.0]])
+
+            # execute
+            checkpoint = Checkpoint(filename, resume=True)
+
+            # verify
+            self.assertEqual(checkpoint.get('intro', {}), 120000)
+            self.assertEqual(checkpoint.get('segments', {'start': 120000}),
+                             [['speech', 120.0, 900.0]])
+            self.assertIsNone(checkpoint.get('normalize', {}))
+
+    def test_open_checkpoint(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # setup
+            input_file = os.path.join(tmpdir, 'recording.mkv')
+            with open(input_file, 'wb') as f:
+                f.write(b'recording')
+            config = configparser.ConfigParser()
+            config.read_dict({'Cache': {'Directory': tmpdir, 'MaxAge': '30'}})
+            old_file = os.path.join(tmpdir, 'checkpoints', 'old.json')
+            os.makedirs(os.path.dirname(old_file))
+            with open(old_file, 'w') as f:
+                f.write('{}')
+            os.utime(old_file, (0, 0))
+            open_checkpoint(config, input_file, False).set('intro', {}, 120000)
+
+            # execute
+            resumed = open_checkpoint(config, input_file, True)
+            restarted = open_checkpoint(config, input_file, False)
+
+            # verify
+            self.assertEqual(resumed.get('intro', {}), 120000)
+            self.assertIsNone(restarted.get('intro', {}))
+            self.assertFalse(os.path.exists(old_file))
+
+    def test_open_checkpoint_without_cache(self):
+        # setup
+        config = configparser.ConfigParser()
+        config.read_dict({'Cache': {'Directory': '', 'MaxAge': '30'}})
+
+        # execute
+        checkpoint = open_checkpoint(config, __file__, True)
+
+        # verify
+        self.assertIsNone(checkpoint.filename)
+
+    @mock.patch('autocut.give_up_without_intro', side_effect=SystemExit(1))
+    @mock.patch('autocut.find_start_after_intro', return_value=-1)
+    @mock.patch('autocut.load_audio')
+    @mock.patch('autocut.decode_offset_ms', 0)
+    @mock.patch('autocut.config', read_config(), create=True)
+    @mock.patch('autocut.args', create_parser().parse_args([]), create=True)
+    def test_process_audio_does_not_checkpoint_missing_intro(self, load_audio,
+                                                             find_start_after_intro,
+                                                             give_up_without_intro):
+        # setup
+        checkpoint = Checkpoint(None)
+
+        # execute
+        with self.assertRaises(SystemExit):
+            process_audio('2024-06-30 09-36-16.mkv', 'audio.wav', None, False, checkpoint)
+
+        # verify
+        self.assertIsNone(checkpoint.get('intro', {}))
+        self.assertNotIn('intro', checkpoint.data)
+
+    @mock.patch('autocut.cleanup_intermediate')
+    @mock.patch('autocut.convert_to_pcm_store', return_value='whole.wav')
+    @mock.patch('autocut.find_jingles')
+    @mock.patch('autocut.get_jingle_clips', return_value=[(__file__, 'outro')])
+    @mock.patch('autocut.give_up_without_intro', side_effect=SystemExit(1))
+    @mock.patch('autocut.find_start_after_intro', return_value=-1)
+    @mock.patch('autocut.load_audio')
+    @mock.patch('autocut.decode_offset_ms', 60000)
+    @mock.patch('autocut.config', read_config(), create=True)
+    @mock.patch('autocut.args', create_parser().parse_args([]), create=True)
+    def test_process_audio_decodes_whole_recording_without_intro(
+            self, load_audio, find_start_after_intro, give_up_without_intro,
+            get_jingle_clips, find_jingles, convert_to_pcm_store, cleanup_intermediate):
+        # setup
+        checkpoint = Checkpoint(None)
+        find_jingles.side_effect = [[{'start_ms': 1000, 'end_ms': 3000}],
+                                    [{'start_ms': 30000, 'end_ms': 32000}]]
+
+        # execute
+        with self.assertRaises(SystemExit):
+            process_audio('2024-06-30 09-36-16.mkv', 'part.wav', None, False, checkpoint)
+
+        # verify
+        cleanup_intermediate.assert_called_once_with('part.wav')
+        convert_to_pcm_store.assert_called_once_with('2024-06-30 09-36-16.mkv')
+        self.assertEqual(checkpoint.get('convert', {'start_ms': 0}), 'whole.wav')
+        # only the part before the decoded audio is searched again
+        self.assertEqual(find_jingles.call_args.args[2], 60000)
+        self.assertEqual(find_start_after_intro.call_count, 2)
+        self.assertEqual(find_start_after_intro.call_args.kwargs['jingles'],
+                         [{'start_ms': 30000, 'end_ms': 32000},
+                          {'start_ms': 61000, 'end_ms': 63000}])
+
+    @parameterized.expand([
+        # (--use-start-time, expected start in the recording, --end-intro, expected)
+        (False, 1200000, None, 0),
+        (True, 1200000, None, 900000),
+        (True, 180000, None, 0),
+        (True, 1200000, '10', 500000),
+    ])
+    @mock.patch('autocut.get_start_in_audio')
+    def test_get_decode_start_ms(self, use_start_time, start_ms, end_intro, expected,
+                                 get_start_in_audio):
+        # setup
+        get_start_in_audio.return_value = start_ms
+        config = configparser.ConfigParser()
+        config.read_dict({'Processing': {'SeekMargin': '5'}})
+        args = create_parser().parse_args(
+            ['--use-start-time'] + (['--end-intro', end_intro] if end_intro else []))
+
+        # execute
+        with mock.patch('autocut.config', config, create=True), \
+                mock.patch('autocut.args', args, create=True):
+            result = get_decode_start_ms(__file__, None, use_start_time)
+
+        # verify
+        self.assertEqual(result, expected)
+
+    @parameterized.expand([
+        # (where the decoded audio starts, expected source of the mp3)
+        (0, 'store'),
+        (60000, 'input'),
+    ])
+    @mock.patch('autocut.subprocess.run')
+    def test_get_fallback_file(self, offset_ms, source, run):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # setup
+            store_file = os.path.join(tmpdir, 'store.wav')
+            write_store(store_file, np.zeros(16000))
+            files = {'store': store_file, 'input': '2024-06-30 09-36-16.mkv'}
+
+            # execute
+            with mock.patch('autocut.decode_offset_ms', offset_ms):
+                result = get_fallback_file(store_file, files['input'])
+
+        # verify
+        self.assertEqual(result, os.path.join(tmpdir, 'store.mp3'))
+        run.assert_called_once_with(['ffmpeg', '-i', files[source], '-vn', '-f', 'mp3',
+                                     result])
+
+    @mock.patch('autocut.subprocess.run')
+    def test_get_fallback_file_without_store(self, run):
+        # execute
+        result = get_fallback_file('recording.mp3', '2024-06-30 09-36-16.mkv')
+
+        # verify
+        self.assertEqual(result, 'recording.mp3')
+        run.assert_not_called()
+
+    def test_split_into_windows(self):
+        # execute
+        result = split_into_windows(100, 1400, 600, 30)
+
+        # verify
+        self.assertEqual(result, [(100, 730, 100, 700), (670, 1400, 700, 1400)])
+
+    def test_stitch_segments(self):
+        # setup
+        windows = [
+            (100, 700, [('noEnergy', 100, 102), ('speech', 102, 690), ('music', 690, 730)]),
+            (700, 1400, [('music', 670, 710), ('speech', 710, 1400)]),
+        ]
+
+        # execute
+        result = stitch_segments(windows)
+
+        # verify
+        self.assertEqual(result, [('noEnergy', 100, 102), ('speech', 102, 690),
+                                  ('music', 690, 710), ('speech', 710, 1400)])
+
+    @mock.patch('autocut.get_segmenter')
+    def test_segment_window_calls_segmenter_on_store(self, get_segmenter):
+        # execute
+        result = segment_window('/tmp/store.wav', 60000, 120000)
+
+        # verify
+        self.assertEqual(result, get_segmenter.return_value.return_value)
+        get_segmenter.return_value.assert_called_once_with(
+            '/tmp/store-16k.wav', start_sec=60, stop_sec=120)
+
+    @mock.patch('autocut.get_segmenter', return_value=EnergySegmenter())
+    def test_segment_windows_like_one_pass(self, get_segmenter):
+        # setup
+        t = np.arange(24 * 16000) / 16000
+        music = sum(np.sin(2 * np.pi * f * t) for f in [262, 330, 392]) * 3000
+        # the same music much quieter in the second half
+        music[12 * 16000:] /= 40
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store_file = os.path.join(tmpdir, 'store.wav')
+            write_store(store_file, music)
+            reference = SegmenterEnergy().add(store_file).mean()
+
+            # execute
+            single = segment_file(store_file)
+            windowed = stitch_segments([
+                (owned_start, owned_end,
+                 segment_window(store_file, start * 1000, end * 1000, 'cnn', reference))
+                for (start, end, owned_start, owned_end) in split_into_windows(0, 24, 6, 2)])
+
+        # verify
+        self.assertEqual([kind for (kind, _, _) in single], ['music', 'noEnergy'])
+        self.assertEqual(windowed, single)
+        self.assertAlmostEqual(single[1][1], 12, delta=0.05)
+        self.assertEqual(get_segmenter.return_value.energy_ratio, 0.03)
+
+    @mock.patch('autocut.segment_overlap_sec', 2)
+    @mock.patch('autocut.live_window_sec', 6)
+    @mock.patch('autocut.args', create_parser().parse_args([]), create=True)
+    @mock.patch('autocut.get_segmenter', return_value=EnergySegmenter())
+    def test_iter_live_segments_like_one_pass(self, get_segmenter):
+        # setup
+        t = np.arange(24 * 16000) / 16000
+        music = sum(np.sin(2 * np.pi * f * t) for f in [262, 330, 392]) * 3000
+        # the same music much quieter in the second half
+        music[12 * 16000:] /= 100
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store_file = os.path.join(tmpdir, 'store.wav')
+            write_store(store_file, music)
+            single = segment_file(store_file, 1000)
+            recording = GrowingRecording(store_file, 24000, 1000)
+
+            # execute
+            result = list(iter_live_segments(recording, 1000))
+
+        # verify
+        self.assertEqual([final for (_, final) in result], [False, False, False, True])
+        self.assertEqual([segments[-1][2] for (segments, _) in result],
+                         [7, 13, 19, single[-1][2]])
+        self.assertEqual(result[-1][0], single)
+        self.assertEqual([kind for (kind, _, _) in single], ['music', 'noEnergy'])
+
+    @mock.patch('autocut.live_guard_ms', 1000)
+    @mock.patch('autocut.config', read_config(), create=True)
+    @mock.patch('autocut.args', create_parser().parse_args(['--no-intro-detection']),
+                create=True)
+    def test_find_start_after_intro_live_without_intro_detection(self):
+        # setup
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store_file = os.path.join(tmpdir, 'store.wav')
+            write_store(store_file, np.zeros(600 * 16000))
+            recording = GrowingRecording(store_file, 600000, 1000)
+
+            # execute
+            with self.assertNoLogs(level='INFO'):
+                result = find_start_after_intro_live(recording, 0, None)
+
+        # verify
+        self.assertEqual(result, 0)
+        self.assertFalse(recording.finished)
+
+    @parameterized.expand([
+        # (pause of the recording program in seconds, expected length in ms)
+        (0.1, 40000),
+        (1, 20000),
+    ])
+    def test_live_recording(self, pause, expected):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # setup
+            input_file = os.path.join(tmpdir, 'recording.wav')
+            # long enough that ffmpeg starts decoding before the pause
+            samples = (np.sin(np.arange(40 * 48000) / 10) * 10000).astype(np.int16)
+            complete_file = os.path.join(tmpdir, 'complete.wav')
+            with wave.open(complete_file, 'wb') as f:
+                f.setnchannels(2)
+                f.setsampwidth(2)
+                f.setframerate(48000)
+                f.writeframes(np.repeat(samples, 2).tobytes())
+            with open(complete_file, 'rb') as f:
+                data = f.read()
+            half = len(data) - samples.nbytes
+            with open(input_file, 'wb') as f:
+                f.write(data[:half])
+
+            def keep_recording():
+                time.sleep(pause)
+                with open(input_file, 'ab') as f:
+                    f.write(data[half:])
+            writer = threading.Thread(target=keep_recording)
+            writer.start()
+
+            # execute
+            with mock.patch('autocut.work_dir', tmpdir):
+                recording = LiveRecording(input_file, 0.5, 0.05)
+            first = recording.wait_for(1000)
+            first_finished = recording.finished
+            audio = recording.wait_for(float('inf'))
+            writer.join()
+
+            # verify
+            self.assertGreaterEqual(len(first), 1000)
+            self.assertFalse(first_finished)
+            self.assertTrue(recording.finished)
+            self.assertEqual(len(audio), expected)
+            np.testing.assert_array_equal(audio.read_frames()[:, 0],
+                                          samples[:expected * 48])
+
+    @parameterized.expand([
+        ('default', '0', '0', 16000, 8),
+        ('available_memory', '0', '0', 3500, 3),
+        ('budget', '0', '2000', 16000, 2),
+        ('little_memory', '0', '500', 16000, 1),
+        ('explicit', '12', '2000', 16000, 12),
+    ])
+    @mock.patch('os.cpu_count', return_value=8)
+    @mock.patch('autocut.available_memory_mb')
+    def test_get_segmenter_processes(self, _, processes, memory, available, expected,
+                                     available_memory_mb, cpu_count):
+        # setup
+        config = configparser.ConfigParser()
+        config.read_dict({'Processing': {'SegmenterProcesses': processes,
+                                         'SegmenterMemory': memory}})
+        available_memory_mb.return_value = available
+
+        # execute
+        result = get_segmenter_processes(config)
+
+        # verify
+        self.assertEqual(result, expected)
+
+    @parameterized.expand([
+        ('cnn', 1),
+        ('fast', 0),
+    ])
+    @mock.patch('autocut.work_dir', None)
+    @mock.patch('autocut.parallel_segmentation', True)
+    @mock.patch('autocut.get_segmenter')
+    def test_init_batch_process_loads_models_only_for_cnn(self, segmenter, calls,
+                                                          get_segmenter):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # execute
+            _init_batch_process(tmpdir, segmenter)
+
+        # verify
+        self.assertEqual(get_segmenter.call_count, calls)
+
+    @parameterized.expand([
+        (0, 0xFF),
+        (-1, 0x7E),
+        (100, 0xF2),
+        (-100, 0x72),
+        (32767, 0x80),
+        (-32768, 0x00),
+    ])
+    def test_lin2ulaw(self, sample, expected):
+        # execute
+        result = lin2ulaw(np.array([sample], dtype=np.int16))
+
+        # verify
+        self.assertEqual(result[0], expected)
+
+    @mock.patch('autocut._intro_search_end_ms', return_value=None)
+    def test_segment_candidates_closest_first(self, _):
+        # setup
+        segments = [(0, 30000), (40000, 70000), (75000, 400000), (405000, 440000)]
+
+        # execute
+        result = _segment_candidates(segments, expected_ms=80000)
+
+        # verify
+        self.assertEqual([candidate[2] for candidate in result], [1, 0, 2, 3])
+
+    @parameterized.expand([
+        # without expected start: every third slot chronologically, then the
+        # slots next to the ones in the first minute, then the others
+        (0, ['0-0', '1-40000', '1-100000', '1-160000',
+             '0-20000', '1-60000',
+             '1-80000', '1-120000', '1-140000', '1-180000']),
+        # all passes start at the expected start
+        (100000, ['1-100000', '1-40000', '1-160000', '0-0',
+                  '1-80000', '1-60000', '1-120000', '1-140000', '1-180000',
+                  '0-20000']),
+    ])
+    @mock.patch('autocut._intro_search_end_ms', return_value=None)
+    def test_slot_candidates_coarse_to_fine(self, expected_ms, expected, _):
+        # setup
+        segments = [(0, 30000), (40000, 200000)]
+
+        # execute
+        result = _slot_candidates(segments, 20000, expected_ms)
+
+        # verify
+        self.assertEqual([candidate[2] for candidate in result], expected)
+
+    @parameterized.expand([
+        # (bytes sent before the first attempt failed, expected REST offset)
+        (0, None),
+        (1000, 1000),
+    ])
+    @mock.patch('autocut.FTP')
+    def test_ftp_upload_resumes_only_own_upload(self, sent, expected, ftp_class):
+        # setup
+        ftp = ftp_class.return_value
+        # a file from an earlier run is on the server if we didn't send
+        # anything
+        ftp.size.return_value = sent or 2000
+        offsets = []
+
+        def storbinary(cmd, f, blocksize, callback, rest):
+            offsets.append(rest)
+            if len(offsets) == 1:
+                if sent:
+                    callback(f.read(sent))
+                raise OSError('connection reset')
+        ftp.storbinary.side_effect = storbinary
+        connection = FtpConnection('server', 'user', 'password')
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'x' * 4000)
+            f.flush()
+            with self.assertRaises(OSError):
+                connection.upload(f.name, '/Predigten/2024/')
+
+            # execute
+            result = connection.upload(f.name, '/Predigten/2024/', attempt=1)
+
+        # verify
+        self.assertEqual(offsets[1], expected)
+        self.assertEqual(result, 4000 - (expected or 0))
+
+    @parameterized.expand([
+        ['Gottesdienst', 'Gottesdienst'],
+        ['Announce"\nrm /etc/passwd', 'Announce__rm__etc_passwd'],
+        ['../Gottesdienst', '___Gottesdienst'],
+    ])
+    @mock.patch('autocut.subprocess.run')
+    def test_upload_to_phone_sanitises_name(self, name, expected, run):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # setup
+            file = os.path.join(tmpdir, 'recording.sln')
+            with open(file, 'wb') as f:
+                f.write(b'x' * 100)
+
+            # execute
+            result = upload_to_phone('server', [file], name)
+
+        # verify
+        self.assertEqual(run.call_args.kwargs['input'],
+                         f'put "{file}" "/var/lib/asterisk/sounds/de_DE/custom/{expected}.sln"\n')
+        self.assertEqual(result, 100)
+
+    @parameterized.expand([
+        # (target LUFS, expected peak in dBFS)
+        (-16, -16),
+        # the true peak limiter keeps the peak below -1 dBTP
+        (0, -1),
+    ])
+    def test_normalize_loudness(self, target, expected):
+        # setup
+        t = np.arange(48000 * 10) / 48000
+        samples = np.sin(2 * np.pi * 997 * t) * 0.1 * 32767
+        samples = np.stack([samples, samples], axis=1).astype(np.int16)
+        audio = AudioSegment(samples.tobytes(), frame_rate=48000,
+                             sample_width=2, channels=2)
+
+        # execute
+        result = np.concatenate(list(normalize_loudness(
+            audio, [('speech', 0, 10)], 1 << 16, target=target)))
+
+        # verify
+        self.assertEqual(len(result), len(samples))
+        peak = 20 * np.log10(np.abs(result[48000:-48000]).max() / 32768)
+        self.assertAlmostEqual(peak, expected, delta=0.1)
+
+    @mock.patch('autocut.fetch_services')
+    def test_services_index_uses_stored_index_if_offline(self, fetch_services):
+        # setup
+        date = datetime.date(2024, 1, 7)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_file = os.path.join(tmpdir, 'services.db')
+            fetch_services.return_value = {date: {'name': 'Familiengottesdienst'}}
+            ServicesIndex('repo', db_file, 3600, 1)._refresh()
+            fetch_services.return_value = None
+            index = ServicesIndex('repo', db_file, 0, 1)
+
+            # execute
+            index.refresh()
+            result = index.get(date, current=True)
+
+        # verify
+        self.assertEqual(result, {'name': 'Familiengottesdienst'})
+        self.assertIsNone(index.get(datetime.date(2024, 1, 14)))
+
+    @mock.patch('autocut.fetch_services')
+    def test_services_index_refreshes_once(self, fetch_services):
+        # setup
+        date = datetime.date(2024, 1, 7)
+
+        def fetch(repo, timeout):
+            time.sleep(0.2)
+            return {date: {'name': 'Familiengottesdienst'}}
+        fetch_services.side_effect = fetch
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_file = os.path.join(tmpdir, 'services.db')
+            indexes = [ServicesIndex('repo', db_file, 3600, 5) for _ in range(2)]
+
+            # execute
+            for index in indexes:
+                index.refresh()
+            result = [index.get(date, current=True) for index in indexes]
+
+        # verify
+        self.assertEqual(fetch_services.call_count, 1)
+        self.assertEqual(result, [{'name': 'Familiengottesdienst'}] * 2)
+
+    def test_jingle_catalogue_find(self):
+        # setup
+        jingles = {'intro.wav': make_audio(make_jingle(1, 8), 16000),
+                   'outro.wav': make_audio(make_jingle(2, 8), 16000)}
+        with mock.patch('pydub.AudioSegment.from_file', side_effect=jingles.get):
+            catalogue = JingleCatalogue.build([('intro.wav', 'intro'), ('outro.wav', 'outro')])
+        rng = np.random.default_rng(1)
+        recording = rng.normal(0, 1000, 60 * 16000)
+        recording[40 * 16000:48 * 16000] += make_jingle(2, 8)
+
+        # execute
+        result = catalogue.find(make_audio(recording, 16000))
+
+        # verify
+        self.assertEqual([(jingle['role'], jingle['start_ms'], jingle['end_ms'])
+                          for jingle in result], [('outro', 40000, 48000)])
+
+    def test_get_jingle_clips_skips_missing(self):
+        # setup
+        config = configparser.ConfigParser()
+        with tempfile.NamedTemporaryFile(suffix='.wav') as f:
+            config.read_dict({'Jingles': {'Intro': f'{f.name}, /missing/intro.wav',
+                                          'Outro': ''}})
+
+            # execute
+            result = get_jingle_clips(config)
+
+        # verify
+        self.assertEqual(result, [(f.name, 'intro')])
+
+    def test_classify_segments(self):
+        # setup
+        rng = np.random.default_rng(1)
+        t = np.arange(20 * 16000) / 16000
+        music = sum(np.sin(2 * np.pi * f * t) for f in [262, 330, 392]) * 3000
+        speech = make_speech(20, 16000, rng) * 5000
+        audio = make_audio(np.concatenate([music, np.zeros(2 * 16000), speech]), 16000)
+
+        # execute
+        result = classify_segments(audio, 10)
+
+        # verify
+        self.assertEqual([kind for (kind, _, _) in result], ['music', 'noEnergy', 'speech'])
+        self.assertAlmostEqual(result[1][1], 30, delta=0.5)
+        self.assertAlmostEqual(result[2][1], 32, delta=0.5)
+        self.assertEqual(result[-1][2], 52)
+
+    def test_smooth_kinds_keeps_short_pauses(self):
+        # setup
+        kinds = ['speech'] * 5 + ['music', 'noEnergy'] + ['speech'] * 5
+
+        # execute
+        result = smooth_kinds(kinds)
+
+        # verify
+        self.assertEqual(list(result), ['speech'] * 6 + ['noEnergy'] + ['speech'] * 5)
+
+    def test_classify_segments_uses_reference_of_recording(self):
+        # setup
+        t = np.arange(30 * 16000) / 16000
+        music = sum(np.sin(2 * np.pi * f * t) for f in [262, 330, 392]) * 3000
+        # hum far below the level of the recording
+        quiet = music[:10 * 16000] / 70
+        recording = make_audio(np.concatenate([music, quiet]), 16000)
+        window = make_audio(quiet, 16000)
+        reference = ClassifierReference().add(recording).level()
+
+        # execute
+        whole = classify_segments(recording)
+        alone = classify_segments(window, 30)
+        windowed = classify_segments(window, 30, reference)
+
+        # verify
+        self.assertEqual(whole[-1][0], 'noEnergy')
+        self.assertNotEqual(alone[0][0], 'noEnergy')
+        self.assertEqual(windowed, [('noEnergy', 30, 40)])
+
 
 if __name__ == '__main__':
     unittest.main()
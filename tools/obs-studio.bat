@@ -1,4 +1,4 @@
 REM Start OBS Studio and then after closing that call GD Wuerfel Export
 cd "C:\Program Files\obs-studio\bin\64bit"
 "C:\Program Files\obs-studio\bin\64bit\obs64.exe"
-start C:\Windows\System32\wsl.exe -d Ubuntu -- bash -c /home/kirche/autocut/autocut.sh --fallback-upload --autostart --use-start-time
\ No newline at end of file
+start C:\Windows\System32\wsl.exe -d Ubuntu-24.04 -- bash -c "/home/kirche/autocut/autocut.sh --submit --fallback-upload --autostart --use-start-time"
\ No newline at end of file